@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the ast and tokenize Imports scanners
+
+    $ python benchmarks/imports_scanner.py [DIRECTORY]
+
+every .py file in DIRECTORY (defaults to the standard library) is scanned with
+both scanners, the timings and any files where the scanners disagree are printed
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import argparse
+import os
+import sys
+import time
+import sysconfig
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from herd.reflection import Imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", nargs="?", default=sysconfig.get_paths()["stdlib"])
+    args = parser.parse_args()
+
+    filepaths = []
+    for root_dir, dirs, files in os.walk(args.directory):
+        for basename in files:
+            if basename.endswith(".py"):
+                filepaths.append(os.path.join(root_dir, basename))
+
+    timings = {}
+    results = {}
+    for scanner in ["ast", "tokenize"]:
+        start = time.time()
+        results[scanner] = [Imports(fp, cache=False, scanner=scanner) for fp in filepaths]
+        timings[scanner] = time.time() - start
+
+    mismatches = 0
+    for fp, a, t in zip(filepaths, results["ast"], results["tokenize"]):
+        if a != t:
+            mismatches += 1
+            print("mismatch {}: {}".format(fp, sorted(a ^ t)))
+
+    print("files: {}".format(len(filepaths)))
+    print("ast: {:.3f}s".format(timings["ast"]))
+    print("tokenize: {:.3f}s".format(timings["tokenize"]))
+    print("speedup: {:.2f}x".format(timings["ast"] / timings["tokenize"] if timings["tokenize"] else 0.0))
+    print("mismatches: {}".format(mismatches))
+
+
+if __name__ == "__main__":
+    main()
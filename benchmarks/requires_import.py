@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare parsing a big package's imports serially and with a process pool
+
+    $ python benchmarks/requires_import.py --modules 5000 --processes 4
+
+this creates a synthetic package with --modules modules and times
+Package._requires_import() both ways with an empty imports cache
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import argparse
+import os
+import sys
+import time
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from herd.reflection import Packages, Package, ImportsCache
+
+
+def create_package(basedir, name, count, per_dir=100):
+    """create package name in basedir with count modules split into subpackages
+    of per_dir modules"""
+    lines = [
+        "import os",
+        "import sys",
+        "from collections import defaultdict",
+        "from json import loads as json_loads",
+        "",
+    ]
+    for i in range(20):
+        lines.extend([
+            "def func_{}(a, b=None, *args, **kwargs):".format(i),
+            "    '''docstring {}'''".format(i),
+            "    ret = defaultdict(list)",
+            "    for x in range(a):",
+            "        if x % 2:",
+            "            ret[x].append([y * 2 for y in args if y])",
+            "    return json_loads(os.environ.get('FOO', '{}')) or ret",
+            "",
+        ])
+    body = "\n".join(lines)
+
+    pkgdir = os.path.join(basedir, name)
+    for i in range(count):
+        subdir = os.path.join(pkgdir, "sub{}".format(i // per_dir))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+            with open(os.path.join(subdir, "__init__.py"), "w") as fp:
+                fp.write("")
+
+        # every module is different so the content hash lookups all miss
+        with open(os.path.join(subdir, "mod{}.py".format(i)), "w") as fp:
+            fp.write(body)
+            fp.write("\nMODULE_ID = {}\n".format(i))
+
+    with open(os.path.join(pkgdir, "__init__.py"), "w") as fp:
+        fp.write("import sys\n")
+
+
+def run(basedir, name, processes):
+    cache = ImportsCache(os.path.join(basedir, "imports.pickle"))
+    ImportsCache.instance = cache
+    Package.parse_processes = processes
+    Package.parse_threshold = 1
+
+    p = Packages(paths=[basedir])[name]
+    start = time.time()
+    imports = p._requires_import()
+    stop = time.time()
+    return stop - start, imports, cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", type=int, default=5000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    basedir = tempfile.mkdtemp(prefix="herd-bench-")
+    try:
+        name = "herdbench"
+        create_package(basedir, name, args.modules)
+
+        serial, serial_imports, _ = run(basedir, name, 0)
+        parallel, parallel_imports, cache = run(basedir, name, args.processes)
+        if serial_imports != parallel_imports:
+            raise RuntimeError("Serial and parallel imports don't match")
+
+        print("modules: {}".format(args.modules))
+        print("serial: {:.3f}s".format(serial))
+        print("parallel ({} processes): {:.3f}s".format(args.processes, parallel))
+        print("speedup: {:.2f}x".format(serial / parallel if parallel else 0.0))
+
+    finally:
+        shutil.rmtree(basedir)
+
+
+if __name__ == "__main__":
+    main()
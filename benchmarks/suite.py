@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time dependency resolution, package lookups and bundling against synthetic site-packages
+
+    $ python benchmarks/suite.py [--scale small --scale medium] [--output results.json]
+    $ python benchmarks/suite.py --baseline benchmarks/baseline.json [--threshold 0.25]
+    $ python benchmarks/suite.py --save-baseline
+
+for every scale a site-packages directory is created with --distributions
+distributions of --modules modules each. Every distribution has a dist-info
+folder whose Requires-Dist lines make a binary tree of dependencies, some have
+a .so stub, and some are required with a differently cased name so the case
+insensitive lookups are used. The handler imports the root of the tree.
+
+Every case is ran --repeat times and the fastest and median times are kept. The
+results are written as JSON, if there is a baseline then any case whose fastest
+time is more than --threshold and --min-delta slower than the baseline's is a
+regression and the exit code is 1
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import argparse
+import os
+import sys
+import time
+import json
+import shutil
+import hashlib
+import logging
+import platform
+import tempfile
+import sysconfig
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from herd import __version__
+from herd.path import Zippath, Filepath
+from herd.reflection import Packages, Dependencies, Dirindex, ImportsCache
+from herd.serverless.interface.aws import Lambda
+
+
+SCALES = {
+    "small": (20, 10),
+    "medium": (100, 20),
+    "large": (400, 25),
+}
+"""name -> (distributions, modules per distribution)"""
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+class Role(object):
+    arn = "arn:aws:iam::123456789012:role/herd-benchmarks"
+
+
+def get_name(i):
+    return "synth_pkg{:04}".format(i)
+
+
+def create_site(basedir, distributions, modules):
+    """create a site-packages directory in basedir
+
+    :returns: tuple, (site-packages directory, the handler's path)
+    """
+    sitedir = os.path.join(basedir, "site-packages")
+    ext = sysconfig.get_config_var("EXT_SUFFIX") or ".so"
+
+    lines = []
+    for i in range(10):
+        lines.extend([
+            "def func_{}(a, b=None, *args, **kwargs):".format(i),
+            "    '''docstring {}'''".format(i),
+            "    ret = defaultdict(list)",
+            "    for x in range(a):",
+            "        if x % 2:",
+            "            ret[x].append([y * 2 for y in args if y])",
+            "    return json.loads(os.environ.get('FOO', '{}')) or ret",
+            "",
+        ])
+    body = "\n".join(lines)
+
+    for i in range(distributions):
+        name = get_name(i)
+        requires = [j for j in (2 * i + 1, 2 * i + 2) if j < distributions]
+
+        pkgdir = os.path.join(sitedir, name)
+        os.makedirs(pkgdir)
+        relpaths = []
+        for m in range(modules):
+            relpath = "{}/mod{}.py".format(name, m)
+            with open(os.path.join(sitedir, relpath), "w") as fp:
+                fp.write("import os\nimport json\nfrom collections import defaultdict\n")
+                if m:
+                    fp.write("from . import mod{}\n".format(m - 1))
+                fp.write(body)
+                # every module is different so nothing is found by content hash
+                fp.write("\nMODULE_ID = {!r}\n".format(relpath))
+            relpaths.append(relpath)
+
+        relpath = "{}/__init__.py".format(name)
+        with open(os.path.join(sitedir, relpath), "w") as fp:
+            for j in requires:
+                fp.write("import {}\n".format(get_name(j)))
+            fp.write("from . import mod0\n")
+        relpaths.append(relpath)
+
+        if i % 10 == 9:
+            relpath = "{}/_speedups{}".format(name, ext)
+            with open(os.path.join(sitedir, relpath), "wb") as fp:
+                for j in range(2048):
+                    fp.write(hashlib.sha256("{}-{}".format(i, j).encode("ascii")).digest())
+            relpaths.append(relpath)
+
+        infodir = "{}-1.0.dist-info".format(name)
+        os.makedirs(os.path.join(sitedir, infodir))
+        metadata = ["Metadata-Version: 2.1", "Name: {}".format(name), "Version: 1.0"]
+        for j in requires:
+            # every fifth distribution is required with a differently cased name
+            metadata.append("Requires-Dist: {} (>=1.0)".format(
+                get_name(j).upper() if j % 5 == 4 else get_name(j)
+            ))
+        for basename, contents in [
+            ("METADATA", "\n".join(metadata) + "\n"),
+            ("top_level.txt", name + "\n"),
+        ]:
+            with open(os.path.join(sitedir, infodir, basename), "w") as fp:
+                fp.write(contents)
+            relpaths.append("{}/{}".format(infodir, basename))
+
+        relpaths.append("{}/RECORD".format(infodir))
+        with open(os.path.join(sitedir, infodir, "RECORD"), "w") as fp:
+            for relpath in relpaths:
+                fp.write("{},,\n".format(relpath))
+
+    handler = os.path.join(basedir, "handler", "herd_benchmark.py")
+    os.makedirs(os.path.dirname(handler))
+    with open(handler, "w") as fp:
+        # the imports are in the function so creating the Lambda doesn't import them
+        fp.write("\n".join([
+            "def handler(event, context):",
+            "    import json",
+            "    import {}".format(get_name(0)),
+            "    return {'statusCode': 200, 'body': json.dumps(event)}",
+            "",
+        ]))
+
+    return sitedir, handler
+
+
+def reset(basedir):
+    """forget everything a previous run cached so the next run is cold"""
+    Dirindex.clear()
+    path = os.path.join(basedir, "imports.pickle")
+    if os.path.exists(path):
+        os.remove(path)
+    ImportsCache.instance = ImportsCache(path)
+
+
+def timeit(callback, repeat, setup=None):
+    """call callback repeat times
+
+    :returns: tuple, (list of the seconds each call took, the last call's return value)
+    """
+    timings = []
+    ret = None
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        ret = callback()
+        timings.append(time.perf_counter() - start)
+    return timings, ret
+
+
+def run_scale(scale, distributions, modules, repeat, workers):
+    """run every case against one synthetic site-packages
+
+    :returns: dict, case name -> result
+    """
+    ret = {}
+
+    def add(case, timings, unit="s", **kwargs):
+        timings = sorted(timings)
+        result = {
+            "min": timings[0],
+            "median": timings[len(timings) // 2],
+            "unit": unit,
+        }
+        result.update(kwargs)
+        ret["{}/{}".format(scale, case)] = result
+
+    basedir = tempfile.mkdtemp(prefix="herd-bench-")
+    sys_path = list(sys.path)
+    try:
+        sitedir, handler = create_site(basedir, distributions, modules)
+        sys.path.insert(0, sitedir)
+        names = [get_name(i) for i in range(distributions)]
+        setup = lambda: reset(basedir)
+
+        # lookups
+        def lookup(names):
+            packages = Packages(paths=[sitedir])
+            ret = 0
+            for name in names:
+                if packages.get(name):
+                    ret += 1
+            return packages, ret
+
+        timings, (packages, found) = timeit(lambda: lookup(names), repeat, setup)
+        add("lookup.hit", timings, count=found)
+
+        timings, found = timeit(lambda: sum(1 for name in names if packages.get(name)), repeat)
+        add("lookup.hit.warm", timings, count=found)
+
+        upper = [name.upper() for name in names]
+        timings, (packages, found) = timeit(lambda: lookup(upper), repeat, setup)
+        add("lookup.case", timings, count=found)
+
+        missing = ["missing_pkg{:04}".format(i) for i in range(distributions)]
+        timings, (packages, found) = timeit(lambda: lookup(missing), repeat, setup)
+        add("lookup.miss", timings, count=found)
+
+        timings, found = timeit(lambda: sum(1 for name in missing if packages.get(name)), repeat)
+        add("lookup.miss.warm", timings, count=found)
+
+        # resolution
+        for case, w in [("resolve", 0), ("resolve.concurrent", workers)]:
+            timings, d = timeit(lambda: Dependencies(handler, workers=w), repeat, setup)
+            add(case, timings, count=len(d))
+
+        reset(basedir)
+        Dependencies(handler)
+        timings, d = timeit(lambda: Dependencies(handler), repeat, Dirindex.clear)
+        add("resolve.cached", timings, count=len(d))
+
+        lockfile = os.path.join(basedir, "herd.lock")
+        Dependencies(handler, lockfile=lockfile)
+        timings, d = timeit(lambda: Dependencies(handler, lockfile=lockfile), repeat, setup)
+        add("resolve.lockfile", timings, count=len(d))
+
+        # bundling
+        func = Lambda(handler, role=Role())
+        func.cache_fragments = False
+
+        def bundle_setup():
+            reset(basedir)
+            if func.lockfile.exists():
+                os.remove(func.lockfile)
+
+        timings, zippath = timeit(lambda: func.bundle(dry_run=True), repeat, bundle_setup)
+        add("bundle.assemble", timings, count=len(func.manifest))
+
+        timings, zippath = timeit(lambda: func.bundle(), repeat, bundle_setup)
+        add("bundle", timings, count=len(func.manifest), bytes=os.path.getsize(zippath))
+
+        # zip throughput over every file in site-packages
+        paths = []
+        for root_dir, dirs, files in os.walk(sitedir):
+            for basename in files:
+                path = Filepath(root_dir, basename)
+                paths.append((path, os.path.relpath(path, sitedir).replace(os.sep, "/")))
+        size = sum(os.path.getsize(path) for path, relpath in paths)
+        zippath = Zippath(basedir, "throughput.zip")
+        for case, w in [("zip.serial", 1), ("zip", None)]:
+            timings, count = timeit(lambda: zippath.write(paths, workers=w), repeat)
+            add(case, timings, count=count, bytes=size)
+            ret["{}/{}".format(scale, case)]["mb_per_s"] = size / (1024 * 1024) / min(timings)
+
+    finally:
+        sys.path[:] = sys_path
+        Dirindex.clear()
+        ImportsCache.instance = None
+        shutil.rmtree(basedir)
+
+    return ret
+
+
+def compare(results, baseline, threshold, min_delta):
+    """compare results against the baseline's results
+
+    :param threshold: float, how much slower (eg, 0.25 is 25%) a case can be
+    :param min_delta: float, a case also has to be this many seconds slower,
+        so the sub-millisecond cases don't fail on timer noise
+    :returns: list, (case, result, baseline result, ratio, is regression)
+        tuples for every case in both, ratio is how many times slower the
+        result is
+    """
+    ret = []
+    for case in sorted(results):
+        if case in baseline:
+            r = results[case]["min"]
+            b = baseline[case]["min"]
+            ratio = r / b if b else 0.0
+            regression = ratio > 1 + threshold and r - b > min_delta
+            ret.append((case, results[case], baseline[case], ratio, regression))
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scale",
+        dest="scales",
+        action="append",
+        choices=sorted(SCALES),
+        help="The scales to run, defaults to small and medium",
+    )
+    parser.add_argument(
+        "--distributions",
+        type=int,
+        default=0,
+        help="Run a custom scale with this many distributions instead",
+    )
+    parser.add_argument("--modules", type=int, default=10, help="Modules per distribution of the custom scale")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=Lambda.dependency_workers)
+    parser.add_argument("--output", default="", help="Write the results as JSON to this path, - is stdout")
+    parser.add_argument(
+        "--baseline",
+        default="",
+        help="Compare the results against this results file",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        nargs="?",
+        const=BASELINE,
+        default="",
+        help="Write the results as the new baseline, defaults to benchmarks/baseline.json",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="How much slower than the baseline a case can be before it is a regression",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=5,
+        metavar="MS",
+        help="A regression also has to be at least this many milliseconds slower",
+    )
+    args = parser.parse_args()
+
+    # the .so stubs would log a warning every bundle
+    logging.getLogger("herd").setLevel(logging.ERROR)
+
+    if args.distributions:
+        scales = [("custom", args.distributions, args.modules)]
+    else:
+        scales = [(name, ) + SCALES[name] for name in args.scales or ["small", "medium"]]
+
+    results = {}
+    for name, distributions, modules in scales:
+        print("scale {}: {} distributions x {} modules".format(name, distributions, modules), file=sys.stderr)
+        results.update(run_scale(name, distributions, modules, args.repeat, args.workers))
+
+    data = {
+        "meta": {
+            "herd": __version__,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+            "created": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        },
+        "results": results,
+    }
+
+    comparison = []
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        for k in ["python", "machine"]:
+            if baseline["meta"].get(k, "") != data["meta"][k]:
+                print("warning: baseline {} is {}, not {}".format(
+                    k,
+                    baseline["meta"].get(k, ""),
+                    data["meta"][k],
+                ), file=sys.stderr)
+        comparison = compare(
+            results,
+            baseline["results"],
+            args.threshold,
+            args.min_delta / 1000,
+        )
+
+    # the table goes to stderr when the JSON goes to stdout
+    out = sys.stderr if "-" in (args.output, args.save_baseline) else sys.stdout
+    if comparison:
+        print("{:<32} {:>10} {:>10} {:>8}".format("CASE", "MIN MS", "BASE MS", "RATIO"), file=out)
+        for case, r, b, ratio, regression in comparison:
+            print("{:<32} {:>10.2f} {:>10.2f} {:>7.2f}x{}".format(
+                case,
+                r["min"] * 1000,
+                b["min"] * 1000,
+                ratio,
+                " REGRESSION" if regression else "",
+            ), file=out)
+
+    else:
+        print("{:<32} {:>10} {:>10} {:>8}".format("CASE", "MIN MS", "MEDIAN MS", "COUNT"), file=out)
+        for case in sorted(results):
+            r = results[case]
+            print("{:<32} {:>10.2f} {:>10.2f} {:>8}".format(
+                case,
+                r["min"] * 1000,
+                r["median"] * 1000,
+                r.get("count", ""),
+            ), file=out)
+
+    for path in [args.output, args.save_baseline]:
+        if path == "-":
+            json.dump(data, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write("\n")
+
+        elif path:
+            with open(path, "w") as fp:
+                json.dump(data, fp, indent=2, sort_keys=True)
+                fp.write("\n")
+
+    return 1 if any(c[-1] for c in comparison) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@ import argparse
 import logging
 import sys
 import os
+import json
 
 import boto3
 from captain import echo
@@ -11,6 +12,10 @@ from captain import echo
 from herd.compat import *
 from herd.utils import EnvironParser, Environ, Extra
 from herd.serverless import Function, Region
+from herd.serverless.interface.aws import Role, Lambda, ImportProfile
+from herd.serverless.interface.local import WorkerPool, LocalGateway
+from herd.path import Cachedir
+from herd.reflection import ImportsCache
 from herd import __version__
 
 
@@ -70,6 +75,16 @@ def main_info_roles(args, extra):
 #         echo.table(
 
 
+def main_cache_clear(args, extra):
+    """remove everything herd has cached between runs"""
+    cache = ImportsCache.get_instance()
+    cache.clear()
+
+    cachedir = Cachedir()
+    cachedir.delete()
+    logger.info("Cleared herd cache at {}".format(cachedir))
+
+
 def main_function(args, extra):
     func = Function(
         filepath=args.filepaths[0],
@@ -78,12 +93,288 @@ def main_function(args, extra):
         api_name=args.api_name,
         stage=args.stage,
         region_name=args.region_name,
+        frozen=args.frozen,
+        treeshake=args.treeshake,
+        keep=args.keep,
+        extras=args.extras,
+        exclude=args.exclude,
+        bytecode=args.bytecode,
+        optimize=args.optimize,
+        drop_sources=args.drop_sources,
+        layer=args.layer,
+        bucket=args.bucket,
+        wheelhouse=args.wheelhouse,
+        architecture=args.architecture,
+        lazy=args.lazy,
+        parse_processes=args.parse_processes,
         **extra.options
     )
 
     logger.info("Function {} available at url: {}".format(func.func.name, func.url))
 
 
+def get_bundle_lambda(args):
+    """returns the Lambda the bundle arguments describe, see add_bundle_arguments()"""
+    return Lambda(
+        args.filepaths[0],
+        role=Role(args.role_name),
+        frozen=args.frozen,
+        treeshake=args.treeshake,
+        keep=args.keep,
+        extras=args.extras,
+        exclude=args.exclude,
+        bytecode=args.bytecode,
+        optimize=args.optimize,
+        drop_sources=args.drop_sources,
+        wheelhouse=args.wheelhouse,
+        architecture=args.architecture,
+        lazy=args.lazy,
+        parse_processes=args.parse_processes,
+    )
+
+
+def main_function_bundle(args, extra):
+    """bundle a lambda function without uploading it"""
+    func = get_bundle_lambda(args)
+    zippath = func.bundle(staging=args.staging, dry_run=args.dry_run)
+
+    if func.excluded:
+        rows = [("RULE", "FILES", "BYTES")]
+        for rule, (count, size) in sorted(func.excluded.items(), key=lambda t: t[1][1], reverse=True):
+            rows.append((rule, String(count), String(size)))
+        rows.append(("TOTAL", String(sum(v[0] for v in func.excluded.values())), String(sum(v[1] for v in func.excluded.values()))))
+        echo.table(rows)
+
+    if zippath:
+        logger.info("Function {} bundled to {} ({} bytes)".format(
+            func.name,
+            zippath,
+            os.path.getsize(zippath),
+        ))
+
+
+def main_bundle_report(args, extra):
+    """print how big every package in a lambda function bundle is and why it
+    was bundled"""
+    func = get_bundle_lambda(args)
+    report = func.report()
+
+    rows = [("PACKAGE", "VERSION", "FILES", "BYTES", "COMPRESSED", "SHARED", "REQUIRED BY")]
+    for row in report:
+        rows.append((
+            row["name"],
+            row["version"],
+            String(row["files"]),
+            String(row["bytes"]),
+            String(row["compressed_bytes"]),
+            "yes" if row["shared_library"] else "",
+            ", ".join(row["required_by"]),
+        ))
+    rows.append((
+        "TOTAL",
+        "",
+        String(sum(row["files"] for row in report)),
+        String(sum(row["bytes"] for row in report)),
+        String(sum(row["compressed_bytes"] for row in report)),
+        "",
+        "",
+    ))
+    echo.table(rows)
+
+    if args.json:
+        data = json.dumps(
+            {"function": func.name, "runtime": func.runtime, "packages": report},
+            indent=2,
+            sort_keys=True,
+        )
+        if args.json == "-":
+            echo.out(data)
+
+        else:
+            with open(args.json, "w") as fp:
+                fp.write(data)
+            logger.info("Wrote bundle report to {}".format(args.json))
+
+
+def main_profile_import(args, extra):
+    """import a lambda function's handler from its bundle like a cold start
+    would and print what the imports cost"""
+    func = get_bundle_lambda(args)
+    profile = ImportProfile(func).run(args.runs)
+    init = profile.summary("init")
+    rss = profile.summary("rss")
+
+    logger.info("Handler {} init: median {:.1f}ms, p95 {:.1f}ms over {} runs".format(
+        func.handler,
+        init["median"] * 1000,
+        init["p95"] * 1000,
+        args.runs,
+    ))
+    logger.info("Peak RSS: median {:.1f}MB, p95 {:.1f}MB".format(
+        rss["median"] / (1024 * 1024),
+        rss["p95"] / (1024 * 1024),
+    ))
+
+    rows = [("IMPORT", "SELF MS", "CUMULATIVE MS")]
+    for row in profile.imports(args.top):
+        rows.append((
+            "{}{}".format("  " * row["depth"], row["name"]),
+            "{:.1f}".format(row["us"] / 1000),
+            "{:.1f}".format(row["cumulative_us"] / 1000),
+        ))
+    echo.table(rows)
+
+    if args.json:
+        data = json.dumps(
+            {
+                "function": func.name,
+                "runtime": func.runtime,
+                "runs": args.runs,
+                "init": init,
+                "rss": rss,
+                "imports": profile.imports(),
+            },
+            indent=2,
+            sort_keys=True,
+        )
+        if args.json == "-":
+            echo.out(data)
+
+        else:
+            with open(args.json, "w") as fp:
+                fp.write(data)
+            logger.info("Wrote import profile to {}".format(args.json))
+
+
+def main_serve(args, extra):
+    """serve a lambda function locally behind an emulated API Gateway proxy"""
+    func = get_bundle_lambda(args)
+    pool = WorkerPool(
+        func,
+        concurrency=args.concurrency,
+        memory=args.memory,
+        timeout=args.timeout,
+    )
+    pool.start()
+    server = LocalGateway(pool, host=args.host, port=args.port, stage=args.stage)
+    logger.info("Function {} with {} warm workers available at url: {}".format(
+        func.name,
+        pool.concurrency,
+        server.url,
+    ))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+        pool.stop()
+
+        stats = pool.stats()
+        rows = [("", "COUNT", "MEDIAN MS", "P95 MS")]
+        for name, label in [("init", "INIT"), ("cold", "COLD"), ("warm", "WARM")]:
+            rows.append((
+                label,
+                String(stats[name]["count"]),
+                "{:.1f}".format(stats[name]["median"] * 1000),
+                "{:.1f}".format(stats[name]["p95"] * 1000),
+            ))
+        echo.table(rows)
+
+
+def add_bundle_arguments(subparser):
+    """add the arguments that change what a lambda function bundle contains"""
+    subparser.add_argument(
+        "--role-name", "--role",
+        help="The name of the AWS IAM role to use for the lambda and api",
+        default="herd-lambda-role",
+    )
+    subparser.add_argument(
+        "--frozen",
+        action="store_true",
+        help="Fail if the dependency lockfile next to FILEPATH is missing or out of date",
+    )
+    subparser.add_argument(
+        "--tree-shake",
+        dest="treeshake",
+        action="store_true",
+        help="Only bundle the dependency modules FILEPATH can actually import",
+    )
+    subparser.add_argument(
+        "--keep",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Module path or file path pattern to bundle even when --tree-shake prunes it",
+    )
+    subparser.add_argument(
+        "--extra",
+        dest="extras",
+        action="append",
+        default=[],
+        metavar="DIST[EXTRA,...]",
+        help="Also bundle the dependencies of a distribution's extras (eg, requests[socks])",
+    )
+    subparser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="RULE",
+        help="Glob rule for files that shouldn't be bundled, added to the defaults and .herdignore",
+    )
+    subparser.add_argument(
+        "--bytecode",
+        action="store_true",
+        help="Bundle bytecode compiled for the lambda runtime so modules aren't compiled every cold start",
+    )
+    subparser.add_argument(
+        "--optimize", "-O",
+        action="count",
+        default=0,
+        help="Optimize the --bytecode like python -O, or -OO to also remove docstrings",
+    )
+    subparser.add_argument(
+        "--drop-sources",
+        action="store_true",
+        help="Only bundle the --bytecode of the dependencies, not their .py files",
+    )
+    subparser.add_argument(
+        "--wheelhouse",
+        default="",
+        metavar="DIR",
+        help="Directory of manylinux wheels the site package dependencies are bundled from",
+    )
+    subparser.add_argument(
+        "--architecture", "--arch",
+        choices=["x86_64", "arm64"],
+        default="x86_64",
+        help="The lambda architecture, the --wheelhouse wheels have to be built for it",
+    )
+    subparser.add_argument(
+        "--lazy",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Top level package FILEPATH imports that should only be loaded when first used (eg, pandas)",
+    )
+    subparser.add_argument(
+        "--parse-processes",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Parse the modules of big dependencies using N processes",
+    )
+    subparser.add_argument(
+        "filepaths",
+        nargs=1,
+        metavar="FILEPATH",
+        help="The path to a module.py that contains a NAME(event, context) function",
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(description='Herd - Manage AWS things')
     parser.add_argument("--version", "-V", "-v", action='version', version="%(prog)s {}".format(__version__))
@@ -118,6 +409,17 @@ def main():
     )
     subparser.set_defaults(func=main_info_roles)
 
+    # $ herd cache-clear
+    desc = "Remove everything herd has cached between runs (eg, parsed imports)"
+    subparser = subparsers.add_parser(
+        "cache-clear",
+        parents=[common_parser],
+        help=desc,
+        description=desc,
+        conflict_handler="resolve",
+    )
+    subparser.set_defaults(func=main_cache_clear)
+
     # $ herd function
     desc = "Add lambda function"
     subparser = subparsers.add_parser(
@@ -128,11 +430,7 @@ def main():
         conflict_handler="resolve",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    subparser.add_argument(
-        "--role-name", "--role",
-        help="The name of the AWS IAM role to use for the lambda and api",
-        default="herd-lambda-role",
-    )
+    add_bundle_arguments(subparser)
     subparser.add_argument(
         "--api-name", "--api", "-a",
         help="The name/id of the AWS api gateway",
@@ -149,13 +447,139 @@ def main():
         default=os.environ.get("AWS_DEFAULT_REGION", ""),
     )
     subparser.add_argument(
-        "filepaths",
-        nargs=1,
-        metavar="FILEPATH",
-        help="The path to a module.py that contains a NAME(event, context) function",
+        "--layer",
+        action="store_true",
+        help="Publish the site package dependencies as a layer that is only published again when they change",
+    )
+    subparser.add_argument(
+        "--bucket",
+        help="The S3 bucket the code is uploaded to, needed for bundles bigger than 50MB",
+        default=os.environ.get("HERD_BUCKET", ""),
     )
     subparser.set_defaults(func=main_function)
 
+    # $ herd function-bundle
+    desc = "Bundle a lambda function without uploading it"
+    subparser = subparsers.add_parser(
+        "function-bundle",
+        parents=[common_parser],
+        help=desc,
+        description=desc,
+        conflict_handler="resolve",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_bundle_arguments(subparser)
+    subparser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only write the reports and print the bytes each exclusion rule saved, don't write the zip",
+    )
+    subparser.add_argument(
+        "--staging",
+        action="store_true",
+        help="Also copy the bundled files into a directory next to the zip",
+    )
+    subparser.set_defaults(func=main_function_bundle)
+
+    # $ herd bundle-report
+    desc = "Report the size of every package in a lambda function bundle and what required it"
+    subparser = subparsers.add_parser(
+        "bundle-report",
+        parents=[common_parser],
+        help=desc,
+        description=desc,
+        conflict_handler="resolve",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_bundle_arguments(subparser)
+    subparser.add_argument(
+        "--json",
+        default="",
+        metavar="PATH",
+        help="Also write the report as JSON to PATH, - writes it to stdout",
+    )
+    subparser.set_defaults(func=main_bundle_report)
+
+    # $ herd profile-import
+    desc = "Import a lambda function's handler from its bundle like a cold start and report the import times"
+    subparser = subparsers.add_parser(
+        "profile-import",
+        parents=[common_parser],
+        help=desc,
+        description=desc,
+        conflict_handler="resolve",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_bundle_arguments(subparser)
+    subparser.add_argument(
+        "--runs", "-n",
+        type=int,
+        default=5,
+        help="How many cold starts, each one is a new python process",
+    )
+    subparser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="Only show the imports with the top cumulative times",
+    )
+    subparser.add_argument(
+        "--json",
+        default="",
+        metavar="PATH",
+        help="Also write the profile as JSON to PATH, - writes it to stdout",
+    )
+    subparser.set_defaults(func=main_profile_import)
+
+    # $ herd serve
+    desc = "Serve a lambda function locally behind an emulated API Gateway proxy"
+    subparser = subparsers.add_parser(
+        "serve",
+        parents=[common_parser],
+        help=desc,
+        description=desc,
+        conflict_handler="resolve",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_bundle_arguments(subparser)
+    subparser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="The address the server listens on",
+    )
+    subparser.add_argument(
+        "--port", "-p",
+        type=int,
+        default=8080,
+        help="The port the server listens on",
+    )
+    subparser.add_argument(
+        "--stage", "-s",
+        default="DEFAULT",
+        help="The staging environment name, the function is at /STAGE/NAME and /NAME",
+    )
+    subparser.add_argument(
+        "--concurrency", "-c",
+        type=int,
+        default=1,
+        help="How many warm workers invoke the handler at the same time",
+    )
+    subparser.add_argument(
+        "--memory",
+        type=int,
+        default=128,
+        metavar="MB",
+        help="A worker that uses more memory than this is stopped like lambda would",
+    )
+    subparser.add_argument(
+        "--timeout",
+        type=int,
+        default=0,
+        metavar="SECONDS",
+        help="An invocation that takes longer is stopped, defaults to the function's timeout",
+    )
+    subparser.set_defaults(func=main_serve)
+
     args, unknown_args = parser.parse_known_args()
     extra = Extra(unknown_args)
 
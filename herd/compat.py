@@ -1,98 +1,63 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, division, print_function, absolute_import
 import sys
-import hashlib
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+# herd uses python 3.7+ standard library modules (concurrent.futures,
+# os.scandir, http.server...) directly, see python_requires in setup.py
+_ver = sys.version_info
+if _ver < (3, 7):
+    raise ImportError("herd requires python 3.7 or later, this is python {}.{}".format(
+        _ver[0],
+        _ver[1],
+    ))
 
 
-# Syntax sugar.
-_ver = sys.version_info
-is_py2 = _ver[0] == 2
-is_py3 = _ver[0] == 3
+import hashlib
+import pickle
+import queue
+import _thread
+import builtins
+from os import replace
+from io import StringIO
+from collections.abc import Callable, Iterable, Set, Mapping
 
 
-if is_py2:
-    basestring = basestring
-    unicode = unicode
-    range = xrange # range is now always an iterator
+basestring = (str, bytes)
+unicode = str
+long = int
 
-    import Queue as queue
-    import thread as _thread
-    import __builtin__ as builtins
-    from collections import Callable, Iterable, Set, Mapping
 
+# ripped from six https://bitbucket.org/gutworth/six
+def reraise(tp, value, tb=None):
     try:
-        from cStringIO import StringIO
-    except ImportError:
-        from StringIO import StringIO
-
-    # shamelously ripped from six https://bitbucket.org/gutworth/six
-    exec("""def reraise(tp, value, tb=None):
-        try:
-            raise tp, value, tb
-        finally:
-            tb = None
-    """)
-
-
-elif is_py3:
-    basestring = (str, bytes)
-    unicode = str
-    long = int
-
-    import queue
-    import _thread
-    from io import StringIO
-    import builtins
-    from collections.abc import Callable, Iterable, Set, Mapping
-
-    # ripped from six https://bitbucket.org/gutworth/six
-    def reraise(tp, value, tb=None):
-        try:
-            if value is None:
-                value = tp()
-            if value.__traceback__ is not tb:
-                raise value.with_traceback(tb)
-            raise value
-        finally:
-            value = None
-            tb = None
-
-
-Str = unicode if is_py2 else str
-Bytes = str if is_py2 else bytes
+        if value is None:
+            value = tp()
+        if value.__traceback__ is not tb:
+            raise value.with_traceback(tb)
+        raise value
+    finally:
+        value = None
+        tb = None
+
+
+Str = str
+Bytes = bytes
 
 
 class ByteString(Bytes):
     """Wrapper around a byte string b"" to make sure we have a byte string that
-    will work across python versions and handle the most annoying encoding issues
-    automatically
+    will handle the most annoying encoding issues automatically
 
     :Example:
-        # python 3
         s = ByteString("foo)
         str(s) # calls __str__ and returns self.unicode()
-        unicode(s) # errors out
         bytes(s) # calls __bytes__ and returns ByteString
-        # python 2
-        s = ByteString("foo)
-        str(s) # calls __str__ and returns ByteString
-        unicode(s) # calls __unicode__ and returns String
-        bytes(s) # calls __str__ and returns ByteString
     """
     def __new__(cls, val=b"", encoding="UTF-8"):
         if isinstance(val, type(None)): return None
 
         if not isinstance(val, (bytes, bytearray)):
-            if is_py2:
-                val = unicode(val)
-            else:
-                val = str(val)
-            #val = val.__str__()
+            val = str(val)
             val = bytearray(val, encoding)
 
         instance = super(ByteString, cls).__new__(cls, val)
@@ -100,12 +65,11 @@ class ByteString(Bytes):
         return instance
 
     def __str__(self):
-        return self if is_py2 else self.unicode()
+        return self.unicode()
 
     def unicode(self):
         s = self.decode(self.encoding)
         return String(s)
-    __unicode__ = unicode
 
     def bytes(self):
         return self
@@ -122,20 +86,12 @@ class ByteString(Bytes):
 
 class String(Str):
     """Wrapper around a unicode string "" to make sure we have a unicode string that
-    will work across python versions and handle the most annoying encoding issues
-    automatically
+    will handle the most annoying encoding issues automatically
 
     :Example:
-        # python 3
         s = String("foo)
         str(s) # calls __str__ and returns String
-        unicode(s) # errors out
         bytes(s) # calls __bytes__ and returns ByteString
-        # python 2
-        s = String("foo)
-        str(s) # calls __str__ and returns ByteString
-        unicode(s) # calls __unicode__ and returns String
-        bytes(s) # calls __str__ and returns ByteString
     """
     def __new__(cls, val="", encoding="UTF-8"):
         if isinstance(val, type(None)): return None
@@ -148,11 +104,10 @@ class String(Str):
         return instance
 
     def __str__(self):
-        return self.bytes() if is_py2 else self
+        return self
 
     def unicode(self):
         return self
-    __unicode__ = unicode
 
     def bytes(self):
         s = self.encode(self.encoding)
@@ -160,7 +115,7 @@ class String(Str):
     __bytes__ = bytes
 
     def raw(self):
-        """because sometimes you need a vanilla str() (or unicode() in py2)"""
+        """because sometimes you need a vanilla str()"""
         return "" + self
 
     def md5(self):
@@ -5,12 +5,32 @@ import codecs
 import tempfile
 from distutils import dir_util
 import shutil
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+import stat
 import glob
+import fnmatch
+import posixpath
+import py_compile
+import zlib
+import struct
+import functools
+import multiprocessing
+import hashlib
+import threading
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from .compat import *
 
 
+logger = logging.getLogger(__name__)
+
 class Path(String):
     @property
     def dirname(self):
@@ -63,11 +83,23 @@ class Dirpath(Path):
         dir_util.copy_tree(source_path, dest_path, update=1)
 
     def zip_to(self, dest_path):
-        if dest_path.endswith(".zip"):
-            dest_path = os.path.splitext(dest_path)[0]
-        # https://docs.python.org/3/library/shutil.html#shutil.make_archive
-        # https://stackoverflow.com/a/25650295/5006
-        return shutil.make_archive(dest_path, 'zip', self)
+        """zip all the files in this directory to dest_path, see Zippath
+
+        :param dest_path: string, the zip file path, .zip is added if missing
+        :returns: Zippath, the zip file path
+        """
+        if not dest_path.endswith(".zip"):
+            dest_path = "{}.zip".format(dest_path)
+
+        paths = []
+        for root_dir, dirs, files in self:
+            for basename in files:
+                path = Filepath(root_dir, basename)
+                paths.append((path, os.path.relpath(path, self).replace(os.sep, "/")))
+
+        zippath = Zippath(dest_path)
+        zippath.write(paths)
+        return zippath
 
     def delete(self):
         """Remove this whole directory and all subdirectories and files in it"""
@@ -93,6 +125,34 @@ class Tempdir(Dirpath):
         return super(Path, cls).__new__(cls, path)
 
 
+class Cachedir(Dirpath):
+    """The directory herd uses to persist things between runs
+
+    this defaults to $XDG_CACHE_HOME/herd (usually ~/.cache/herd) but can be
+    set with the HERD_CACHE_DIR environment variable
+    """
+    @classmethod
+    def get_basedir(cls):
+        basedir = os.environ.get("HERD_CACHE_DIR", "")
+        if not basedir:
+            basedir = os.environ.get("XDG_CACHE_HOME", "")
+            if not basedir:
+                basedir = os.path.join(os.path.expanduser("~"), ".cache")
+            basedir = os.path.join(basedir, "herd")
+        return basedir
+
+    def __new__(cls, *args, **kwargs):
+        instance = super(Cachedir, cls).__new__(cls, cls.get_basedir(), *args)
+        if not instance.exists():
+            try:
+                os.makedirs(instance)
+            except OSError:
+                # another process could have created it in the meantime
+                if not instance.exists():
+                    raise
+        return instance
+
+
 class Filepath(Path):
     @property
     def fileroot(self):
@@ -132,8 +192,40 @@ class Filepath(Path):
         return os.path.isfile(self)
 
     def copy_to(self, dest_path):
+        dest_dir = os.path.dirname(dest_path)
+        if dest_dir and not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
         r = shutil.copy(self, dest_path)
 
+    def compile_to(self, dest_path, dfile="", optimize=0):
+        """compile this python file to reproducible bytecode at dest_path
+
+        the bytecode is an unchecked hash pyc, so it is always used without
+        checking the source file, and it doesn't contain a timestamp
+
+        :param dest_path: string, the .pyc file path
+        :param dfile: string, the source path the bytecode will report in tracebacks
+        :param optimize: int, 1 is like python -O, 2 is like python -OO
+        :returns: Filepath, dest_path
+        """
+        if not hasattr(py_compile, "PycInvalidationMode"):
+            raise ValueError("Compiling unchecked hash bytecode needs python 3.7+")
+
+        dest_dir = os.path.dirname(dest_path)
+        if dest_dir and not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+
+        py_compile.compile(
+            self,
+            cfile=dest_path,
+            # marshal can't handle str subclasses like this class
+            dfile=str.__str__(dfile or os.path.abspath(self)),
+            doraise=True,
+            optimize=optimize,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+        return Filepath(dest_path)
+
     def zip_to(self, dest_path):
         with ZipFile(dest_path, 'w') as z:
             z.write(self)
@@ -143,3 +235,515 @@ class Filepath(Path):
         """remove the file"""
         os.unlink(self)
 
+
+
+class Exclusions(list):
+    """Glob rules for the files that shouldn't be bundled
+
+    the rules are like .gitignore, a rule that ends with a slash only matches
+    directories, a rule that has a slash in it is matched against the whole
+    relative path, otherwise it is matched against every part of the path, a
+    rule that starts with an exclamation point includes what it matches again
+    and the last matching rule wins
+
+    the .default_package_rules only match directories that aren't python
+    packages, so importable subpackages like django/test are still bundled
+    """
+    default_rules = [
+        "__pycache__/",
+        "*.pyc",
+        "*.pyo",
+        "*.pyi",
+        "*.pyx",
+        "*.pxd",
+        "*.c",
+        "*.cc",
+        "*.cpp",
+        "*.h",
+        "*.hpp",
+        "*.dist-info/INSTALLER",
+        "*.dist-info/REQUESTED",
+        "*.dist-info/direct_url.json",
+        "*.egg-info/SOURCES.txt",
+    ]
+    """list, the rules that are used unless defaults=False, license files and
+    RECORD are bundled since licenses can require the notice to be
+    redistributed and importlib.metadata.files() reads RECORD, add them to
+    .herdignore to exclude them"""
+
+    default_package_rules = [
+        "tests/",
+        "test/",
+        "docs/",
+        "doc/",
+        "examples/",
+    ]
+    """list, rules that are used unless defaults=False but that never match a
+    directory that has an __init__.py, see .match()"""
+
+    @classmethod
+    def get_packages(cls, relpaths):
+        """returns the directories of relpaths that are python packages
+
+        :param relpaths: iterable, relative file paths (eg, foo/test/__init__.py)
+        :returns: set, the relative directory paths (eg, foo/test)
+        """
+        ret = set()
+        for relpath in relpaths:
+            dirname, basename = posixpath.split(relpath.replace(os.sep, "/"))
+            if dirname and basename in ("__init__.py", "__init__.pyc"):
+                ret.add(dirname)
+        return ret
+
+    def __init__(self, rules=None, defaults=True):
+        """
+        :param rules: list, more rules that are checked after the default rules
+        :param defaults: boolean, False to not use .default_rules and
+            .default_package_rules
+        """
+        super(Exclusions, self).__init__()
+        self.package_rules = set()
+        if defaults:
+            self.extend(self.default_rules)
+            # these are remembered by index so the same rule in rules (eg, from
+            # .herdignore) still matches packages
+            self.package_rules.update(range(len(self), len(self) + len(self.default_package_rules)))
+            self.extend(self.default_package_rules)
+        self.extend(rules or [])
+
+    def add_file(self, path):
+        """add the rules in an ignore file (eg, .herdignore), blank lines and
+        lines that start with # are skipped
+
+        :param path: string, the ignore file, nothing happens if it doesn't exist
+        """
+        path = Filepath(path)
+        if path.exists():
+            for line in path:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    self.append(line)
+
+    def match(self, relpath, packages=None):
+        """check if relpath should be excluded
+
+        :param relpath: string, the path relative to the bundle
+        :param packages: set, the relative paths of the directories that are
+            python packages, the .default_package_rules don't match these, see
+            .get_packages()
+        :returns: string, the rule that excluded relpath, empty if it isn't excluded
+        """
+        ret = ""
+        bits = relpath.replace(os.sep, "/").split("/")
+        packages = packages or set()
+        for index, rule in enumerate(self):
+            negate = rule.startswith("!")
+            pattern = rule[1:] if negate else rule
+            dir_only = pattern.endswith("/")
+            pattern = pattern.strip("/")
+            skip = packages if index in self.package_rules else set()
+
+            if "/" in pattern:
+                # the rule matches the path or one of its directories
+                count = len(bits) - 1 if dir_only else len(bits)
+                matched = any(
+                    fnmatch.fnmatchcase("/".join(bits[:i]), pattern) and "/".join(bits[:i]) not in skip
+                    for i in range(1, count + 1)
+                )
+
+            else:
+                names = bits[:-1] if dir_only else bits
+                matched = any(
+                    fnmatch.fnmatchcase(name, pattern) and "/".join(bits[:i + 1]) not in skip
+                    for i, name in enumerate(names)
+                )
+
+            if matched:
+                ret = "" if negate else rule
+
+        return ret
+
+
+class FragmentCache(object):
+    """Size bounded on-disk cache of compressed zip entries, see Zippath.write()
+
+    each fragment is the compressed entries of a group of files (eg, a
+    package), the least recently used fragments are removed when the cache is
+    bigger than .max_size, fragments are written atomically and eviction is
+    locked so concurrent builds can share the cache
+    """
+    max_size = 1024 * 1024 * 1024
+    """int, the most bytes the fragments can use"""
+
+    def __init__(self, path=None, max_size=None):
+        """
+        :param path: string, the cache directory, defaults to fragments in the
+            herd cache directory
+        :param max_size: int, defaults to .max_size
+        """
+        self.path = Dirpath(path) if path else Cachedir("fragments")
+        if not self.path.exists():
+            os.makedirs(self.path)
+        if max_size is not None:
+            self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_path(self, key):
+        return Filepath(self.path, "{}.fragment".format(key))
+
+    def get(self, key):
+        """returns the fragment of key or None if it isn't cached
+
+        :param key: string, see Zippath.get_fragment_key()
+        :returns: dict, arcname keys and compressed entry values
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as fp:
+                ret = pickle.load(fp)
+
+        except (IOError, OSError):
+            ret = None
+
+        except Exception as e:
+            logger.warning("Ignoring unreadable zip fragment {}: {}".format(path, e))
+            ret = None
+
+        if ret is None:
+            self.misses += 1
+
+        else:
+            self.hits += 1
+            try:
+                # the mtime is when it was last used
+                os.utime(path, None)
+            except OSError:
+                pass
+
+        return ret
+
+    def set(self, key, fragment):
+        """cache fragment and then evict fragments if the cache is too big
+
+        :param key: string, see Zippath.get_fragment_key()
+        :param fragment: dict, arcname keys and compressed entry values
+        """
+        fd, tmppath = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump(fragment, fp, pickle.HIGHEST_PROTOCOL)
+        replace(tmppath, self.get_path(key))
+        self.evict()
+
+    @contextmanager
+    def file_lock(self):
+        """lock the cache directory across processes"""
+        if fcntl:
+            with open(os.path.join(self.path, ".lock"), "a") as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+
+        else:
+            yield
+
+    def evict(self):
+        """remove the least recently used fragments until the cache is no
+        bigger than .max_size
+
+        :returns: int, how many fragments were removed
+        """
+        ret = 0
+        with self.lock:
+            with self.file_lock():
+                fragments = []
+                for basename in os.listdir(self.path):
+                    if basename.endswith(".fragment"):
+                        path = os.path.join(self.path, basename)
+                        try:
+                            st = os.stat(path)
+                        except OSError:
+                            continue
+                        fragments.append((st.st_mtime, st.st_size, path))
+
+                total = sum(f[1] for f in fragments)
+                for mtime, size, path in sorted(fragments):
+                    if total <= self.max_size:
+                        break
+
+                    try:
+                        os.unlink(path)
+                        ret += 1
+                    except OSError:
+                        pass
+                    total -= size
+
+        if ret:
+            logger.debug("Evicted {} zip fragments from {}".format(ret, self.path))
+        return ret
+
+
+class Zippath(Filepath):
+    """A zip file that is written reproducibly
+
+    the entries are sorted and have the same timestamp and normalized
+    permissions so the same files will always produce the same bytes, the files
+    are read straight into the zip so nothing has to be copied first
+
+    the entries are compressed concurrently and then written in order, zipfile
+    can't add entries that are already compressed so the zip records are
+    written here
+
+    https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+    """
+    date_time = (1980, 1, 1, 0, 0, 0)
+    """tuple, every entry gets this timestamp (the earliest zip supports)"""
+
+    workers = multiprocessing.cpu_count()
+    """int, how many threads compress entries (zlib releases the GIL)"""
+
+    level = 6
+    """int, the zlib compression level, 0 stores everything"""
+
+    stored_exts = set([
+        "so", "zip", "whl", "egg", "jar",
+        "gz", "tgz", "bz2", "xz", "zst",
+        "png", "jpg", "jpeg", "gif", "webp", "ico",
+    ])
+    """set, files with these extensions are already compressed so they are stored"""
+
+    def write(self, paths, workers=None, level=None, cache=None):
+        """write the zip file, replacing it if it already exists
+
+        :param paths: iterable, (path, arcname) or (path, arcname, group) tuples
+            where path is the file that will be written to the zip as arcname,
+            the compressed entries of a group (eg, a package and its version)
+            are cached together
+        :param workers: int, defaults to .workers
+        :param level: int, defaults to .level
+        :param cache: FragmentCache, if passed then the compressed entries of
+            every group are taken from it, or put in it if they aren't there yet
+        :returns: int, how many entries were written
+        """
+        workers = self.workers if workers is None else workers
+        level = self.level if level is None else level
+
+        entries = {}
+        for t in paths:
+            path, arcname, group = t if len(t) > 2 else (t[0], t[1], "")
+            arcname = arcname.replace(os.sep, "/")
+            if arcname in entries:
+                raise ValueError("Zip entry {} is both {} and {}".format(
+                    arcname,
+                    entries[arcname][0],
+                    path
+                ))
+            entries[arcname] = (path, group)
+
+        if len(entries) > 0xFFFF:
+            raise ValueError("Zip would have {} entries, more than zip supports without zip64".format(len(entries)))
+
+        # group -> how many of its entries haven't been written yet
+        remaining = {}
+        if cache:
+            for arcname, (path, group) in entries.items():
+                if group:
+                    remaining[group] = remaining.get(group, 0) + 1
+
+        keys = {}
+        if remaining:
+            arcnames = {}
+            for arcname, (path, group) in entries.items():
+                if group:
+                    arcnames.setdefault(group, []).append(arcname)
+
+            for group, group_arcnames in arcnames.items():
+                keys[group] = self.get_fragment_key(
+                    group,
+                    [(arcname, entries[arcname][0]) for arcname in group_arcnames],
+                    level
+                )
+
+        # a group's fragment is only kept in memory until all its entries are
+        # written, the entries of a group are usually next to each other
+        fragments = {}
+        hits = set()
+
+        def get_cached(arcname):
+            group = entries[arcname][1]
+            if group in keys:
+                if group not in fragments:
+                    fragment = cache.get(keys[group])
+                    if fragment is None:
+                        fragments[group] = {}
+                    else:
+                        fragments[group] = fragment
+                        hits.add(group)
+
+                if group in hits:
+                    return fragments[group].get(arcname, None)
+
+            return None
+
+        arcnames = sorted(entries)
+        compress = functools.partial(self.compress, level=level)
+        central = []
+        offset = 0
+        with open(self, "wb") as fp:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                # compressed entries are held in memory until they are written
+                # so only a few batches are compressed at a time
+                batchsize = max(1, workers) * 8
+                for i in range(0, len(arcnames), batchsize):
+                    batch = arcnames[i:i + batchsize]
+                    results = dict((arcname, get_cached(arcname)) for arcname in batch)
+                    misses = [arcname for arcname in batch if results[arcname] is None]
+                    results.update(zip(
+                        misses,
+                        executor.map(compress, [entries[arcname][0] for arcname in misses])
+                    ))
+
+                    for arcname in batch:
+                        method, crc, size, data, mode = results[arcname]
+                        if offset + len(data) > 0xFFFFFFFF:
+                            raise ValueError("Zip would be bigger than zip supports without zip64")
+
+                        central.append(self.write_local(fp, arcname, method, crc, size, data, mode, offset))
+                        offset = fp.tell()
+
+                        group = entries[arcname][1]
+                        if group in keys:
+                            if group not in hits:
+                                fragments[group][arcname] = results[arcname]
+
+                            remaining[group] -= 1
+                            if remaining[group] == 0:
+                                if group not in hits:
+                                    cache.set(keys[group], fragments[group])
+                                fragments.pop(group)
+
+            self.write_central(fp, central, offset)
+
+        return len(entries)
+
+    def get_fragment_key(self, group, paths, level):
+        """returns the key of the compressed entries of group, this changes
+        when any of the files change or they would be compressed differently
+
+        :param group: string, the group name (eg, a package name and version)
+        :param paths: list, (arcname, path) tuples
+        :param level: int, the compression level
+        :returns: string, the hex digest
+        """
+        h = hashlib.sha256()
+        h.update("{}\t{}\t{}".format(group, level, ",".join(sorted(self.stored_exts))).encode("utf-8"))
+        for arcname, path in sorted(paths):
+            st = os.stat(path)
+            h.update("\n{}\t{}\t{}\t{}".format(
+                arcname,
+                st.st_size,
+                st.st_mtime,
+                st.st_mode & stat.S_IXUSR,
+            ).encode("utf-8"))
+        return h.hexdigest()
+
+    def compress(self, path, level):
+        """read and compress path
+
+        :returns: tuple, (method, crc32, uncompressed size, data, mode)
+        """
+        with open(path, "rb") as fp:
+            data = fp.read()
+
+        mode = 0o755 if os.stat(path).st_mode & stat.S_IXUSR else 0o644
+        crc = zlib.crc32(data) & 0xFFFFFFFF
+        size = len(data)
+        if size > 0xFFFFFFFF:
+            raise ValueError("{} is bigger than zip supports without zip64".format(path))
+
+        method = ZIP_STORED
+        if level > 0 and Filepath(path).ext not in self.stored_exts:
+            c = zlib.compressobj(level, zlib.DEFLATED, -15)
+            compressed = c.compress(data) + c.flush()
+            # some files don't get smaller, there is no reason to inflate those
+            if len(compressed) < size:
+                method = ZIP_DEFLATED
+                data = compressed
+
+        return method, crc, size, data, mode
+
+    def get_dos_date_time(self):
+        y, m, d, hh, mm, ss = self.date_time
+        return ((y - 1980) << 9) | (m << 5) | d, (hh << 11) | (mm << 5) | (ss // 2)
+
+    def write_local(self, fp, arcname, method, crc, size, data, mode, offset):
+        """write the local header and data of an entry
+
+        :returns: tuple, what .write_central() needs to know about the entry
+        """
+        name = arcname.encode("utf-8")
+        flags = 0 if len(name) == len(arcname) else 0x800 # non-ascii names are utf-8
+        version = 20 if method == ZIP_DEFLATED else 10
+        date, time = self.get_dos_date_time()
+        fp.write(struct.pack(
+            "<4s2B4HL2L2H",
+            b"PK\x03\x04",
+            version,
+            0,
+            flags,
+            method,
+            time,
+            date,
+            crc,
+            len(data),
+            size,
+            len(name),
+            0,
+        ))
+        fp.write(name)
+        fp.write(data)
+        return (name, flags, version, method, crc, len(data), size, mode, offset)
+
+    def write_central(self, fp, central, offset):
+        """write the central directory and the end of central directory record"""
+        date, time = self.get_dos_date_time()
+        for name, flags, version, method, crc, csize, size, mode, header_offset in central:
+            fp.write(struct.pack(
+                "<4s4B4HL2L5H2L",
+                b"PK\x01\x02",
+                20,
+                3, # unix, so the external attributes are used for permissions
+                version,
+                0,
+                flags,
+                method,
+                time,
+                date,
+                crc,
+                csize,
+                size,
+                len(name),
+                0,
+                0,
+                0,
+                0,
+                (stat.S_IFREG | mode) << 16,
+                header_offset,
+            ))
+            fp.write(name)
+
+        size = fp.tell() - offset
+        fp.write(struct.pack(
+            "<4s4H2LH",
+            b"PK\x05\x06",
+            0,
+            0,
+            len(central),
+            len(central),
+            size,
+            offset,
+            0,
+        ))
@@ -10,27 +10,251 @@ import json
 import re
 import pkgutil
 import logging
-import itertools
+import hashlib
+import tempfile
+import csv
+import threading
+import multiprocessing
+import tokenize
+import functools
+import fnmatch
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from .compat import *
-from .path import Filepath, Dirpath, Path
+from .path import Filepath, Dirpath, Path, Cachedir
 from .utils import get_runtime
 
 
 logger = logging.getLogger(__name__)
 
 
+class ImportsCache(object):
+    """Persistent on-disk cache of Imports scan results
+
+    Files are looked up by their path, mtime and size, if those don't match then
+    the file's contents are hashed and looked up by that hash, so a file that
+    was touched but not changed (or the same file installed in another
+    virtualenv) still doesn't have to be parsed again
+    """
+    instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """returns the process wide cache that Imports uses by default"""
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    @property
+    def data(self):
+        if self._data is None:
+            with self.lock:
+                if self._data is None:
+                    self._data = self.load()
+        return self._data
+
+    def __init__(self, path=None):
+        """
+        :param path: string, the file the cache will be persisted to, defaults
+            to imports.pickle in the herd cache directory
+        """
+        self.path = Filepath(path) if path else Filepath(Cachedir(), "imports.pickle")
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self._data = None
+        self.lock = threading.Lock()
+        self.digests = {}
+        """the (mtime, size, digest) of files .get() hashed and missed, so
+        .set() doesn't have to hash them again"""
+
+    def load(self):
+        """read the persisted cache, this will return an empty cache if the
+        persisted cache doesn't exist or can't be read"""
+        ret = {"paths": {}, "hashes": {}}
+        if self.path.exists():
+            try:
+                with open(self.path, "rb") as fp:
+                    ret = pickle.load(fp)
+
+            except Exception as e:
+                logger.warning("Ignoring unreadable imports cache {}: {}".format(self.path, e))
+
+        return ret
+
+    def hash(self, filepath):
+        with open(filepath, "rb") as fp:
+            return hashlib.md5(fp.read()).hexdigest()
+
+    def get(self, filepath):
+        """return the cached imports for filepath
+
+        :param filepath: string, the path to a python file
+        :returns: set, the cached imports or None if filepath isn't cached
+        """
+        ret = None
+        paths = self.data["paths"]
+        hashes = self.data["hashes"]
+
+        key = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        entry = paths.get(key)
+        if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            ret = hashes.get(entry[2])
+
+        else:
+            digest = self.hash(filepath)
+            if digest in hashes:
+                ret = hashes[digest]
+                paths[key] = (st.st_mtime, st.st_size, digest)
+                self.dirty = True
+
+            else:
+                self.digests[key] = (st.st_mtime, st.st_size, digest)
+
+        if ret is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return ret
+
+    def set(self, filepath, imports):
+        """cache imports for filepath
+
+        :param filepath: string, the path to a python file
+        :param imports: set, the imports found in filepath
+        """
+        key = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        entry = self.digests.pop(key, None)
+        if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            digest = entry[2]
+        else:
+            digest = self.hash(filepath)
+        self.data["paths"][key] = (st.st_mtime, st.st_size, digest)
+        self.data["hashes"][digest] = frozenset(imports)
+        self.dirty = True
+
+    def save(self):
+        """persist the cache if anything has changed since it was loaded"""
+        if not self.dirty: return
+
+        # merge with whatever another process might have saved in the meantime
+        data = self.load()
+        data["paths"].update(self.data["paths"])
+        data["hashes"].update(self.data["hashes"])
+
+        fd, tmppath = tempfile.mkstemp(dir=self.path.dirname)
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+        replace(tmppath, self.path)
+
+        self._data = data
+        self.dirty = False
+
+    def clear(self):
+        """remove the persisted cache and reset the counters"""
+        if self.path.exists():
+            self.path.delete()
+        self._data = None
+        self.digests = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+
+def find_imports(filepath, scanner="ast"):
+    """returns the imports of filepath without using the cache, this is module
+    level so it can be sent to a process pool, see Imports.find_all()"""
+    return frozenset(Imports(filepath, cache=False, scanner=scanner))
+
+
 class Imports(set):
     """A set of all the toplevel imports of the passed in filepath"""
-    def __init__(self, filepath, encoding="UTF-8"):
+    import_regex = re.compile(r"\bimport\b")
+    """used to skip files that can't have any imports without scanning them"""
+
+    @classmethod
+    def find_all(cls, filepaths, processes=0, chunksize=100, cache=None, scanner="ast"):
+        """find all the imports of all the filepaths
+
+        :param filepaths: list, the python files to scan for imports
+        :param processes: int, if greater than zero then the files that aren't
+            cached are parsed in a pool of this many processes
+        :param chunksize: int, how many files are sent to a process at a time
+        :param cache: ImportsCache, see .__init__()
+        :param scanner: string, see .__init__()
+        :returns: set, the imports of all the filepaths
+        """
+        ret = set()
+        if cache is None:
+            cache = ImportsCache.get_instance()
+
+        if processes > 0:
+            misses = []
+            for filepath in filepaths:
+                imports = cache.get(filepath) if cache else None
+                if imports is None:
+                    misses.append(filepath)
+                else:
+                    ret.update(imports)
+
+            if misses:
+                logger.debug("Parsing {} files using {} processes".format(len(misses), processes))
+                # spawn because this could be called from a Dependencies worker
+                # thread and forking a threaded process isn't safe
+                mp_context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context) as executor:
+                    results = executor.map(
+                        functools.partial(find_imports, scanner=scanner),
+                        misses,
+                        chunksize=chunksize
+                    )
+                    for filepath, imports in zip(misses, results):
+                        ret.update(imports)
+                        if cache:
+                            cache.set(filepath, imports)
+
+        else:
+            for filepath in filepaths:
+                ret.update(cls(filepath, cache=cache, scanner=scanner))
+
+        return ret
+
+    def __init__(self, filepath, encoding="UTF-8", cache=None, scanner="ast"):
+        """
+        :param filepath: string, the python file to scan for imports
+        :param encoding: string, the encoding of filepath
+        :param cache: ImportsCache, defaults to ImportsCache.get_instance(), pass
+            in False to always parse filepath
+        :param scanner: string, either "ast" to parse the whole file or "tokenize"
+            to only look at the tokens of the import statements, both find the
+            same imports in any file python can parse but "tokenize" is faster
+        """
         super(Imports, self).__init__()
 
+        if cache is None:
+            cache = ImportsCache.get_instance()
+
+        if cache:
+            imports = cache.get(filepath)
+            if imports is not None:
+                self.update(imports)
+                return
+
         open_kwargs = dict(mode='r', errors='replace', encoding=encoding)
         with codecs.open(filepath, **open_kwargs) as fp:
             body = fp.read().strip()
 
         try:
-            self._find(body)
+            if scanner == "tokenize":
+                self._scan(body)
+            else:
+                self._find(body)
+
         except SyntaxError as e:
             logger.debug("Failed to parse {}".format(filepath))
 
@@ -38,6 +262,88 @@ class Imports(set):
             # TypeError: compile() expected string without null bytes
             logger.debug("Failed to parse binary file {}".format(filepath))
 
+        if cache:
+            cache.set(filepath, self)
+
+    def _scan(self, body):
+        """tokenize version of ._find(), this only looks at the tokens of
+        import statements and stops after the last import statement"""
+        m = None
+        for m in self.import_regex.finditer(body):
+            pass
+
+        if not m:
+            return
+
+        # no import statements can start after the last import keyword
+        last_row = body.count("\n", 0, m.start()) + 1
+
+        try:
+            self._scan_tokens(body, last_row)
+
+        except (tokenize.TokenError, SyntaxError):
+            # the tokenizer is more forgiving than the parser, so let the parser
+            # decide what to do with a broken file
+            self.clear()
+            self._find(body)
+
+    def _scan_tokens(self, body, last_row):
+        state = None
+        boundary = True
+        tokens = tokenize.generate_tokens(StringIO(body).readline)
+        for ttype, tstr, start, _, _ in tokens:
+            if ttype in (tokenize.NL, tokenize.COMMENT):
+                continue
+
+            end = ttype in (tokenize.NEWLINE, tokenize.ENDMARKER) \
+                or (ttype == tokenize.OP and tstr == ";")
+
+            if end:
+                state = None
+
+            elif state == "import":
+                # import foo.bar as baz, che
+                if ttype == tokenize.NAME and expect_name:
+                    self.add(tstr)
+                    expect_name = False
+
+                elif ttype == tokenize.OP and tstr == ",":
+                    expect_name = True
+
+            elif state == "from":
+                # from ..foo.bar import baz
+                if ttype == tokenize.OP and tstr in (".", "...") and not modulename:
+                    level += len(tstr)
+
+                elif ttype == tokenize.NAME:
+                    if tstr == "import":
+                        # if modulename is missing it's a "from . import ..." statement
+                        # if level > 0 it's a "from .submodule import ..." statement
+                        if modulename and level == 0:
+                            self.add(modulename)
+                        state = "skip"
+
+                    elif not modulename:
+                        modulename = tstr
+
+            elif state is None and ttype == tokenize.NAME:
+                if start[0] > last_row:
+                    break
+
+                if tstr == "import":
+                    state = "import"
+                    expect_name = True
+
+                elif tstr == "from" and boundary:
+                    # a from that doesn't start a statement is a "yield from"
+                    # or "raise ... from"
+                    state = "from"
+                    level = 0
+                    modulename = ""
+
+            boundary = end or ttype in (tokenize.INDENT, tokenize.DEDENT) \
+                or (ttype == tokenize.OP and tstr == ":")
+
     def _find(self, body):
         lines = [l for l in body.splitlines(False)]
 
@@ -65,8 +371,68 @@ class Imports(set):
         node_iter.visit(ast.parse(ByteString(body)))
 
 
+class ModuleImports(set):
+    """A set of the full module paths (eg, foo.bar.che) the passed in filepath
+    could import
+
+    Unlike Imports this keeps submodules and resolves relative imports, and for
+    "from foo import bar" both foo and foo.bar are added since bar could be a
+    submodule, so this is a superset of what is actually imported
+    """
+    def __init__(self, filepath, modulepath="", is_package=False, encoding="UTF-8"):
+        """
+        :param filepath: string, the python file to scan for imports
+        :param modulepath: string, the module path of filepath (eg, foo.bar),
+            this is needed to resolve relative imports
+        :param is_package: boolean, True if filepath is a package's __init__.py
+        :param encoding: string, the encoding of filepath
+        """
+        super(ModuleImports, self).__init__()
+
+        bits = modulepath.split(".") if modulepath else []
+        self.package_bits = bits if is_package else bits[:-1]
+
+        open_kwargs = dict(mode='r', errors='replace', encoding=encoding)
+        with codecs.open(filepath, **open_kwargs) as fp:
+            body = fp.read().strip()
+
+        try:
+            self._find(body)
+        except (SyntaxError, TypeError, ValueError) as e:
+            logger.debug("Failed to parse {}".format(filepath))
+
+    def _find(self, body):
+        def visit_Import(node):
+            for name in node.names:
+                self.add(name.name)
+
+        def visit_ImportFrom(node):
+            if node.level:
+                if node.level - 1 >= len(self.package_bits):
+                    return
+
+                bits = self.package_bits[:len(self.package_bits) - (node.level - 1)]
+                if node.module:
+                    bits = bits + node.module.split(".")
+
+            else:
+                bits = node.module.split(".")
+
+            if bits:
+                modulepath = ".".join(bits)
+                self.add(modulepath)
+                for name in node.names:
+                    if name.name != "*":
+                        self.add("{}.{}".format(modulepath, name.name))
+
+        node_iter = ast.NodeVisitor()
+        node_iter.visit_Import = visit_Import
+        node_iter.visit_ImportFrom = visit_ImportFrom
+        node_iter.visit(ast.parse(ByteString(body)))
+
+
 class Dependencies(set):
-    def __init__(self, path, ignore=None):
+    def __init__(self, path, ignore=None, workers=0, scanner="ast", lockfile="", frozen=False, environment=None, extras=None, processes=0):
         """Find external dependencies for path
 
         external dependencies are dependencies that aren't part of the standard
@@ -76,11 +442,40 @@ class Dependencies(set):
         :param ignore: string|list, regex(es) to match against found imports. If
             a match is found the import is ignored and not included in the final
             set, it is also not checked for child dependencies
+        :param workers: int, if greater than zero then the dependency graph is
+            resolved breadth first and each package's requires are found using
+            a pool of this many threads, otherwise the graph is resolved depth
+            first in this thread
+        :param scanner: string, how modules are scanned for imports, see
+            Imports.__init__()
+        :param lockfile: string, the path to a Lockfile, if it is still valid the
+            dependencies are loaded from it without parsing anything, otherwise
+            they are resolved and the lockfile is written
+        :param frozen: boolean, if True then a ValueError is raised if lockfile
+            doesn't exist or is out of date instead of resolving again
+        :param environment: dict, the PEP 508 marker variables of the target,
+            requirements whose markers are false for it aren't followed, see
+            Marker.get_environment(), defaults to this python
+        :param extras: list, the extras that should be installed (eg,
+            requests[socks]), extras asked for by the requirements themselves
+            are also followed
+        :param processes: int, if greater than zero then the modules of big
+            packages are parsed using a pool of this many processes, see
+            Package.parse_threshold
         """
         #self.filepath = Filepath(filepath)
-        self.resolve(path, ignore)
-
-    def resolve(self, path, ignore):
+        self.resolve(path, ignore, workers, scanner, lockfile, frozen, environment, extras, processes)
+
+    def resolve(self, path, ignore, workers=0, scanner="ast", lockfile="", frozen=False, environment=None, extras=None, processes=0):
+        self.path = path
+        self.scanner = scanner
+        self.processes = processes
+        self.environment = Marker.get_environment() if environment is None else environment
+        self.extras = {}
+        for r in extras or []:
+            r = Requirement(r)
+            self.extras.setdefault(Dirindex.normalize_info_name(r.distribution), set()).update(r.extras)
+        self.dropped = []
         if ignore:
             if isinstance(ignore, basestring):
                 ignore = [ignore]
@@ -88,11 +483,29 @@ class Dependencies(set):
             ignore = []
 
         packages = Packages()
+
+        if lockfile:
+            lockfile = Lockfile(lockfile)
+            drift = lockfile.drift(path, ignore, self.environment, extras)
+            if not drift:
+                logger.debug("Loading dependencies from lockfile {}".format(lockfile))
+                self.update(lockfile.packages(packages))
+                self.dropped = lockfile.dropped(packages)
+                return
+
+            if frozen:
+                raise ValueError("Lockfile {} is out of date: {}".format(lockfile, drift))
+
+            logger.debug("Ignoring lockfile {}: {}".format(lockfile, drift))
+            # whatever changed could have been indexed before it changed, so
+            # resolve against the filesystem as it is now
+            Dirindex.clear()
         seen = set()
+        modulenames = []
         filepath = Filepath(path)
         if filepath.exists():
             logger.debug("Checking imports for {}".format(filepath))
-            im = Imports(filepath)
+            im = Imports(filepath, scanner=self.scanner)
             for modulename in im:
                 for regex in ignore:
                     if re.search(regex, modulename, flags=re.I):
@@ -104,7 +517,7 @@ class Dependencies(set):
                         break
 
                 if modulename not in seen:
-                    self.update(self._resolve(modulename, packages, seen))
+                    modulenames.append(modulename)
 
         else:
             # do we have a module path?
@@ -115,12 +528,145 @@ class Dependencies(set):
 
             else:
                 logger.debug("Checking requires for {}".format(p))
-                for modulename in p.requires():
-                    self.update(self._resolve(modulename, packages, seen))
+                modulenames.extend(self._requires(p))
+
+        if workers > 0:
+            self.update(self._resolve_concurrent(modulenames, packages, seen, workers))
+
+        else:
+            for modulename in modulenames:
+                self.update(self._resolve(modulename, packages, seen))
+
+        self._resolve_extras(packages, seen)
+
+        for p in sorted(self):
+            for r, reason in getattr(p, "dropped", []):
+                self.dropped.append((p, r, reason))
+
+        if self.dropped:
+            logger.debug("Dropped {} requirements that would not be installed on the target".format(
+                len(self.dropped)
+            ))
+
+        cache = ImportsCache.get_instance()
+        logger.debug("Imports cache had {} hits and {} misses".format(
+            cache.hits,
+            cache.misses
+        ))
+        cache.save()
+
+        if lockfile:
+            lockfile.save(path, ignore, self, packages, self.environment, extras)
+
+    def required_by(self):
+        """returns the edges of the dependency graph that pulled in every
+        dependency, this finds the requires of every dependency again so it
+        is only meant for reporting
+
+        :returns: dict, package name keys and a sorted list of the names of the
+            packages that require it, an empty name is the module at .path
+        """
+        ret = dict((String(p), set()) for p in self)
+
+        filepath = Filepath(self.path)
+        if filepath.exists():
+            requires = [("", Imports(filepath, scanner=self.scanner))]
+        else:
+            requires = [("", self._requires(Packages()[self.path]))]
+        requires.extend((String(p), self._requires(p)) for p in self)
+
+        for name, modulepaths in requires:
+            for modulepath in modulepaths:
+                modulename = modulepath.split(".")[0]
+                if modulename in ret and modulename != name:
+                    ret[modulename].add(name)
+
+        return dict((name, sorted(names)) for name, names in ret.items())
+
+    def get_extras(self, p):
+        """returns the extras that were asked for of package p's distributions"""
+        ret = set()
+        for infopath in p.infopaths:
+            ret.update(self.extras.get(Dirindex.normalize_info_name(infopath.name), set()))
+        return ret
+
+    def _requires(self, p):
+        """returns the requires of package p and remembers the extras its
+        requirements ask for so they are used when those packages are checked"""
+        ret = p.requires(self.scanner, self.environment, self.get_extras(p), self.processes)
+        self._add_extras(p)
+        return ret
+
+    def _add_extras(self, p):
+        """remember the extras the requirements of package p ask for"""
+        for r in getattr(p, "required", []):
+            if r.extras:
+                self.extras.setdefault(Dirindex.normalize_info_name(r.distribution), set()).update(r.extras)
 
     def _resolve(self, modulepath, packages, seen):
-        modulename = modulepath.split(".")[0]
         ret = set()
+        p = self._resolve_package(modulepath, packages, seen)
+        if p:
+            ret.add(p)
+            logger.debug("Checking requires for {} at {}".format(p, p.path))
+            for m in self._requires(p):
+                #pout.v(name, require_modulepath, seen)
+                ret.update(self._resolve(m, packages, seen))
+
+        return ret
+
+    def _resolve_extras(self, packages, seen):
+        """a package can be checked before another package's requirement asks
+        for one of its extras, so check those packages again until nothing new
+        is asked for"""
+        changed = True
+        while changed:
+            changed = False
+            for p in sorted(self):
+                if self.get_extras(p) - getattr(p, "requires_extras", frozenset()):
+                    logger.debug("Checking requires for {} again with extras {}".format(
+                        p,
+                        ", ".join(sorted(self.get_extras(p)))
+                    ))
+                    for m in self._requires(p):
+                        self.update(self._resolve(m, packages, seen))
+                    changed = True
+
+    def _resolve_concurrent(self, modulepaths, packages, seen, workers):
+        """breadth first version of ._resolve(), the packages of each level of
+        the graph are found in this thread and then all their requires are found
+        concurrently since that is mostly waiting on the disk"""
+        ret = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while modulepaths:
+                frontier = []
+                for modulepath in modulepaths:
+                    p = self._resolve_package(modulepath, packages, seen)
+                    if p:
+                        ret.add(p)
+                        frontier.append(p)
+
+                logger.debug("Checking requires for {} packages".format(len(frontier)))
+                modulepaths = []
+                # the extras are copied here since ._add_extras() could change
+                # them while the workers are still running
+                extras = [frozenset(self.get_extras(p)) for p in frontier]
+                results = executor.map(
+                    lambda p, e: p.requires(self.scanner, self.environment, e, self.processes),
+                    frontier,
+                    extras
+                )
+                for p, requires in zip(frontier, results):
+                    modulepaths.extend(requires)
+                    self._add_extras(p)
+
+        return ret
+
+    def _resolve_package(self, modulepath, packages, seen):
+        """returns the non standard package of modulepath if it hasn't been seen
+        yet, otherwise None"""
+        ret = None
+        modulename = modulepath.split(".")[0]
         if modulename not in seen:
             seen.add(modulename)
 
@@ -132,22 +678,820 @@ class Dependencies(set):
 
             else:
                 if not p.is_standard():
-                    ret.add(p)
-                    logger.debug("Checking requires for {} at {}".format(p, p.path))
-                    for m in p.requires():
-                        #pout.v(name, require_modulepath, seen)
-                        ret.update(self._resolve(m, packages, seen))
+                    ret = p
+
+        return ret
+
+
+class Lockfile(Filepath):
+    """A JSON file that records a resolved Dependencies graph along with the
+    fingerprints of the files and directories that produced it
+
+    If none of those files have changed then the graph can be loaded from the
+    lockfile without parsing anything
+    """
+    format_version = 2
+
+    @classmethod
+    def fingerprint(cls, path):
+        """returns the fingerprint of path, files are fingerprinted by mtime,
+        size and md5 hash, directories by mtime (which changes when something
+        is added or removed)
+
+        :returns: list, the fingerprint or None if path doesn't exist
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        if os.path.isdir(path):
+            return [st.st_mtime]
+
+        with open(path, "rb") as fp:
+            return [st.st_mtime, st.st_size, hashlib.md5(fp.read()).hexdigest()]
+
+    @classmethod
+    def matches(cls, path, fingerprint):
+        """return True if path still matches fingerprint, files that have been
+        touched but not changed still match"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        if len(fingerprint) == 1:
+            return os.path.isdir(path) and st.st_mtime == fingerprint[0]
+
+        if st.st_size != fingerprint[1]:
+            return False
+
+        if st.st_mtime == fingerprint[0]:
+            return True
+
+        with open(path, "rb") as fp:
+            return hashlib.md5(fp.read()).hexdigest() == fingerprint[2]
+
+    def load(self):
+        """returns the contents of the lockfile or an empty dict if it doesn't
+        exist or can't be read"""
+        ret = {}
+        if self.exists():
+            try:
+                ret = json.loads(self.contents())
+            except ValueError as e:
+                logger.warning("Ignoring unreadable lockfile {}: {}".format(self, e))
+        return ret
+
+    def drift(self, path, ignore, environment=None, extras=None):
+        """check the lockfile against the current state of the filesystem
+
+        :param path: string, the path Dependencies is resolving
+        :param ignore: list, the ignore regexes Dependencies is using
+        :param environment: dict, the marker variables Dependencies is using,
+            defaults to this python
+        :param extras: list, the extras Dependencies is using
+        :returns: string, why the lockfile can't be used, empty if it can
+        """
+        data = self.load()
+        if not data:
+            return "lockfile does not exist"
+
+        if data.get("format_version") != self.format_version:
+            return "lockfile format changed"
+
+        if data.get("path") != String(path) or data.get("ignore") != list(ignore):
+            return "lockfile was created for different arguments"
+
+        if environment is None:
+            environment = Marker.get_environment()
+
+        if data.get("environment") != environment or data.get("extras") != sorted(extras or []):
+            return "lockfile was created for a different target"
+
+        for p, fingerprint in data.get("fingerprints", {}).items():
+            if not self.matches(p, fingerprint):
+                return "{} changed".format(p)
+
+        return ""
+
+    def packages(self, packages):
+        """returns the locked packages
+
+        :param packages: Packages, used to find the locked packages
+        :returns: set, the Package instances
+        """
+        ret = set()
+        for d in self.load().get("packages", []):
+            ret.add(packages.package_class(d["name"], d["basedir"]))
+        return ret
+
+    def dropped(self, packages):
+        """returns the locked requirements that were dropped, see
+        Dependencies.dropped
+
+        :param packages: Packages, used to find the locked packages
+        :returns: list, (Package, Requirement, reason) tuples
+        """
+        ret = []
+        for d in self.load().get("dropped", []):
+            ret.append((
+                packages.package_class(d["name"], d["basedir"]),
+                Requirement(d["requirement"]),
+                d["reason"],
+            ))
+        return ret
+
+    def save(self, path, ignore, dependencies, packages, environment=None, extras=None):
+        """write the resolved dependencies and the fingerprints of everything
+        that produced them to the lockfile
+
+        :param path: string, the path that was resolved
+        :param ignore: list, the ignore regexes that were used
+        :param dependencies: Dependencies, the resolved packages
+        :param packages: Packages, the packages used to resolve path
+        :param environment: dict, the marker variables that were used
+        :param extras: list, the extras that were used
+        """
+        paths = set()
+        if Filepath(path).exists():
+            paths.add(Filepath(path))
+        else:
+            paths.update(m.filepath for m in packages[path].modules() if m.filepath)
+
+        # the search paths are included because a newly installed package
+        # could satisfy a dependency that was missing, the lockfile's directory
+        # is left out since writing the lockfile changes it
+        paths.update(packages.search_paths())
+        paths.discard(self.dirname)
+
+        locked = []
+        for p in sorted(dependencies):
+            locked.append({
+                "name": String(p),
+                "path": p.path,
+                "basedir": p.basedir,
+                "version": p.version,
+            })
+
+            for m in p.modules():
+                if m.filepath:
+                    paths.add(m.filepath)
+                if m.is_package():
+                    paths.add(m.path)
+
+            for infopath in p.infopaths:
+                paths.add(infopath)
+                for basename in ["METADATA", "metadata.json", "PKG-INFO"]:
+                    filepath = Filepath(infopath, basename)
+                    if filepath.exists():
+                        paths.add(filepath)
+
+        fingerprints = {}
+        for p in paths:
+            fingerprint = self.fingerprint(p)
+            if fingerprint:
+                fingerprints[String(p)] = fingerprint
+
+        data = {
+            "format_version": self.format_version,
+            "path": String(path),
+            "ignore": list(ignore),
+            "environment": Marker.get_environment() if environment is None else environment,
+            "extras": sorted(extras or []),
+            "dropped": [{
+                "name": String(p),
+                "basedir": p.basedir,
+                "requirement": String(r),
+                "reason": reason,
+            } for p, r, reason in getattr(dependencies, "dropped", [])],
+            "packages": locked,
+            "fingerprints": fingerprints,
+        }
+
+        fd, tmppath = tempfile.mkstemp(dir=self.dirname)
+        with os.fdopen(fd, "w") as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        replace(tmppath, self)
+        logger.debug("Saved {} dependencies to lockfile {}".format(len(locked), self))
+
+
+class Treeshake(object):
+    """Find the modules of the dependencies that are actually reachable from a
+    module by following its imports at the submodule level
+
+    Anything that is only imported dynamically (eg, importlib.import_module())
+    or that isn't a module (eg, data files) needs to be matched by one of the
+    keep patterns or it will be pruned
+    """
+    def __init__(self, filepath, dependencies, keep=None):
+        """
+        :param filepath: string, the module the dependencies were found for
+        :param dependencies: Dependencies, the packages to shake
+        :param keep: list, fnmatch patterns that are matched against module
+            paths (eg, foo.plugins.*) and file paths relative to the package's
+            basedir (eg, foo/data/*.json), matching modules are treated as
+            reachable and matching files are always kept
+        """
+        self.filepath = Filepath(filepath)
+        self.dependencies = {String(p): p for p in dependencies}
+        self.keep = keep or []
+        self.modules = set()
+        self.pruned = []
+        self.resolve()
+
+    def get_modulepath(self, relpath):
+        """returns the module path of a file path relative to a basedir or an
+        empty string if relpath isn't a module"""
+        bits = relpath.split("/")
+        basename = bits.pop()
+        if basename == "__init__.py":
+            pass
+        elif basename.endswith(".py"):
+            bits.append(basename[:-3])
+        elif basename.endswith(".so"):
+            bits.append(basename.split(".")[0])
+        else:
+            return ""
+        return ".".join(bits)
+
+    def is_kept(self, modulepath, relpath):
+        for pattern in self.keep:
+            if modulepath and fnmatch.fnmatchcase(modulepath, pattern):
+                return True
+            if fnmatch.fnmatchcase(relpath, pattern):
+                return True
+        return False
+
+    def resolve(self):
+        queue = [(self.filepath, "", False)]
+        for p in self.dependencies.values():
+            for path, relpath in p.files():
+                modulepath = self.get_modulepath(relpath)
+                if modulepath and self.is_kept(modulepath, relpath):
+                    bits = modulepath.split(".")
+                    for i in range(1, len(bits) + 1):
+                        queue.extend(self.add(".".join(bits[:i])))
+
+        while queue:
+            filepath, modulepath, is_package = queue.pop()
+            for name in ModuleImports(filepath, modulepath, is_package):
+                bits = name.split(".")
+                for i in range(1, len(bits) + 1):
+                    queue.extend(self.add(".".join(bits[:i])))
+
+    def add(self, modulepath):
+        """mark modulepath as reachable
+
+        :returns: list, the (filepath, modulepath, is_package) of modulepath if
+            it needs to be scanned
+        """
+        ret = []
+        if modulepath in self.modules: return ret
+
+        p = self.dependencies.get(modulepath.split(".")[0], None)
+        if not p: return ret
+
+        if modulepath != p:
+            try:
+                p = p.__class__(modulepath, p.basedir)
+            except ValueError:
+                # "from foo import bar" where bar isn't a module
+                return ret
+
+        self.modules.add(modulepath)
+        filepath = p.filepath
+        if filepath and filepath.exists() and filepath.ext == "py":
+            ret.append((filepath, modulepath, p.is_package()))
+        return ret
+
+    def files(self, p, files=None):
+        """filter p.files() down to the files that are reachable, kept, or part
+        of the package's info folder, every other file is added to .pruned
+
+        :param p: Package, one of the dependencies
+        :param files: iterable, (path, relpath) tuples to filter instead of
+            p.files() (eg, the files of p's wheel, see Wheel.files())
+        :returns: generator, yields the same (path, relpath) tuples p.files() does
+        """
+        for path, relpath in (p.files() if files is None else files):
+            modulepath = self.get_modulepath(relpath)
+            if modulepath in self.modules \
+                or self.is_kept(modulepath, relpath) \
+                or relpath.split("/")[0].endswith("-info"):
+                yield path, relpath
+
+            else:
+                self.pruned.append((path, relpath))
+
+
+class Dirindex(object):
+    """An index of the top level entries of a directory built from one
+    os.scandir() pass the first time something is looked up
+
+    Each instance is shared for the life of the process, use .get_instance() to
+    get the index for a directory, it is built again if the directory's mtime
+    has changed since it was scanned (eg, a package was installed or removed)
+    """
+    instances = {}
+
+    @classmethod
+    def get_instance(cls, basedir):
+        basedir = Dirpath(basedir)
+        instance = cls.instances.get(basedir, None)
+        if instance is None or instance.is_stale():
+            instance = cls(basedir)
+            cls.instances[basedir] = instance
+        return instance
+
+    @classmethod
+    def clear(cls):
+        """forget every directory that has been indexed"""
+        cls.instances = {}
+
+    @classmethod
+    def normalize_info_name(cls, name):
+        """normalize a distribution name so "Foo-Bar", "foo_bar" and "foo.bar"
+        all match"""
+        return re.sub(r"[-_.]+", "_", name).lower()
+
+    def __init__(self, basedir):
+        self.basedir = Dirpath(basedir)
+        self.scanned = False
+        self.modules = {}
+        self.packages = {}
+        self.shared = {}
+        self.infopaths = {}
+        self.lowercase = {}
+        self.misses = set()
+        self.info_scanned = False
+        self.top_levels = {}
+        self.distributions = {}
+        self.mtime = None
+        self.lock = threading.RLock()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.basedir).st_mtime
+        except OSError:
+            return None
+
+    def is_stale(self):
+        """returns True if basedir has changed since it was scanned"""
+        return self.scanned and self.get_mtime() != self.mtime
+
+    def scan(self):
+        """do the one os.scandir() pass over basedir"""
+        if self.scanned: return
+        with self.lock:
+            if self.scanned: return
+
+            # before the scan so a change during the scan is found next time
+            self.mtime = self.get_mtime()
+            try:
+                entries = list(os.scandir(self.basedir))
+            except OSError:
+                entries = []
+
+            for entry in entries:
+                name = entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+
+                if name.endswith("-info"):
+                    if name.endswith(".dist-info") or name.endswith(".egg-info"):
+                        key = self.normalize_info_name(name.split("-")[0])
+                        path = Dirpath(self.basedir, name) if is_dir else Filepath(self.basedir, name)
+                        self.infopaths.setdefault(key, []).append(path)
+
+                elif is_dir:
+                    self.packages[name] = Dirpath(self.basedir, name)
+
+                elif name.endswith(".py"):
+                    self.modules[name[:-3]] = Filepath(self.basedir, name)
+
+                elif name.endswith(".so"):
+                    # extension modules can have an abi tag (eg, foo.cpython-37m-x86_64-linux-gnu.so)
+                    self.shared.setdefault(name.split(".")[0], Filepath(self.basedir, name))
+
+            for d in [self.shared, self.packages, self.modules]:
+                for name, path in d.items():
+                    self.lowercase[name.lower()] = path
+
+            self.scanned = True
+
+    def find(self, name):
+        """find the module, package, or shared library name in basedir
+
+        :param name: string, the module name with no extension
+        :returns: Path, the path or None if name isn't in basedir
+        """
+        if name in self.misses: return None
+
+        self.scan()
+        for d in [self.modules, self.packages, self.shared]:
+            if name in d:
+                return d[name]
+
+        ret = self.lowercase.get(name.lower(), None)
+        if ret:
+            logger.debug("Found {} through case-insensitive search of {}".format(name, self.basedir))
+
+        else:
+            self.misses.add(name)
+
+        return ret
+
+    def scan_info(self):
+        """read the top level names of every info folder in basedir to build
+        the top level import name -> Infopath reverse index"""
+        if self.info_scanned: return
+        with self.lock:
+            if self.info_scanned: return
+
+            self.scan()
+            for paths in self.infopaths.values():
+                for path in paths:
+                    m = Infopath(path)
+                    top_level = m.top_level
+                    self.top_levels[m] = top_level
+                    for name in top_level:
+                        self.distributions.setdefault(name, []).append(m)
+
+            # namespace packages (eg, google) are installed by many
+            # distributions, sorting them keeps the order off the filesystem
+            for infopaths in self.distributions.values():
+                infopaths.sort(key=lambda m: (self.normalize_info_name(m.name), m))
+
+            self.info_scanned = True
+
+    def find_distribution(self, name):
+        """find the info folder of the distribution that installed the top
+        level module name, if more than one distribution did then this is the
+        first of .find_distributions()
+
+        :param name: string, the top level import name (eg, dateutil)
+        :returns: Infopath, the info folder or None if not found
+        """
+        infopaths = self.find_distributions(name)
+        return infopaths[0] if infopaths else None
+
+    def find_distributions(self, name):
+        """find the info folders of every distribution that installed the top
+        level module name, sorted by distribution name
+
+        :param name: string, the top level import name (eg, google)
+        :returns: list, the Infopath instances
+        """
+        self.scan_info()
+        return list(self.distributions.get(name, []))
+
+    def get_top_level(self, infopath):
+        """returns the top level import names of infopath, infopath should be
+        in basedir"""
+        self.scan_info()
+        ret = self.top_levels.get(infopath, None)
+        if ret is None:
+            ret = Infopath(infopath).top_level
+            self.top_levels[infopath] = ret
+        return ret
+
+    def find_infopaths(self, name):
+        """find the info folders (eg, *.dist-info) for the distribution name
+
+        :param name: string, the distribution name (eg, python-dateutil)
+        :returns: list, the found Infopath instances
+        """
+        self.scan()
+        return [Infopath(p) for p in self.infopaths.get(self.normalize_info_name(name), [])]
+
+
+class Marker(String):
+    """A PEP 508 environment marker (eg, `python_version < "3.8" and extra == "test"`)
+
+    https://peps.python.org/pep-0508/#environment-markers
+    """
+    token_regex = re.compile(r"""
+        \s*(?:
+            (?P<string>'[^']*'|"[^"]*")
+            |(?P<op>===|==|!=|<=|>=|~=|<|>|\bnot\s+in\b|\bin\b)
+            |(?P<bool>\band\b|\bor\b)
+            |(?P<paren>[()])
+            |(?P<variable>[A-Za-z_][A-Za-z0-9_.]*)
+        )
+    """, re.X)
+
+    variables = set([
+        "os_name",
+        "sys_platform",
+        "platform_machine",
+        "platform_python_implementation",
+        "platform_release",
+        "platform_system",
+        "platform_version",
+        "python_version",
+        "python_full_version",
+        "implementation_name",
+        "implementation_version",
+        "extra",
+    ])
+
+    @classmethod
+    def get_environment(cls, runtime="", **kwargs):
+        """returns the values of the marker variables
+
+        :param runtime: string, the target python runtime (eg, python3.9), this
+            defaults to the current python
+        :param **kwargs: any marker variables that should be different from
+            this machine (eg, sys_platform="linux")
+        :returns: dict
+        """
+        import platform
+
+        environment = {
+            "os_name": os.name,
+            "sys_platform": sys.platform,
+            "platform_machine": platform.machine(),
+            "platform_python_implementation": platform.python_implementation(),
+            "platform_release": platform.release(),
+            "platform_system": platform.system(),
+            "platform_version": platform.version(),
+            "python_version": ".".join(platform.python_version_tuple()[:2]),
+            "python_full_version": platform.python_version(),
+            "implementation_name": sys.implementation.name,
+        }
+
+        if runtime and runtime != get_runtime():
+            # we only know the major and minor versions of a different runtime
+            version = re.sub(r"^[a-z]+", "", runtime)
+            environment["python_version"] = version
+            environment["python_full_version"] = "{}.0".format(version)
+
+        environment["implementation_version"] = environment["python_full_version"]
+        environment.update(kwargs)
+        return environment
+
+    @classmethod
+    def parse_version(cls, version):
+        """returns the release numbers of version (eg, "3.9.1" -> (3, 9, 1)) or
+        None if version isn't a version"""
+        m = re.match(r"^\s*v?(\d+(?:\.\d+)*)", version)
+        return tuple(int(n) for n in m.group(1).split(".")) if m else None
+
+    @classmethod
+    def normalize_extra(cls, extra):
+        return re.sub(r"[-_.]+", "-", extra).lower()
+
+    def __new__(cls, marker):
+        instance = super(Marker, cls).__new__(cls, marker.strip())
+        instance.tree = instance.parse()
+        return instance
+
+    def tokenize(self):
+        ret = []
+        s = String(self)
+        i = 0
+        while i < len(s):
+            if not s[i:].strip():
+                break
+
+            m = self.token_regex.match(s, i)
+            if not m or m.end() == i:
+                raise ValueError("Invalid marker {} at position {}".format(s, i))
+
+            for kind, value in m.groupdict().items():
+                if value is not None:
+                    if kind == "string":
+                        value = value[1:-1]
+                    elif kind == "op":
+                        value = " ".join(value.split())
+                    elif kind == "variable":
+                        # PEP 345 used dotted names (eg, platform.python_implementation)
+                        value = value.replace(".", "_")
+                        if value not in self.variables:
+                            raise ValueError("Unknown marker variable {} in {}".format(value, s))
+                    ret.append((kind, value))
+
+            i = m.end()
+
+        return ret
+
+    def parse(self):
+        """parse the marker into a tree of ("or", [...]), ("and", [...]), and
+        ("compare", lhs, op, rhs) nodes"""
+        tokens = self.tokenize()
+
+        def parse_or(i):
+            nodes = []
+            node, i = parse_and(i)
+            nodes.append(node)
+            while i < len(tokens) and tokens[i] == ("bool", "or"):
+                node, i = parse_and(i + 1)
+                nodes.append(node)
+            return (("or", nodes) if len(nodes) > 1 else nodes[0]), i
+
+        def parse_and(i):
+            nodes = []
+            node, i = parse_atom(i)
+            nodes.append(node)
+            while i < len(tokens) and tokens[i] == ("bool", "and"):
+                node, i = parse_atom(i + 1)
+                nodes.append(node)
+            return (("and", nodes) if len(nodes) > 1 else nodes[0]), i
+
+        def parse_atom(i):
+            if i < len(tokens) and tokens[i] == ("paren", "("):
+                node, i = parse_or(i + 1)
+                if i >= len(tokens) or tokens[i] != ("paren", ")"):
+                    raise ValueError("Unbalanced parentheses in marker {}".format(self))
+                return node, i + 1
+
+            if i + 2 < len(tokens) and tokens[i + 1][0] == "op":
+                lhs, op, rhs = tokens[i], tokens[i + 1][1], tokens[i + 2]
+                if lhs[0] in ("string", "variable") and rhs[0] in ("string", "variable"):
+                    return ("compare", lhs, op, rhs), i + 3
+
+            raise ValueError("Invalid marker {}".format(self))
+
+        node, i = parse_or(0)
+        if i != len(tokens):
+            raise ValueError("Invalid marker {}".format(self))
+        return node
+
+    def evaluate(self, environment=None, extras=None):
+        """returns True if the marker is true for environment
+
+        :param environment: dict, the marker variables, see .get_environment()
+        :param extras: set, the extras that were asked for, `extra == "..."` is
+            true if any of them match
+        :returns: boolean
+        """
+        if environment is None:
+            environment = self.get_environment()
+        extras = [self.normalize_extra(e) for e in extras or []] or [""]
+
+        def value(token, extra):
+            kind, v = token
+            if kind == "variable":
+                if v == "extra":
+                    return extra
+                if v not in environment:
+                    raise ValueError("No value for marker variable {}".format(v))
+                return environment[v]
+            return v
+
+        def evaluate(node):
+            if node[0] == "or":
+                return any(evaluate(n) for n in node[1])
+
+            if node[0] == "and":
+                return all(evaluate(n) for n in node[1])
+
+            _, lhs, op, rhs = node
+            if ("variable", "extra") in (lhs, rhs):
+                return any(
+                    self.compare(
+                        self.normalize_extra(value(lhs, extra)),
+                        op,
+                        self.normalize_extra(value(rhs, extra))
+                    ) for extra in extras
+                )
+
+            return self.compare(value(lhs, ""), op, value(rhs, ""))
+
+        return evaluate(self.tree)
+
+    def compare(self, lhs, op, rhs):
+        if op == "in":
+            return lhs in rhs
+
+        if op == "not in":
+            return lhs not in rhs
+
+        if op == "===":
+            return lhs == rhs
+
+        lv = self.parse_version(lhs)
+        if rhs.endswith(".*") and op in ("==", "!="):
+            rv = self.parse_version(rhs[:-2])
+            if lv is not None and rv is not None:
+                lv = (lv + (0,) * len(rv))[:len(rv)]
+                return (lv == rv) if op == "==" else (lv != rv)
+
+        rv = self.parse_version(rhs)
+        if lv is not None and rv is not None:
+            if op == "~=":
+                if len(rv) < 2:
+                    raise ValueError("Invalid compatible version {}".format(rhs))
+                return self.compare(lhs, ">=", rhs) and lv[:len(rv) - 1] == rv[:-1]
+
+            size = max(len(lv), len(rv))
+            lhs = lv + (0,) * (size - len(lv))
+            rhs = rv + (0,) * (size - len(rv))
+
+        if op == "==":
+            return lhs == rhs
+        elif op == "!=":
+            return lhs != rhs
+        elif op == "<":
+            return lhs < rhs
+        elif op == "<=":
+            return lhs <= rhs
+        elif op == ">":
+            return lhs > rhs
+        elif op == ">=":
+            return lhs >= rhs
+
+        raise ValueError("Cannot compare {} {} {}".format(lhs, op, rhs))
+
+
+class Requirement(String):
+    """A Requires-Dist line (eg, `requests[socks] (>=2.0) ; python_version < "3.8"`)"""
+    @property
+    def name(self):
+        """the module name of the requirement, see Infopath.info_to_module()"""
+        return Infopath.info_to_module(self.distribution)
+
+    def __new__(cls, requirement):
+        requirement = requirement.strip()
+        instance = super(Requirement, cls).__new__(cls, requirement)
+
+        bits = requirement.split(";", 1)
+        m = re.match(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[([^\]]*)\])?", bits[0])
+        if not m:
+            raise ValueError("Invalid requirement {}".format(requirement))
+
+        instance.distribution = m.group(1)
+        instance.extras = set(e.strip() for e in (m.group(2) or "").split(",") if e.strip())
+        instance.marker = None
+        if len(bits) > 1 and bits[1].strip():
+            try:
+                instance.marker = Marker(bits[1])
+            except ValueError as e:
+                # it's safer to bundle something we don't need than to leave
+                # out something we do
+                logger.warning("Keeping requirement {} because {}".format(requirement, e))
 
+        return instance
+
+    def drop_reason(self, environment=None, extras=None):
+        """check if this requirement would be installed for environment
+
+        :param environment: dict, see Marker.get_environment()
+        :param extras: set, the extras that were asked for of the distribution
+            that has this requirement
+        :returns: string, why the requirement wouldn't be installed, empty if
+            it would be
+        """
+        ret = ""
+        if self.marker:
+            try:
+                if not self.marker.evaluate(environment, extras):
+                    ret = "marker is false: {}".format(self.marker)
+            except ValueError as e:
+                logger.warning("Keeping requirement {} because {}".format(self, e))
         return ret
 
 
 class Infopath(String):
+    @property
+    def name(self):
+        """the distribution name from the info folder's name (eg, python_dateutil)"""
+        return self.path.fileroot.split("-")[0]
+
     @property
     def top_level(self):
+        """the top level import names this distribution installed, this uses
+        top_level.txt if it exists, otherwise the names are derived from the
+        installed files (wheels built by newer tools don't have top_level.txt)"""
         ret = []
         if self.path.isdir():
             filepath = Filepath(self, "top_level.txt")
-            ret = [line.strip() for line in filepath]
+            if filepath.exists():
+                ret = [line.strip() for line in filepath if line.strip()]
+
+            else:
+                for path in self.files():
+                    bits = path.split("/")
+                    name = bits[0]
+                    if len(bits) > 1:
+                        if name == "__pycache__" or name.endswith("-info") or name.endswith(".data"):
+                            name = ""
+
+                    elif name.endswith(".py"):
+                        name = name[:-3]
+
+                    elif name.endswith(".so"):
+                        name = name.split(".")[0]
+
+                    else:
+                        name = ""
+
+                    if name and name not in ret:
+                        ret.append(name)
+
         return ret
 
     @property
@@ -158,9 +1502,9 @@ class Infopath(String):
 
         p = Package.find_path(name, basedir)
         if not p:
-            top_level = self.top_level
+            top_level = Dirindex.get_instance(basedir).get_top_level(self)
             if top_level:
-                name = self.top_level[0]
+                name = top_level[0]
 
             else:
                 for prefix in ["python_", "py"]:
@@ -173,6 +1517,20 @@ class Infopath(String):
 
         return name
 
+    @property
+    def version(self):
+        """the version of the distribution (eg, 1.2.3)"""
+        # info folders are named NAME-VERSION.dist-info or NAME-VERSION-PYVER.egg-info
+        bits = os.path.splitext(self.path.basename)[0].split("-")
+        if len(bits) > 1:
+            return bits[1]
+
+        for line in self.data.splitlines(False):
+            if line.startswith("Version:"):
+                return line.split(":", 1)[1].strip()
+
+        return self.metadata.get("version", "")
+
     @property
     def metadata(self):
         ret = {}
@@ -209,42 +1567,328 @@ class Infopath(String):
         instance.path = infopath
         return instance
 
-    def requires(self):
-        """returns the info defined dependencies for this package
+    def files(self):
+        """returns the files that were installed with this distribution
 
-        this doesn't normalize the module name or anything
+        this uses RECORD (wheels) or installed-files.txt (eggs), files that
+        were installed outside of the info folder's directory (eg, scripts in
+        bin/) are ignored
 
-        :returns: set, the required packages per configuration
+        :returns: list, the file paths relative to the info folder's directory
         """
-        ret = set()
+        ret = []
+        if self.path.isdir():
+            filepath = Filepath(self, "RECORD")
+            if filepath.exists():
+                paths = [row[0] for row in csv.reader(filepath) if row]
+
+            else:
+                filepath = Filepath(self, "installed-files.txt")
+                if filepath.exists():
+                    paths = [os.path.join(self.path.basename, line.strip()) for line in filepath if line.strip()]
+
+                else:
+                    paths = []
+
+            for path in paths:
+                path = os.path.normpath(path).replace(os.sep, "/")
+                if not path.startswith("../") and not os.path.isabs(path):
+                    ret.append(path)
+
+        return ret
+
+    def requirements(self):
+        """returns every requirement this distribution defines
+
+        :returns: list, the Requirement instances
+        """
+        ret = []
 
         md = self.metadata
         if md:
             for d in md.get("run_requires", []):
+                markers = []
+                if d.get("environment", ""):
+                    markers.append("({})".format(d["environment"]))
+                if d.get("extra", ""):
+                    markers.append('extra == "{}"'.format(d["extra"]))
+
                 for name in d.get("requires", []):
-                    ret.add(self.info_to_module(name))
+                    if markers:
+                        name = "{} ; {}".format(name, " and ".join(markers))
+                    ret.append(Requirement(name))
 
         else:
             txt = self.data
             if txt:
                 for line in txt.splitlines(False):
                     if line.startswith("Requires-Dist"):
-                        # TODO -- this line can have "extras == '...' info that
-                        # means this package is optional and might not be
-                        # installed
-                        name = self.info_to_module(line.split(":")[1].strip())
-                        if name:
-                            ret.add(name)
+                        try:
+                            ret.append(Requirement(line.split(":", 1)[1]))
+                        except ValueError as e:
+                            logger.warning("Ignoring requirement in {}: {}".format(self, e))
+
+        return ret
+
+    def requires(self, environment=None, extras=None):
+        """returns the info defined dependencies for this package
+
+        this doesn't normalize the module name or anything
+
+        :param environment: dict, the marker variables of the target, see
+            Marker.get_environment(), defaults to this python
+        :param extras: set, the extras of this distribution that were asked for
+        :returns: set, the required packages per configuration
+        """
+        ret = set()
+        for r in self.requirements():
+            if not r.drop_reason(environment, extras):
+                ret.add(r.name)
+        return ret
+
+
+class Wheel(Filepath):
+    """A built distribution, see PEP 427
+
+    the filename is NAME-VERSION(-BUILD)-PYTHON-ABI-PLATFORM.whl and every tag
+    can be a dotted list (eg, manylinux_2_17_x86_64.manylinux2014_x86_64)
+
+    https://packaging.python.org/en/latest/specifications/binary-distribution-format/
+    """
+    @classmethod
+    def normalize_name(cls, name):
+        """returns the distribution name the way wheel filenames escape it"""
+        return re.sub(r"[-_.]+", "_", name).lower()
+
+    def __new__(cls, *args, **kwargs):
+        instance = super(Wheel, cls).__new__(cls, *args, **kwargs)
+        bits = instance.fileroot.split("-")
+        if instance.ext != "whl" or len(bits) not in (5, 6):
+            raise ValueError("{} is not a wheel".format(instance))
+
+        instance.distribution = cls.normalize_name(bits[0])
+        instance.version = bits[1]
+        instance.tags = set()
+        for python in bits[-3].split("."):
+            for abi in bits[-2].split("."):
+                for platform in bits[-1].split("."):
+                    instance.tags.add((python, abi, platform))
+        return instance
+
+    def get_priority(self, tags):
+        """returns how good a match this wheel is for tags
+
+        :param tags: dict, (python, abi, platform) keys and priority values,
+            see Wheelhouse.get_tags()
+        :returns: int, lower is better, None if the wheel isn't compatible
+        """
+        priorities = [tags[tag] for tag in self.tags if tag in tags]
+        return min(priorities) if priorities else None
+
+    def unpack(self):
+        """unpack the wheel into the herd cache, this is only done the first
+        time so unpacked wheels are shared across builds
+
+        :returns: Dirpath, the directory the wheel was unpacked to
+        """
+        st = os.stat(self)
+        key = hashlib.sha256("{}\t{}\t{}".format(
+            self.basename,
+            st.st_size,
+            st.st_mtime,
+        ).encode("utf-8")).hexdigest()[:16]
+
+        basedir = Cachedir("wheels")
+        ret = Dirpath(basedir, "{}-{}".format(self.fileroot, key))
+        if not ret.exists():
+            # the wheel is unpacked next to where it will go and then moved
+            # there so concurrent builds never see a partially unpacked wheel
+            tmpdir = tempfile.mkdtemp(prefix=".unpack-", dir=basedir)
+            try:
+                with zipfile.ZipFile(self) as z:
+                    for info in z.infolist():
+                        name = os.path.normpath(info.filename)
+                        if os.path.isabs(name) or name.split(os.sep)[0] == "..":
+                            raise ValueError("Wheel {} has unsafe path {}".format(self, info.filename))
+
+                        if info.filename.endswith("/"):
+                            continue
+
+                        path = os.path.join(tmpdir, name)
+                        if not os.path.isdir(os.path.dirname(path)):
+                            os.makedirs(os.path.dirname(path))
+
+                        with z.open(info) as src, open(path, "wb") as dest:
+                            shutil.copyfileobj(src, dest)
+
+                        if (info.external_attr >> 16) & 0o111:
+                            os.chmod(path, 0o755)
+
+                os.rename(tmpdir, ret)
+                logger.debug("Unpacked wheel {} to {}".format(self.basename, ret))
+
+            except OSError:
+                # another build could have unpacked it in the meantime
+                if not ret.exists():
+                    raise
+
+            finally:
+                if os.path.isdir(tmpdir):
+                    shutil.rmtree(tmpdir)
 
         return ret
 
+    def files(self):
+        """yields every file the wheel would install into site-packages
+
+        files in the wheel's .data/purelib and .data/platlib folders are moved
+        to the top level, its other .data folders (eg, scripts) are skipped
+
+        :returns: generator, yields the same (path, relpath) tuples
+            Package.files() does
+        """
+        basedir = self.unpack()
+        for root_dir, dirs, files in basedir:
+            for basename in files:
+                path = Filepath(root_dir, basename)
+                relpath = os.path.relpath(path, basedir).replace(os.sep, "/")
+                bits = relpath.split("/")
+                if bits[0].endswith(".data"):
+                    if len(bits) > 2 and bits[1] in ("purelib", "platlib"):
+                        bits = bits[2:]
+                        relpath = "/".join(bits)
+
+                    else:
+                        continue
+
+                if "__pycache__" in bits or relpath.endswith(".pyc"):
+                    continue
+
+                yield path, relpath
+
+
+class Wheelhouse(Dirpath):
+    """A directory of wheels built for the platform lambda runs on, this finds
+    the wheel of a distribution that is most compatible with the runtime
+
+    lambda runs on linux with glibc so manylinux wheels are used,
+    https://peps.python.org/pep-0600/
+    """
+    @classmethod
+    def get_glibc(cls, runtime):
+        """returns the glibc version of the lambda runtime
+
+        :param runtime: string, the lambda runtime (eg, python3.9)
+        :returns: tuple, (major, minor)
+        """
+        version = tuple(int(v) for v in runtime[6:].split("."))
+        # runtimes from 3.12 are on Amazon Linux 2023, older ones are on
+        # Amazon Linux 2
+        return (2, 34) if version >= (3, 12) else (2, 26)
+
+    @classmethod
+    def get_tags(cls, runtime, machine="x86_64"):
+        """returns every tag a wheel for runtime on machine can have
+
+        :param runtime: string, the lambda runtime (eg, python3.9)
+        :param machine: string, x86_64 or aarch64
+        :returns: dict, (python, abi, platform) keys and priority values, lower
+            priorities are better matches
+        """
+        major, minor = (int(v) for v in runtime[6:].split("."))
+        glibc_major, glibc_minor = cls.get_glibc(runtime)
+
+        platforms = []
+        legacy = {17: "manylinux2014", 12: "manylinux2010", 5: "manylinux1"}
+        for m in range(glibc_minor, 4, -1):
+            platforms.append("manylinux_{}_{}_{}".format(glibc_major, m, machine))
+            if m in legacy and (m == 17 or machine == "x86_64"):
+                platforms.append("{}_{}".format(legacy[m], machine))
+
+        cp = "cp{}{}".format(major, minor)
+        tags = []
+        tags.extend((cp, cp, platform) for platform in platforms)
+        for platform in platforms:
+            for m in range(minor, 1, -1):
+                tags.append(("cp{}{}".format(major, m), "abi3", platform))
+        tags.extend((cp, "none", platform) for platform in platforms)
+
+        pys = ["py{}{}".format(major, minor), "py{}".format(major)]
+        pys.extend("py{}{}".format(major, m) for m in range(minor - 1, -1, -1))
+        for platform in platforms + ["any"]:
+            tags.extend((py, "none", platform) for py in pys)
+        tags.append((cp, "none", "any"))
+
+        ret = {}
+        for tag in tags:
+            ret.setdefault(tag, len(ret))
+        return ret
+
+    def __new__(cls, path, runtime, machine="x86_64"):
+        """
+        :param path: string, the directory with the .whl files
+        :param runtime: string, the lambda runtime (eg, python3.9)
+        :param machine: string, x86_64 or aarch64
+        """
+        instance = super(Wheelhouse, cls).__new__(cls, path)
+        if not instance.exists():
+            raise ValueError("Wheelhouse {} does not exist".format(instance))
+
+        instance.runtime = runtime
+        instance.machine = machine
+        instance.tags = cls.get_tags(runtime, machine)
+        instance.wheels = {}
+        for path in instance.glob("*.whl"):
+            try:
+                wheel = Wheel(path)
+            except ValueError:
+                logger.warning("Ignoring {} in wheelhouse, it is not a wheel".format(path))
+                continue
+            instance.wheels.setdefault(wheel.distribution, []).append(wheel)
+        return instance
+
+    def find(self, name, version=""):
+        """find the best wheel of a distribution
+
+        :param name: string, the distribution name (eg, python-dateutil)
+        :param version: string, if passed only a wheel of this version is found
+        :returns: Wheel, or None if there is no compatible wheel, the newest
+            version is found when compatible wheels have different versions
+        """
+        candidates = []
+        for wheel in self.wheels.get(Wheel.normalize_name(name), []):
+            if version and wheel.version != version:
+                continue
+
+            priority = wheel.get_priority(self.tags)
+            if priority is not None:
+                candidates.append((priority, wheel))
+
+        # newest first and then the sort by priority keeps that order
+        candidates.sort(key=lambda t: Marker.parse_version(t[1].version) or (), reverse=True)
+        candidates.sort(key=lambda t: t[0])
+        return candidates[0][1] if candidates else None
+
 
 class Package(String):
 
+    parse_processes = 0
+    """int, the default processes of .requires(), see Imports.find_all()"""
+
+    parse_threshold = 1000
+    """int, packages with fewer modules than this are always parsed in this
+    process since starting the process pool would cost more than it saves"""
+
     @property
     def name(self):
         return String(self)
 
+    @property
+    def version(self):
+        """the installed version of the package, empty if it isn't a site package"""
+        infopath = self.infopath
+        return infopath.version if infopath else ""
+
     @property
     def filepath(self):
         """always reteurns a filepath for the module, this could either be self.name.py
@@ -257,44 +1901,21 @@ class Package(String):
     @property
     def infopath(self):
         if not self.basedir: return ""
+        return Dirindex.get_instance(self.basedir).find_distribution(self)
 
-        for infopath in self.basedir.glob("*.*-info"):
-            m = Infopath(infopath)
-            if self in m.top_level:
-                return m
+    @property
+    def infopaths(self):
+        """the info folders of every distribution that installed this package,
+        a namespace package (eg, google) can have more than one"""
+        if not self.basedir: return []
+        return Dirindex.get_instance(self.basedir).find_distributions(self)
 
     @classmethod
     def find_path(cls, name, basedir):
-        ret = ""
         name = String(name)
-        name = name.replace(".", "/")
-        p = Filepath(basedir, name, ext=".py")
-        if p.exists():
-            ret = p
-        else:
-            p = Dirpath(basedir, name)
-            if p.exists():
-                ret = p
-
-            else:
-                p = Filepath(basedir, name, ext=".so")
-                if p.exists():
-                    ret = p
-
-        if not ret:
-            # let's just try and find by ignoring case
-            basedir = Dirpath(basedir)
-            regex = re.compile(r"^{}(?:\.py)?$".format(name), re.I)
-            for root_dir, dirs, files in basedir:
-                for basename in itertools.chain(files, dirs):
-                    if regex.match(basename):
-                        logger.debug("Found {} through case-insensitive search of {}".format(name, basedir))
-                        ret = Path.create(root_dir, basename)
-                        break
-
-                break
-
-        return ret
+        bits = name.split(".")
+        index = Dirindex.get_instance(Dirpath(basedir, *bits[:-1]))
+        return index.find(bits[-1]) or ""
 
     def __new__(cls, name, basedir):
         path = None
@@ -315,12 +1936,7 @@ class Package(String):
         return True if p else False
 
     def is_standard(self):
-        sp = StandardPackages()
-        try:
-            sp[self]
-            return True
-        except KeyError:
-            return False
+        return StandardPackages.is_standard_name(self)
 
     def is_local(self):
         return not self.is_site() and not self.is_standard()
@@ -333,6 +1949,53 @@ class Package(String):
         """returns True if this package is a module file"""
         return self.path.isfile() if self.path else False
 
+    def files(self):
+        """yields every file that belongs to this package
+
+        site packages use their info folders' RECORD (or installed-files.txt)
+        so only the files that were installed with the distributions are
+        yielded, this includes the info folders and any sibling top level
+        modules and data files the distributions installed, cached bytecode is
+        skipped. A namespace package (eg, google) combines the files of every
+        distribution that installed it. Other packages, or site packages with
+        a distribution that didn't record its files, yield every file in .path
+
+        :returns: generator, yields tuples of (path, relpath) where relpath is
+            path relative to .basedir
+        """
+        relpaths = []
+        seen = set()
+        for infopath in self.infopaths:
+            files = infopath.files()
+            if not files:
+                relpaths = []
+                break
+
+            for relpath in files:
+                if relpath not in seen:
+                    seen.add(relpath)
+                    relpaths.append(relpath)
+
+        if relpaths:
+            for relpath in relpaths:
+                bits = relpath.split("/")
+                if "__pycache__" in bits or relpath.endswith(".pyc"):
+                    continue
+
+                path = Filepath(self.basedir, relpath)
+                if path.exists():
+                    yield path, relpath
+
+        elif self.path:
+            if self.path.isfile():
+                yield self.path, self.path.basename
+
+            else:
+                for root_dir, dirs, files in self.path:
+                    for basename in files:
+                        path = Filepath(root_dir, basename)
+                        yield path, os.path.relpath(path, self.basedir).replace(os.sep, "/")
+
     def has_shared_library(self):
         """Returns True if this package contains a shared library (.so) file"""
         if self.path:
@@ -369,37 +2032,77 @@ class Package(String):
         for sm in self.submodules():
             yield sm
 
-    def requires(self):
+    def requires(self, scanner="ast", environment=None, extras=None, processes=None):
+        """returns the top level names this package depends on
+
+        :param scanner: string, how the modules are scanned for imports, see
+            Imports.__init__()
+        :param environment: dict, the marker variables of the target that the
+            distribution's requirements are checked against, see
+            Marker.get_environment(), defaults to this python
+        :param extras: set, the extras of this package's distribution that were
+            asked for
+        :param processes: int, if greater than zero and this package has at
+            least .parse_threshold modules then they are parsed using a pool of
+            this many processes, defaults to .parse_processes
+        :returns: set
+        """
+        extras = frozenset(extras or [])
         ret = getattr(self, "_requires_set", None)
-        if ret is None:
-            ret = self._requires_import() or set()
-            ret.update(self._requires_info() or set())
+        if ret is None or extras != self.requires_extras:
+            ret = self._requires_import(scanner, processes) or set()
+            info_requires = self._requires_info(environment, extras) or set()
+            ret.update(info_requires)
+
+            # the distribution won't install these on the target so any imports
+            # of them have to be optional
+            for r, reason in self.dropped:
+                if r.name not in info_requires:
+                    ret.discard(r.name)
 
             # remove itself as a dependency if present (I'm looking at you pycrypto)
             ret.discard(self)
             self._requires_set = ret
+            self.requires_extras = extras
 
         return ret
 
-    def _requires_import(self):
+    def _requires_import(self, scanner="ast", processes=None):
         """find all the import statements in all the modules of this package"""
-        ret = set()
-
+        filepaths = []
         for m in self.modules():
             if m.filepath:
-                im = Imports(m.filepath)
-                ret.update(im)
+                filepaths.append(m.filepath)
 
             else:
                 logger.debug("Cannot find imports for {}".format(m))
 
-        return ret
+        if processes is None:
+            processes = self.parse_processes
+        if len(filepaths) < self.parse_threshold:
+            processes = 0
+
+        return Imports.find_all(filepaths, processes=processes, scanner=scanner)
 
-    def _requires_info(self):
+    def _requires_info(self, environment=None, extras=None):
+        """returns the names of the distribution's requirements that would be
+        installed on the target, the Requirement instances that would be are
+        put in .required and the ones that wouldn't are put in .dropped as
+        (Requirement, reason) tuples"""
         ret = set()
-        infopath = self.infopath
-        if infopath:
-            ret = infopath.requires()
+        self.required = []
+        self.dropped = []
+        for infopath in self.infopaths:
+            for r in infopath.requirements():
+                reason = r.drop_reason(environment, extras)
+                if reason:
+                    logger.debug("Dropping {} requirement {} because {}".format(self, r, reason))
+                    self.dropped.append((r, reason))
+
+                else:
+                    self.required.append(r)
+                    ret.add(r.name)
+
         return ret
 
 
@@ -410,6 +2113,7 @@ class Packages(dict):
 
     def __init__(self, paths=None):
         self.paths = paths
+        self.misses = set()
         super(Packages, self).__init__()
 
     def search_paths(self):
@@ -424,6 +2128,9 @@ class Packages(dict):
                     yield dp
 
     def __missing__(self, name):
+        if name in self.misses:
+            raise KeyError(name)
+
         ret = None
         for basedir in self.search_paths():
             try:
@@ -436,12 +2143,10 @@ class Packages(dict):
 
         if not ret:
             # search again, this time looking for the info folder
-            pattern = "{}*.*-info".format(name.replace("-", "?"))
             for basedir in self.search_paths():
-                for infopath in basedir.glob(pattern):
-                    m = Infopath(infopath)
+                for m in Dirindex.get_instance(basedir).find_infopaths(name):
                     ret = self.package_class(m.import_name, basedir)
-                    logger.debug("Found {} = {} using infopath {}".format(name, ret, infopath))
+                    logger.debug("Found {} = {} using infopath {}".format(name, ret, m))
 
                     if super(Packages, self).__contains__(ret): 
                         logger.debug("Mapping {} to {}".format(ret, name))
@@ -453,9 +2158,14 @@ class Packages(dict):
                     break
 
         if not ret:
-            sp = StandardPackages()
-            ret = sp[name]
-            logger.debug("Found {} in standard library".format(name))
+            sp = StandardPackages.get_instance()
+            try:
+                ret = sp[name]
+                logger.debug("Found {} in standard library".format(name))
+
+            except KeyError:
+                self.misses.add(name)
+                raise
 
         if ret:
             super(Packages, self).__setitem__(name, ret)
@@ -501,40 +2211,100 @@ class Packages(dict):
 
 class StandardPackages(Packages):
     """A dictionary of python standard library packages/modules. If the requested
-    module is not part of the standard library then a KeyError is raised"""
+    module is not part of the standard library then a KeyError is raised
+
+    Whether a name is part of the standard library is decided by .module_names
+    which is only computed once per interpreter, use .get_instance() to get the
+    process wide instance
+    """
+    instance = None
+
+    module_names = None
+    """frozenset, the top level standard library module names, see .get_module_names()"""
+
+    @classmethod
+    def get_instance(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    @classmethod
+    def get_basedirs(cls):
+        """returns the directories the standard library could be installed in"""
+        ret = []
+        # in a virtual environment the BINLIBDEST config value can be different
+        # than the configured python lib standard lib path
+        for path in [sysconfig.get_python_lib(standard_lib=True), sysconfig.get_config_var("BINLIBDEST")]:
+            if path:
+                for basedir in [Dirpath(path), Dirpath(path, "lib-dynload")]:
+                    if basedir not in ret and basedir.exists():
+                        ret.append(basedir)
+        return ret
+
+    @classmethod
+    def get_module_names(cls):
+        """returns all the top level standard library module names
+
+        this uses sys.stdlib_module_names (python 3.10+) when available,
+        otherwise the standard library directories are scanned
+
+        :returns: frozenset
+        """
+        if cls.module_names is None:
+            # https://stackoverflow.com/a/4927129/5006
+            names = set(sys.builtin_module_names)
+
+            stdlib_names = getattr(sys, "stdlib_module_names", None)
+            if stdlib_names:
+                names.update(stdlib_names)
+
+            else:
+                for basedir in cls.get_basedirs():
+                    for _, name, _ in pkgutil.iter_modules([basedir]):
+                        names.add(name)
+
+            cls.module_names = frozenset(names)
+
+        return cls.module_names
+
+    @classmethod
+    def is_standard_name(cls, name):
+        """return True if the module name (eg, os.path) is part of the standard
+        library"""
+        return name.split(".")[0] in cls.get_module_names()
+
     def __init__(self):
         super(StandardPackages, self).__init__()
 
     def __missing__(self, name):
+        if not self.is_standard_name(name):
+            raise KeyError(name)
+
         ret = None
 
-        # https://stackoverflow.com/a/4927129/5006
-        if name in set(sys.builtin_module_names):
+        if name in sys.builtin_module_names:
             ret = self.package_class(name, None)
 
         if not ret:
-            basedir = Dirpath(sysconfig.get_python_lib(standard_lib=True))
-
-            try:
-                ret = self.package_class(name, basedir)
-            except ValueError:
-                # in a virtual environment this config value can be different
-                # than the configured python lib standard lib path retrieved
-                # above
-                basedir = Dirpath(sysconfig.get_config_var("BINLIBDEST"))
+            for basedir in self.get_basedirs():
                 try:
                     ret = self.package_class(name, basedir)
+                    break
                 except ValueError:
-                    ret = None
+                    pass
 
         if not ret:
             for basedir in self.search_paths():
-                filepath = Filepath(basedir, name, ext="so")
-                if filepath.exists():
+                filepath = Dirindex.get_instance(basedir).find(name)
+                if filepath and filepath.ext == "so":
                     ret = self.package_class(name, basedir)
+                    break
 
         if not ret:
-            raise KeyError(name)
+            # it's part of the standard library but doesn't have a file we can
+            # find (eg, a frozen module) so treat it like a builtin
+            ret = self.package_class(name, None)
 
+        super(Packages, self).__setitem__(name, ret)
         return ret
 
@@ -14,6 +14,20 @@ class Function(object):
         api_name="herd-lambda-api",
         stage="DEFAULT",
         region_name="",
+        frozen=False,
+        treeshake=False,
+        keep=None,
+        extras=None,
+        exclude=None,
+        bytecode=False,
+        optimize=0,
+        drop_sources=False,
+        layer=False,
+        bucket="",
+        wheelhouse="",
+        architecture="x86_64",
+        lazy=None,
+        parse_processes=None,
         **options
     ):
 
@@ -30,7 +44,26 @@ class Function(object):
         #
         # but it worked the second time it was ran
 
-        func = Lambda(filepath, role=role, environ=environ, region_name=region_name)
+        func = Lambda(
+            filepath,
+            role=role,
+            environ=environ,
+            region_name=region_name,
+            frozen=frozen,
+            treeshake=treeshake,
+            keep=keep,
+            extras=extras,
+            exclude=exclude,
+            bytecode=bytecode,
+            optimize=optimize,
+            drop_sources=drop_sources,
+            layer=layer,
+            bucket=bucket,
+            wheelhouse=wheelhouse,
+            architecture=architecture,
+            lazy=lazy,
+            parse_processes=parse_processes,
+        )
         func.save()
 
         api = ApiGateway(api_name, region_name=region_name)
@@ -7,13 +7,23 @@ import sys
 import inspect
 import os
 import re
+import codecs
+import hashlib
+import base64
+import py_compile
+import math
+import fnmatch
+import subprocess
+from zipfile import ZipFile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.exceptions import ClientError
 
 from ...compat import *
-from ...path import Tempdir, Filepath, Path
-from ...reflection import Dependencies
+from ...path import Tempdir, Filepath, Dirpath, Path, Zippath, Exclusions, FragmentCache
+from ...reflection import Dependencies, Lockfile, Treeshake, Marker, Wheelhouse, Packages, Imports
 from ...utils import Environ
 
 
@@ -395,6 +405,264 @@ class ApiGateway(AWS):
             return ret
 
 
+class Layer(AWS):
+    """Represents a lambda layer and its published versions
+
+    a version's description records the digest of what it contains so a
+    version with the same contents can be found and used again instead of
+    publishing a new one
+
+    https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/lambda.html#Lambda.Client.publish_layer_version
+    """
+    client_name = "lambda"
+
+    @property
+    def client(self):
+        return self._client or super(Layer, self).client
+
+    def __init__(self, name, region_name="", client=None):
+        """
+        :param name: string, the layer's name
+        :param region_name: string, see Lambda.__init__()
+        :param client: boto3 lambda client, the function's client is shared
+            with its layer so they always talk to the same place
+        """
+        self.name = name
+        self._region_name = region_name
+        self._client = client
+
+    def _load(self):
+        """returns all the published versions of the layer"""
+        client = self.client
+        ret = {"LayerVersions": []}
+        kwargs = {"LayerName": self.name}
+        while True:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/lambda.html#Lambda.Client.list_layer_versions
+            res = client.list_layer_versions(**kwargs)
+            ret["LayerVersions"].extend(res.get("LayerVersions", []))
+            if res.get("NextMarker", ""):
+                kwargs["Marker"] = res["NextMarker"]
+            else:
+                break
+
+        return ret if ret["LayerVersions"] else {}
+
+    def get_description(self, digest):
+        return "herd {}".format(digest)
+
+    def find_version(self, digest):
+        """find a published version that has the contents that hash to digest
+
+        :param digest: string, see Lambda.get_layer_digest()
+        :returns: string, the version's arn or empty if there isn't one
+        """
+        if self.load():
+            description = self.get_description(digest)
+            for version in self.raw["LayerVersions"]:
+                if version.get("Description", "") == description:
+                    return version["LayerVersionArn"]
+        return ""
+
+    def publish(self, zippath, digest, runtime, bucket=None):
+        """publish a new version of the layer
+
+        :param zippath: string, the layer zip, the files should be in python/
+        :param digest: string, the digest of the zip's contents
+        :param runtime: string, the python runtime the layer is for
+        :param bucket: Bucket, if passed the zip is uploaded to it instead of
+            being sent with the request
+        :returns: string, the new version's arn
+        """
+        if bucket:
+            key = "{}{}/layer.zip".format(bucket.prefix, self.name)
+            bucket.upload(zippath, key)
+            content = {"S3Bucket": bucket.name, "S3Key": key}
+
+        else:
+            with open(zippath, "rb") as fp:
+                content = {"ZipFile": fp.read()}
+
+        res = self.client.publish_layer_version(
+            LayerName=self.name,
+            Description=self.get_description(digest),
+            Content=content,
+            CompatibleRuntimes=[runtime],
+        )
+
+        self.raw = None
+        return res["LayerVersionArn"]
+
+    def delete(self):
+        """delete every published version of the layer
+
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/lambda.html#Lambda.Client.delete_layer_version
+        """
+        if self.load():
+            client = self.client
+            for version in self.raw["LayerVersions"]:
+                client.delete_layer_version(LayerName=self.name, VersionNumber=version["Version"])
+        self.raw = None
+
+
+class Bucket(AWS):
+    """Represents the s3 bucket lambda code is staged in
+
+    lambda only accepts 50MB of zipped code with the request, bigger bundles
+    have to be uploaded to s3 first. Files bigger than .part_size are uploaded
+    in parts by .workers threads so only a few parts are in memory at a time,
+    and the object remembers the checksum of the file so uploading the same
+    file again is skipped
+
+    https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.create_multipart_upload
+    """
+    client_name = "s3"
+
+    part_size = 16 * 1024 * 1024
+    """int, the bytes in every part of a multipart upload, s3 needs every part
+    but the last to be at least 5MB"""
+
+    workers = 8
+    """int, how many parts are uploaded at the same time"""
+
+    prefix = "herd/"
+    """string, the objects herd uploads have keys that start with this"""
+
+    checksum_key = "herd-sha256"
+    """string, the object metadata the file's checksum is kept in"""
+
+    @property
+    def client(self):
+        return self._client or super(Bucket, self).client
+
+    def __init__(self, name, region_name="", client=None):
+        """
+        :param name: string, the bucket's name, the bucket has to exist
+        :param region_name: string, see Lambda.__init__()
+        :param client: boto3 s3 client
+        """
+        self.name = name
+        self._region_name = region_name
+        self._client = client
+
+    def _load(self):
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.head_bucket
+        return self.client.head_bucket(Bucket=self.name)
+
+    def get_checksum(self, path):
+        """returns the base64 encoded sha256 digest of the file at path, this is
+        what lambda reports as CodeSha256
+
+        :param path: string, the file
+        :returns: string
+        """
+        h = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                h.update(chunk)
+        return base64.b64encode(h.digest()).decode("ascii")
+
+    def get_object_checksum(self, key):
+        """returns the checksum of the file that was uploaded to key
+
+        :param key: string, the object's key
+        :returns: string, empty if there is no object or it has no checksum
+        """
+        try:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.head_object
+            res = self.client.head_object(Bucket=self.name, Key=key)
+
+        except ClientError as e:
+            return ""
+
+        return res.get("Metadata", {}).get(self.checksum_key, "")
+
+    def upload(self, path, key, checksum=""):
+        """upload the file at path to key unless it is already there
+
+        :param path: string, the file
+        :param key: string, the object's key
+        :param checksum: string, the file's checksum if it is already known,
+            see .get_checksum()
+        :returns: boolean, True if the file was uploaded, False if the object
+            already had the same checksum
+        """
+        checksum = checksum or self.get_checksum(path)
+        if checksum == self.get_object_checksum(key):
+            logger.info("Skipping upload of {} to s3://{}/{}, it is unchanged ({})".format(
+                path,
+                self.name,
+                key,
+                checksum,
+            ))
+            return False
+
+        size = os.path.getsize(path)
+        metadata = {self.checksum_key: checksum}
+        client = self.client
+        if size <= self.part_size:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.put_object
+            with open(path, "rb") as fp:
+                client.put_object(Bucket=self.name, Key=key, Body=fp, Metadata=metadata)
+
+        else:
+            self.upload_parts(path, key, size, metadata)
+
+        logger.info("Uploaded {} ({} bytes) to s3://{}/{}".format(path, size, self.name, key))
+        return True
+
+    def upload_parts(self, path, key, size, metadata):
+        """upload the file at path to key using a multipart upload, the upload
+        is aborted if any part fails
+
+        :param path: string, the file
+        :param key: string, the object's key
+        :param size: int, the file's size
+        :param metadata: dict, the object's metadata
+        """
+        client = self.client
+        upload_id = client.create_multipart_upload(
+            Bucket=self.name,
+            Key=key,
+            Metadata=metadata,
+        )["UploadId"]
+
+        def upload_part(part_number):
+            # every thread reads its own part so only the parts that are being
+            # uploaded are in memory
+            with open(path, "rb") as fp:
+                fp.seek((part_number - 1) * self.part_size)
+                body = fp.read(self.part_size)
+
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_part
+            res = client.upload_part(
+                Bucket=self.name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )
+            return {"PartNumber": part_number, "ETag": res["ETag"]}
+
+        part_count = (size + self.part_size - 1) // self.part_size
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+                parts = list(executor.map(upload_part, range(1, part_count + 1)))
+
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.complete_multipart_upload
+            client.complete_multipart_upload(
+                Bucket=self.name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+
+        except Exception:
+            # the parts of an incomplete upload are kept (and billed) until
+            # it is aborted
+            client.abort_multipart_upload(Bucket=self.name, Key=key, UploadId=upload_id)
+            raise
+
+
 class Lambda(AWS):
     """Represents a lambda function
 
@@ -403,6 +671,52 @@ class Lambda(AWS):
 
     timeout = 300 # Maximum allowable timeout
 
+    dependency_workers = 8
+    """int, how many threads are used to resolve the dependencies, see Dependencies"""
+
+    parse_processes = 0
+    """int, how many processes parse the modules of big dependencies, 0 parses
+    them in this process, see Dependencies"""
+
+    import_scanner = "ast"
+    """string, how modules are scanned for imports, see Imports"""
+
+    exclude_defaults = True
+    """boolean, False to bundle the files the Exclusions default rules would exclude"""
+
+    compress_workers = None
+    """int, how many threads compress the bundle, defaults to Zippath.workers"""
+
+    compress_level = None
+    """int, the zlib level the bundle is compressed with, defaults to Zippath.level"""
+
+    cache_fragments = True
+    """boolean, False to compress every dependency again instead of reusing
+    the compressed files of previous bundles, see FragmentCache"""
+
+    platform = {
+        "os_name": "posix",
+        "sys_platform": "linux",
+        "platform_system": "Linux",
+        "platform_machine": "x86_64",
+        "platform_python_implementation": "CPython",
+        "implementation_name": "cpython",
+    }
+    """dict, the PEP 508 marker variables of the lambda runtime that can be
+    different from this machine, see Marker.get_environment()"""
+
+    bootstrap_module = "herd_bootstrap"
+    """string, the module lambda calls the handler from when .lazy is set"""
+
+    runtime_packages = ["boto3", "botocore", "s3transfer", "jmespath", "dateutil", "six", "urllib3"]
+    """list, the packages the lambda python runtime provides, see .unpack()"""
+
+    machines = {
+        "x86_64": "x86_64",
+        "arm64": "aarch64",
+    }
+    """dict, the lambda architectures and the machine linux reports for them"""
+
     @property
     def arn(self):
         # ARN format="arn:aws:lambda:REGION:ACCOUNT_ID:function:FUNCTION_NAME"
@@ -414,11 +728,40 @@ class Lambda(AWS):
         return "python{}.{}".format(info.major, info.minor)
         #return os.path.basename(sys.executable)
 
+    @property
+    def environment(self):
+        """the marker variables dependency requirements are checked against"""
+        platform = dict(self.platform)
+        platform["platform_machine"] = self.machines[self.architecture]
+        return Marker.get_environment(self.runtime, **platform)
+
     @property
     def handler(self):
-        return "{}.{}".format(self.module_name, self.function_name)
+        module_name = self.bootstrap_module if self.lazy else self.module_name
+        return "{}.{}".format(module_name, self.function_name)
+
+    @property
+    def lockfile(self):
+        """the lockfile next to the handler file that records the resolved
+        dependencies, see Dependencies"""
+        return Lockfile(self.filepath.dirname, "{}.herd.lock".format(self.filepath.fileroot))
+
+    @property
+    def layer_name(self):
+        """the name of the layer the dependencies are published to"""
+        return "{}-dependencies".format(self.name)
 
-    def __init__(self, filepath, role, environ=None, name="", region_name=""):
+    @property
+    def exclusions(self):
+        """the rules for the files that won't be bundled, these are the default
+        rules, then the exclude rules, then the rules in .herdignore and
+        FILEROOT.herdignore next to the handler file"""
+        ret = Exclusions(self.exclude, defaults=self.exclude_defaults)
+        ret.add_file(Filepath(self.filepath.dirname, ".herdignore"))
+        ret.add_file(Filepath(self.filepath.dirname, "{}.herdignore".format(self.filepath.fileroot)))
+        return ret
+
+    def __init__(self, filepath, role, environ=None, name="", region_name="", frozen=False, treeshake=False, keep=None, extras=None, exclude=None, bytecode=False, optimize=0, drop_sources=False, layer=False, bucket=None, wheelhouse="", architecture="x86_64", lazy=None, parse_processes=None):
         """create a representation of the lambda function that will run filepath
 
         :param filepath: string, the file path to a python file that will uploaded
@@ -431,6 +774,37 @@ class Lambda(AWS):
             name than the basename of the filepath
         :param region_name: if you want to use a different region name then the 
             default defined in aws config or AWS_DEFAULT_REGION
+        :param frozen: boolean, if True then bundling fails if the lockfile is
+            missing or out of date instead of resolving the dependencies again
+        :param treeshake: boolean, if True then only the dependency modules that
+            are reachable from filepath are bundled, see Treeshake
+        :param keep: list, fnmatch patterns of dynamically imported modules and
+            data files that should be bundled when treeshake is True
+        :param extras: list, the distribution extras that should be bundled
+            (eg, requests[socks])
+        :param exclude: list, glob rules for more files that shouldn't be
+            bundled, see Exclusions
+        :param bytecode: boolean, if True then the python files are compiled
+            and the bytecode is bundled so lambda doesn't have to compile the
+            modules every cold start
+        :param optimize: int, the bytecode optimization level, 1 is like
+            python -O and 2 is like python -OO
+        :param drop_sources: boolean, if True then only the bytecode of the
+            dependencies is bundled, not their python files
+        :param layer: boolean, if True then the site package dependencies are
+            published as a layer that is only published again when they change,
+            and the function's zip only has the handler and local modules
+        :param bucket: string|Bucket, the s3 bucket the code is uploaded to
+            before lambda is updated, this is needed for bundles bigger than
+            the 50MB lambda accepts with the request
+        :param wheelhouse: string, a directory of wheels built for lambda (eg,
+            manylinux wheels), the site package dependencies are bundled from
+            their compatible wheel instead of from this machine
+        :param architecture: string, the lambda architecture, x86_64 or arm64
+        :param lazy: list, fnmatch patterns matched against the top level
+            packages the handler imports, matching packages are imported lazily
+            by a bootstrap module so they are only loaded when first used
+        :param parse_processes: int, see .parse_processes
         """
         # ??? -- we could also do this with regex looking for def NAME(event, context):
         # but that would make getting the description harder
@@ -438,6 +812,35 @@ class Lambda(AWS):
         self._region_name = region_name
         self.role = role
         self.environ = Environ(environ or {})
+        self.frozen = frozen
+        self.treeshake = treeshake
+        self.keep = keep or []
+        self.extras = extras or []
+        self.exclude = exclude or []
+        self.bytecode = bytecode
+        self.optimize = optimize
+        self.drop_sources = drop_sources
+        self.layer = layer
+        if bucket and not isinstance(bucket, Bucket):
+            bucket = Bucket(bucket, region_name=region_name)
+        self.bucket = bucket
+        if architecture not in self.machines:
+            raise ValueError("Unknown lambda architecture {}, use one of {}".format(
+                architecture,
+                ", ".join(sorted(self.machines)),
+            ))
+        self.architecture = architecture
+        self.wheelhouse = wheelhouse
+        self.lazy = lazy or []
+        if parse_processes is not None:
+            self.parse_processes = parse_processes
+        self.entry_groups = {}
+        self.layer_entries = {}
+        self.layer_digest = ""
+        self.excluded = {}
+        self.manifest = {}
+        self.dependencies = None
+        self.wheels = {}
         self.ignore_dependencies = [
             r"^boto3(?:\.|$)",
             r"^botocore(?:\.|$)",
@@ -465,50 +868,620 @@ class Lambda(AWS):
         else:
             self.name = self.module_name
 
+    def compile(self, entries, manifest, basedir):
+        """compile the python files in entries and add their bytecode
+
+        the bytecode is put where lambda's python will use it, in __pycache__
+        next to the source or in place of the source if .drop_sources is True.
+        The optimized bytecode is named like the unoptimized bytecode since
+        lambda doesn't run python with -O. The handler's source is always kept
+
+        :param entries: dict, relpath keys and Filepath values, this is changed
+        :param manifest: dict, see .bundle(), this is changed
+        :param basedir: string, the bytecode files are written in here
+        """
+        count = 0
+        tag = sys.implementation.cache_tag
+        for relpath, path in sorted(entries.items()):
+            if not relpath.endswith(".py"):
+                continue
+
+            drop_source = self.drop_sources and relpath != self.filepath.basename
+            if drop_source:
+                pyc_relpath = "{}c".format(relpath)
+
+            else:
+                dirname, basename = os.path.split(relpath)
+                pyc_relpath = "/".join(bit for bit in [
+                    dirname,
+                    "__pycache__",
+                    "{}.{}.pyc".format(basename[:-3], tag),
+                ] if bit)
+
+            try:
+                pyc_path = path.compile_to(
+                    Filepath(basedir, "bytecode", pyc_relpath),
+                    dfile=relpath,
+                    optimize=self.optimize,
+                )
+
+            except py_compile.PyCompileError as e:
+                # some packages have files that aren't meant for this python
+                logger.debug("Bundling {} without bytecode: {}".format(relpath, e))
+                continue
+
+            # the bytecode has the source's mtime so its cache key only
+            # changes when the source does, see FragmentCache
+            st = os.stat(path)
+            os.utime(pyc_path, (st.st_atime, st.st_mtime))
+            entries[pyc_relpath] = pyc_path
+            manifest[pyc_relpath] = (manifest[relpath][0], os.path.getsize(pyc_path))
+            if drop_source:
+                entries.pop(relpath)
+                manifest.pop(relpath)
+            count += 1
+
+        logger.info("Compiled {} python files to bytecode".format(count))
+
+    def get_lazy_modules(self):
+        """returns the top level packages the handler imports that match .lazy
+
+        :returns: list, the sorted package names
+        """
+        names = set(name.split(".")[0] for name in Imports(self.filepath, scanner=self.import_scanner))
+        ret = set()
+        for pattern in self.lazy:
+            matches = [name for name in names if fnmatch.fnmatchcase(name, pattern)]
+            if not matches:
+                logger.warning("Lazy import pattern {} doesn't match anything {} imports".format(
+                    pattern,
+                    self.filepath.basename,
+                ))
+            ret.update(matches)
+        return sorted(ret)
+
+    def write_bootstrap(self, basedir):
+        """write the module that makes the lazy packages lazy and then imports
+        the handler, lambda calls the handler through it, see .handler
+
+        the packages get importlib's LazyLoader so they are only executed when
+        one of their attributes is first used, importing one of their
+        submodules (eg, import foo.bar) needs the package so it is executed
+        then. A package the handler uses in every request gains nothing and a
+        package that runs code that has to happen at import (eg, registering
+        plugins) shouldn't be lazy
+
+        :param basedir: string, the module is written in here
+        :returns: Filepath, the bootstrap module
+        """
+        names = self.get_lazy_modules()
+        lines = [
+            "# -*- coding: utf-8 -*-",
+            "# generated by herd, lambda calls {}.{} through this module".format(
+                self.module_name,
+                self.function_name,
+            ),
+            "import sys",
+            "import importlib.util",
+            "",
+            "",
+            "def lazy(name):",
+            "    if name in sys.modules:",
+            "        return",
+            "    spec = importlib.util.find_spec(name)",
+            "    if spec is None or spec.loader is None:",
+            "        return",
+            "    spec.loader = importlib.util.LazyLoader(spec.loader)",
+            "    module = importlib.util.module_from_spec(spec)",
+            "    sys.modules[name] = module",
+            "    spec.loader.exec_module(module)",
+            "",
+            "    class LazyModule(type(module)):",
+            "        def __getattribute__(self, attr):",
+            "            # import statements read these so they can't load the module",
+            "            if attr in ('__spec__', '__name__'):",
+            "                return object.__getattribute__(self, attr)",
+            "            return super(LazyModule, self).__getattribute__(attr)",
+            "",
+            "    module.__class__ = LazyModule",
+            "",
+            "",
+            "for name in {!r}:".format([String(name) for name in names]),
+            "    lazy(name)",
+            "",
+            "from {} import {}".format(self.module_name, self.function_name),
+            "",
+        ]
+
+        ret = Filepath(basedir, "{}.py".format(self.bootstrap_module))
+        with codecs.open(ret, mode="w", encoding="UTF-8") as fp:
+            fp.write("\n".join(lines))
+
+        logger.info("Bootstrap {} imports {} lazily".format(
+            ret.basename,
+            ", ".join(names) if names else "nothing",
+        ))
+        return ret
+
+    def get_layer_digest(self, entries):
+        """returns a digest of the runtime and every file of the layer, this
+        doesn't change unless what the layer would contain changes
+
+        :param entries: dict, relpath keys and Filepath values
+        :returns: string, the hex digest
+        """
+        h = hashlib.sha256()
+        h.update(self.runtime.encode("utf-8"))
+        for relpath in sorted(entries):
+            with open(entries[relpath], "rb") as fp:
+                file_digest = hashlib.sha256(fp.read()).hexdigest()
+            h.update("\n{}\t{}".format(relpath, file_digest).encode("utf-8"))
+        return h.hexdigest()
+
+    def get_layers(self, arn=""):
+        """returns the layers the function should have, the layers that herd
+        didn't publish (eg, extensions or monitoring agents) are always kept
+
+        :param arn: string, the dependency layer version, see .save_layer(),
+            empty removes the dependency layer if the function has it
+        :returns: list, the layer version arns or None if the function's layers
+            shouldn't change
+        """
+        current = []
+        if self.exists():
+            current = [layer["Arn"] for layer in self.raw["Configuration"].get("Layers", None) or []]
+
+        ret = []
+        prefix = ":layer:{}:".format(self.layer_name)
+        for layer_arn in current:
+            if prefix in layer_arn:
+                # the dependency layer keeps its place
+                if arn and arn not in ret:
+                    ret.append(arn)
+
+            else:
+                ret.append(layer_arn)
+
+        if arn and arn not in ret:
+            ret.append(arn)
+
+        return None if ret == current else ret
+
+    def save_layer(self, basedir):
+        """find or publish the layer version that has .layer_entries
+
+        :param basedir: string, the layer zip is written in here if it needs
+            to be published
+        :returns: string, the layer version arn
+        """
+        layer = Layer(self.layer_name, region_name=self._region_name, client=self.client)
+        arn = layer.find_version(self.layer_digest)
+        if arn:
+            logger.info("Using layer {} for {}, dependencies are unchanged".format(arn, self.name))
+
+        else:
+            # lambda puts layers in /opt and /opt/python is in sys.path
+            zippath = Zippath(basedir, "layer.zip")
+            self.write_zip(zippath, self.layer_entries, prefix="python/")
+            arn = layer.publish(zippath, self.layer_digest, self.runtime, bucket=self.bucket)
+            logger.info("Published layer {} for {} ({} bytes)".format(
+                arn,
+                self.name,
+                os.path.getsize(zippath),
+            ))
+
+        return arn
+
+    def write_zip(self, zippath, entries, prefix=""):
+        """write entries to zippath, reusing the cached compressed files of
+        the dependencies that haven't changed if .cache_fragments is True
+
+        :param zippath: Zippath, the zip file that will be written
+        :param entries: dict, relpath keys and Filepath values
+        :param prefix: string, put in front of every relpath in the zip
+        """
+        cache = FragmentCache() if self.cache_fragments else None
+        zippath.write(
+            (
+                (path, "{}{}".format(prefix, relpath), self.entry_groups.get(relpath, ""))
+                for relpath, path in entries.items()
+            ),
+            workers=self.compress_workers,
+            level=self.compress_level,
+            cache=cache,
+        )
+        if cache:
+            logger.debug("Reused {} of {} cached dependency fragments for {}".format(
+                cache.hits,
+                cache.hits + cache.misses,
+                zippath,
+            ))
+
+    def report(self):
+        """bundle the function and break the bundle down by package, this
+        doesn't talk to AWS
+
+        :returns: list, a dict for every package (and the handler's module)
+            sorted by compressed bytes, biggest first
+        """
+        zippath = self.bundle()
+        compressed = {}
+        with ZipFile(zippath) as z:
+            for info in z.infolist():
+                compressed[info.filename] = info.compress_size
+
+        d = self.dependencies
+        required_by = d.required_by()
+        rows = {
+            self.module_name: {
+                "name": self.module_name,
+                "version": "",
+                "source": "handler",
+                "files": 0,
+                "bytes": 0,
+                "compressed_bytes": 0,
+                "required_by": [],
+                "shared_library": False,
+            }
+        }
+        for p in d:
+            name = String(p)
+            if name in self.wheels:
+                source = ", ".join(wheel.basename for wheel in self.wheels[name])
+            else:
+                source = "site" if p.is_site() else "local"
+
+            rows[name] = {
+                "name": name,
+                "version": p.version,
+                "source": source,
+                "files": 0,
+                "bytes": 0,
+                "compressed_bytes": 0,
+                "required_by": [n or self.module_name for n in required_by.get(name, [])],
+                "shared_library": p.has_shared_library(),
+            }
+
+        for relpath, (name, size) in self.manifest.items():
+            row = rows[name]
+            row["files"] += 1
+            row["bytes"] += size
+            # files in the layer aren't in the function's zip
+            row["compressed_bytes"] += compressed.get(relpath, 0)
+
+        return sorted(
+            rows.values(),
+            key=lambda row: (row["compressed_bytes"], row["bytes"], row["name"]),
+            reverse=True,
+        )
+
+    @contextmanager
+    def unpack(self):
+        """bundle the function and lay it out like lambda would so it can be
+        run on this machine
+
+        the bundle is unzipped into a read-only directory like /var/task, the
+        layer files go where /opt/python would be, and the packages the lambda
+        runtime provides (see .runtime_packages) are linked into a directory
+        like /var/runtime. Everything is removed when the context exits
+
+        :returns: list, the directories that go first in sys.path, in order
+        """
+        zippath = self.bundle()
+        basedir = zippath.dirname
+        taskdir = Tempdir("task", dir=basedir)
+        with ZipFile(zippath) as z:
+            z.extractall(taskdir)
+        ret = [taskdir]
+
+        if self.layer_entries:
+            optdir = Dirpath(basedir, "opt", "python")
+            for relpath, path in self.layer_entries.items():
+                path.copy_to(Path(optdir, relpath))
+            ret.append(optdir)
+
+        runtimedir = Tempdir("runtime", dir=basedir)
+        packages = Packages()
+        for name in self.runtime_packages:
+            try:
+                p = packages[name]
+            except (KeyError, ValueError):
+                continue
+            if p.path:
+                os.symlink(p.path, os.path.join(runtimedir, p.path.basename))
+        ret.append(runtimedir)
+
+        # /var/task is read-only on lambda
+        for root_dir, dirs, files in os.walk(taskdir):
+            for basename in files:
+                os.chmod(os.path.join(root_dir, basename), 0o444)
+            os.chmod(root_dir, 0o555)
+
+        try:
+            yield ret
+
+        finally:
+            for root_dir, dirs, files in os.walk(taskdir):
+                os.chmod(root_dir, 0o755)
+            basedir.delete()
+
+    def get_code(self, zippath, code_sha256, zipped_code=None):
+        """returns the Code that lambda will be updated with, if .bucket is set
+        then the zip is uploaded to it unless it is already there
+
+        :param zippath: string, the bundle
+        :param code_sha256: string, the bundle's checksum
+        :param zipped_code: bytes, the bundle's contents if it was already read
+        :returns: dict
+        """
+        if self.bucket:
+            key = "{}{}/lambda.zip".format(self.bucket.prefix, self.name)
+            self.bucket.upload(zippath, key, code_sha256)
+            return {"S3Bucket": self.bucket.name, "S3Key": key}
+
+        if zipped_code is None:
+            with open(zippath, "rb") as fp:
+                zipped_code = fp.read()
+        return {"ZipFile": zipped_code}
+
+    def get_code_sha256(self, zipped_code):
+        """returns the hash of zipped_code the way lambda reports it as CodeSha256
+
+        :param zipped_code: bytes, the contents of the zip file
+        :returns: string, the base64 encoded sha256 digest
+        """
+        return base64.b64encode(hashlib.sha256(zipped_code).digest()).decode("ascii")
+
     def _load(self):
         client = self.client
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/lambda.html#Lambda.Client.get_function
         return client.get_function(FunctionName=self.name)
 
-    def bundle(self):
-        basedir = Tempdir("lambda")
-        #zip_filepath = os.path.join(basedir, "lambda.zip")
-        bundle_dir = Tempdir("bundle", dir=basedir)
+    def bundle(self, staging=False, dry_run=False):
+        """bundle the handler and all its dependencies into a zip file
+
+        the files are written straight into the zip under their archive names,
+        how many files and bytes each exclusion rule left out is put in
+        .excluded
 
-        self.filepath.copy_to(Path(bundle_dir, self.filepath.basename))
+        :param staging: boolean, if True then the bundled files are also copied
+            into a bundle directory next to the zip so they can be inspected
+        :param dry_run: boolean, if True then the reports are written but the
+            zip isn't
+        :returns: Zippath, the zip file or None if dry_run is True, if .layer
+            is True then the site package files are put in .layer_entries
+            instead of the zip
+        """
+        basedir = Tempdir("lambda")
 
-        d = Dependencies(self.filepath, self.ignore_dependencies)
+        d = Dependencies(
+            self.filepath,
+            self.ignore_dependencies,
+            workers=self.dependency_workers,
+            scanner=self.import_scanner,
+            lockfile=self.lockfile,
+            frozen=self.frozen,
+            environment=self.environment,
+            extras=self.extras,
+            processes=self.parse_processes,
+        )
 
+        shaker = Treeshake(self.filepath, d, self.keep) if self.treeshake else None
+        wheelhouse = Wheelhouse(
+            self.wheelhouse,
+            self.runtime,
+            self.machines[self.architecture]
+        ) if self.wheelhouse else None
+        wheels = {}
+
+        exclusions = self.exclusions
+        excluded = []
+        entries = {self.filepath.basename: self.filepath}
+        manifest = {self.filepath.basename: (self.module_name, os.path.getsize(self.filepath))}
+        if self.lazy:
+            bootstrap = self.write_bootstrap(basedir)
+            entries[bootstrap.basename] = bootstrap
+            manifest[bootstrap.basename] = (self.module_name, os.path.getsize(bootstrap))
         for p in d:
-            if p.has_shared_library():
+            files = None
+            if wheelhouse and p.is_site():
+                # a namespace package is only bundled from the wheelhouse if
+                # every distribution that installed it has a wheel there
+                found = []
+                for infopath in p.infopaths:
+                    wheel = wheelhouse.find(infopath.name, infopath.version)
+                    if wheel:
+                        found.append(wheel)
+
+                    elif p.has_shared_library():
+                        raise ValueError("No {} {} wheel of {} {} in wheelhouse {}".format(
+                            self.runtime,
+                            self.architecture,
+                            infopath.name,
+                            infopath.version,
+                            wheelhouse,
+                        ))
+
+                if found and len(found) == len(p.infopaths):
+                    logger.debug("Bundling dependency {} from {}".format(
+                        p,
+                        ", ".join(wheel.basename for wheel in found),
+                    ))
+                    wheels[String(p)] = found
+                    files = {}
+                    for wheel in found:
+                        for path, relpath in wheel.files():
+                            files.setdefault(relpath, path)
+                    files = [(path, relpath) for relpath, path in files.items()]
+
+            if files is None and p.has_shared_library():
                 logger.warning("Dependency {} has a shared library (.so file) and might not work in Lambda".format(p))
-            p.path.copy_to(Path(bundle_dir, p.path.basename))
-
-        # get rid of *.pyc files
-        for root, dirnames, filenames in bundle_dir:
-            for filename in filenames:
-                if filename.endswith(".pyc"):
-                    filepath = Filepath(root, filename)
-                    filepath.delete()
 
-        logger.debug("Bundled lambda function to {}".format(bundle_dir))
-        return bundle_dir.zip_to(Filepath(basedir, "lambda.zip"))
+            if files is None:
+                files = list(p.files())
+
+            # a package's test or doc subpackages are imported so they are kept
+            packages = exclusions.get_packages(relpath for path, relpath in files)
+            for path, relpath in (shaker.files(p, files) if shaker else files):
+                if relpath not in manifest:
+                    rule = exclusions.match(relpath, packages)
+                    if rule:
+                        excluded.append((relpath, os.path.getsize(path), rule))
+
+                    else:
+                        entries[relpath] = path
+                        manifest[relpath] = (String(p), os.path.getsize(path))
+
+        if self.bytecode:
+            self.compile(entries, manifest, basedir)
+
+        self.manifest = manifest
+        self.dependencies = d
+        self.wheels = wheels
+
+        if staging:
+            bundle_dir = Tempdir("bundle", dir=basedir)
+            for relpath, path in entries.items():
+                path.copy_to(Path(bundle_dir, relpath))
+            logger.debug("Staged lambda function bundle to {}".format(bundle_dir))
+
+        # the manifest lists every bundled file so builds can be compared
+        manifest_path = Filepath(basedir, "lambda.manifest")
+        with codecs.open(manifest_path, mode="w", encoding="UTF-8") as fp:
+            for relpath in sorted(manifest):
+                fp.write("{}\t{}\t{}\n".format(relpath, manifest[relpath][1], manifest[relpath][0]))
+
+        if d.dropped:
+            # the dropped report lists the requirements that won't be installed
+            # on lambda so their packages weren't followed
+            dropped_path = Filepath(basedir, "lambda.dropped")
+            with codecs.open(dropped_path, mode="w", encoding="UTF-8") as fp:
+                for p, r, reason in d.dropped:
+                    fp.write("{}\t{}\t{}\n".format(p, r, reason))
+
+            logger.info("Dropped {} requirements that lambda would not install, see {}".format(
+                len(d.dropped),
+                dropped_path,
+            ))
+
+        self.excluded = {}
+        if excluded:
+            # the excluded report lists every file an exclusion rule left out
+            excluded_path = Filepath(basedir, "lambda.excluded")
+            with codecs.open(excluded_path, mode="w", encoding="UTF-8") as fp:
+                for relpath, size, rule in sorted(excluded):
+                    fp.write("{}\t{}\t{}\n".format(relpath, size, rule))
+                    self.excluded.setdefault(rule, [0, 0])
+                    self.excluded[rule][0] += 1
+                    self.excluded[rule][1] += size
+
+            logger.info("Excluded {} files ({} bytes), see {}".format(
+                len(excluded),
+                sum(size for relpath, size, rule in excluded),
+                excluded_path,
+            ))
+
+        if shaker:
+            # the pruned report lists everything tree shaking left out in case
+            # something that is imported dynamically needs to be kept
+            pruned_path = Filepath(basedir, "lambda.pruned")
+            pruned_size = 0
+            with codecs.open(pruned_path, mode="w", encoding="UTF-8") as fp:
+                for path, relpath in sorted(shaker.pruned, key=lambda t: t[1]):
+                    size = os.path.getsize(path)
+                    pruned_size += size
+                    fp.write("{}\t{}\n".format(relpath, size))
+
+            logger.info("Tree shaking pruned {} files ({} bytes), see {}".format(
+                len(shaker.pruned),
+                pruned_size,
+                pruned_path,
+            ))
+
+        # files of the same package are cached together, the handler isn't
+        # cached since it is what usually changes between bundles
+        groups = dict(
+            (String(p), "{}=={} {}".format(
+                p,
+                ", ".join(wheel.basename for wheel in wheels[String(p)]) if String(p) in wheels else p.version,
+                self.optimize if self.bytecode else "-"
+            ))
+            for p in d
+        )
+        self.entry_groups = {}
+        for relpath in entries:
+            group = groups.get(manifest[relpath][0], "")
+            if group:
+                self.entry_groups[relpath] = group
+
+        self.layer_entries = {}
+        self.layer_digest = ""
+        if self.layer:
+            site = set(String(p) for p in d if p.is_site())
+            for relpath in list(entries.keys()):
+                if manifest[relpath][0] in site:
+                    self.layer_entries[relpath] = entries.pop(relpath)
+            self.layer_digest = self.get_layer_digest(self.layer_entries)
+            logger.debug("Layer for {} has {} files with digest {}".format(
+                self.name,
+                len(self.layer_entries),
+                self.layer_digest,
+            ))
+
+        if dry_run:
+            logger.debug("Dry run of lambda function bundle with manifest {}".format(manifest_path))
+            return None
+
+        zippath = Zippath(basedir, "lambda.zip")
+        self.write_zip(zippath, entries)
+        logger.debug("Bundled lambda function to {} with manifest {}".format(zippath, manifest_path))
+        return zippath
 
     def save(self):
         role = self.role
         client = self.client
 
         zipfilepath = self.bundle()
-        with open(zipfilepath, 'rb') as f:
-            zipped_code = f.read()
+        zipped_code = None
+        if self.bucket:
+            # the bundle is streamed to s3 so it is never all in memory
+            code_sha256 = self.bucket.get_checksum(zipfilepath)
+
+        else:
+            with open(zipfilepath, 'rb') as f:
+                zipped_code = f.read()
+            code_sha256 = self.get_code_sha256(zipped_code)
+
+        layer_arn = ""
+        if self.layer and self.layer_entries:
+            layer_arn = self.save_layer(zipfilepath.dirname)
+
+        # Layers is only sent when the dependency layer is added, changed or
+        # removed so the layers herd didn't add are left alone
+        layers = self.get_layers(layer_arn)
+        layer_kwargs = {} if layers is None else {"Layers": layers}
 
         if self.exists():
             # update
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/lambda.html#Lambda.Client.update_function_code
-            res = client.update_function_code(
-                FunctionName=self.name,
-                ZipFile=zipped_code
-            )
+            # the bundle is reproducible so if the hashes match the code hasn't
+            # changed and there is no reason to upload it again
+            update_code = code_sha256 != self.raw["Configuration"].get("CodeSha256", "")
+            if not update_code:
+                logger.info("Skipping code upload for {}, code is unchanged ({})".format(
+                    self.name,
+                    code_sha256
+                ))
+
+            # code that needs a layer is uploaded after the layer is added and
+            # code that doesn't is uploaded before a layer is removed so the
+            # function always has its dependencies
+            if update_code and not layer_arn:
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/lambda.html#Lambda.Client.update_function_code
+                res = client.update_function_code(
+                    FunctionName=self.name,
+                    Architectures=[self.architecture],
+                    **self.get_code(zipfilepath, code_sha256, zipped_code)
+                )
 
             # /v1/documentation/api/latest/reference/services/lambda.html#Lambda.Client.update_function_configuration
             res = client.update_function_configuration(
@@ -519,7 +1492,17 @@ class Lambda(AWS):
                 Timeout=self.timeout,
                 Description=Description(self.description),
                 Environment={"Variables": self.environ},
+                **layer_kwargs
             )
+            self.raw["Configuration"] = res
+
+            if update_code and layer_arn:
+                res = client.update_function_code(
+                    FunctionName=self.name,
+                    Architectures=[self.architecture],
+                    **self.get_code(zipfilepath, code_sha256, zipped_code)
+                )
+                self.raw["Configuration"] = res
 
         else:
             # create
@@ -529,15 +1512,17 @@ class Lambda(AWS):
                 Runtime=self.runtime,
                 Role=role.arn,
                 Handler=self.handler,
-                Code={
-                    "ZipFile": zipped_code
-                },
+                Code=self.get_code(zipfilepath, code_sha256, zipped_code),
+                Architectures=[self.architecture],
                 Timeout=self.timeout,
                 Description=Description(self.description),
                 Environment={"Variables": self.environ},
+                **layer_kwargs
             )
 
-            self.raw = res
+            # get_function() nests the configuration that create_function()
+            # returns in Configuration
+            self.raw = {"Configuration": res}
 
     def run(self, **kwargs):
         ret = {}
@@ -564,3 +1549,191 @@ class Lambda(AWS):
         self.client.delete_function(FunctionName=self.name)
 
 
+
+class ImportProfile(object):
+    """Imports the handler of a lambda function's bundle in a fresh python
+    process, like lambda does on a cold start, to find what importing it costs
+
+    the handler is imported from the unpacked bundle, see Lambda.unpack(),
+    by the same runtime.py that herd serve uses. The site packages of this
+    machine are never in sys.path so anything the bundle is missing fails like
+    it would on lambda
+
+    https://docs.python.org/3/using/cmdline.html#cmdoption-X
+    """
+    timeout = 60
+    """int, how many seconds each import can take"""
+
+    marker = "herd-import-start"
+    """string, written to stderr right before the handler is imported so the
+    imports runtime.py made can be told apart from the handler's"""
+
+    @classmethod
+    def parse_importtime(cls, output):
+        """parse the -X importtime output of one import into a tree
+
+        python writes a line when each import finishes so a module's line
+        comes after the lines of the modules it imported
+
+        :param output: string, the importtime lines
+        :returns: list, (depth, name, self microseconds, cumulative microseconds)
+            tuples with every module before the modules it imported
+        """
+        lines = []
+        for line in output.splitlines(False):
+            if line.startswith("import time:") and "|" in line:
+                bits = line[len("import time:"):].split("|")
+                try:
+                    us = int(bits[0])
+                    cumulative_us = int(bits[1])
+                except ValueError:
+                    # the header line
+                    continue
+
+                name = bits[2].rstrip()
+                lines.append(((len(name) - len(name.lstrip())) // 2, name.strip(), us, cumulative_us))
+
+        if not lines:
+            return []
+
+        base = min(line[0] for line in lines)
+        pending = {}
+        for depth, name, us, cumulative_us in lines:
+            depth -= base
+            node = ((depth, name, us, cumulative_us), pending.pop(depth + 1, []))
+            pending.setdefault(depth, []).append(node)
+
+        ret = []
+        stack = list(reversed(pending.get(0, [])))
+        while stack:
+            line, children = stack.pop()
+            ret.append(line)
+            stack.extend(reversed(children))
+        return ret
+
+    @classmethod
+    def get_percentile(cls, values, percent):
+        """returns the nearest rank percentile of values
+
+        :param values: list, numbers
+        :param percent: int, 50 is the median
+        :returns: number
+        """
+        values = sorted(values)
+        index = max(0, int(math.ceil(len(values) * percent / 100.0)) - 1)
+        return values[index]
+
+    def __init__(self, func):
+        """
+        :param func: Lambda, the function whose handler is imported
+        """
+        self.func = func
+        self.runs = []
+
+    def run(self, count=5):
+        """import the handler count times, every time in a new process
+
+        :param count: int, how many cold starts
+        :returns: ImportProfile, self
+        """
+        func = self.func
+        with func.unpack() as paths:
+            config = json.dumps({
+                "paths": paths,
+                "marker": self.marker,
+                "module": func.handler.rsplit(".", 1)[0],
+                "function": func.function_name,
+            })
+
+            env = dict((k, String(v)) for k, v in func.environ.items())
+            env["PATH"] = os.environ.get("PATH", "")
+            env["LAMBDA_TASK_ROOT"] = paths[0]
+
+            for i in range(count):
+                p = subprocess.Popen(
+                    # -E and -s keep this machine's environment and user site
+                    # packages out of the process
+                    [
+                        sys.executable,
+                        "-E",
+                        "-s",
+                        "-X",
+                        "importtime",
+                        os.path.join(os.path.dirname(os.path.abspath(__file__)), "runtime.py"),
+                        config,
+                    ],
+                    cwd=paths[0],
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+                try:
+                    stdout, stderr = p.communicate(timeout=self.timeout)
+
+                except subprocess.TimeoutExpired:
+                    p.kill()
+                    p.communicate()
+                    raise ValueError("Importing handler {} took more than {} seconds".format(
+                        func.handler,
+                        self.timeout,
+                    ))
+
+                stdout = stdout.decode("utf-8", "replace")
+                stderr = stderr.decode("utf-8", "replace")
+                run = json.loads(stdout) if stdout.strip() else {}
+                if p.returncode != 0 or run.get("error", None):
+                    raise ValueError("Importing handler {} failed: {}".format(
+                        func.handler,
+                        run["error"]["errorMessage"] if run.get("error", None) else p.returncode,
+                    ))
+
+                run.pop("error", None)
+                run["imports"] = self.parse_importtime(stderr.split(self.marker, 1)[-1])
+                self.runs.append(run)
+                logger.debug("Cold start {} of {} took {:.3f}s".format(i + 1, count, run["init"]))
+
+        return self
+
+    def summary(self, key):
+        """returns the median and p95 of key across the runs
+
+        :param key: string, init (seconds) or rss (bytes)
+        :returns: dict, with median and p95 keys
+        """
+        values = [run[key] for run in self.runs]
+        return {
+            "median": self.get_percentile(values, 50),
+            "p95": self.get_percentile(values, 95),
+        }
+
+    def imports(self, top=0):
+        """returns the import tree of the first run with the median times of
+        every module across the runs
+
+        :param top: int, if passed only the modules with the top cumulative
+            times are returned, a module's importer is always at least as slow
+            so the tree stays connected
+        :returns: list, dicts with depth, name, us and cumulative_us keys, with
+            every module before the modules it imported
+        """
+        times = {}
+        for run in self.runs:
+            for depth, name, us, cumulative_us in run["imports"]:
+                times.setdefault(name, []).append((us, cumulative_us))
+
+        ret = []
+        for depth, name, us, cumulative_us in (self.runs[0]["imports"] if self.runs else []):
+            ret.append({
+                "depth": depth,
+                "name": name,
+                "us": self.get_percentile([t[0] for t in times[name]], 50),
+                "cumulative_us": self.get_percentile([t[1] for t in times[name]], 50),
+            })
+
+        if top and len(ret) > top:
+            cumulative = sorted((row["cumulative_us"] for row in ret), reverse=True)[top - 1]
+            ret = [row for row in ret if row["cumulative_us"] >= cumulative]
+
+        return ret
+
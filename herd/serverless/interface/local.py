@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, print_function, absolute_import
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import select
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from ...compat import *
+from .aws import ImportProfile
+
+
+logger = logging.getLogger(__name__)
+
+
+class Worker(object):
+    """A python process that imports a lambda function's handler once and then
+    invokes it for every event it is sent, like a warm lambda container, see
+    runtime.py
+
+    lambda stops a container that runs past its timeout or uses more than its
+    memory, so this does too and the next invocation starts a new process. The
+    process can't allocate more than its memory, see runtime.set_memory_limit()
+    """
+    def __init__(self, func, paths, memory=128, timeout=None):
+        """
+        :param func: Lambda, the function whose handler is invoked
+        :param paths: list, the directories that go first in sys.path, see
+            Lambda.unpack()
+        :param memory: int, the most megabytes the process can use
+        :param timeout: int, the most seconds an invocation can take, defaults
+            to the function's timeout
+        """
+        self.func = func
+        self.paths = paths
+        self.memory = memory
+        self.timeout = timeout or func.timeout
+        self.process = None
+        self.invocations = 0
+        self.init = 0.0
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """start the process and wait for it to import the handler
+
+        :returns: float, how many seconds importing the handler took
+        """
+        func = self.func
+        config = json.dumps({
+            "paths": self.paths,
+            "module": func.handler.rsplit(".", 1)[0],
+            "function": func.function_name,
+            "name": func.name,
+            "memory": self.memory,
+            "timeout": self.timeout,
+        })
+
+        env = dict((k, v) for k, v in os.environ.items() if k.startswith("AWS_"))
+        env.update((k, String(v)) for k, v in func.environ.items())
+        env["PATH"] = os.environ.get("PATH", "")
+        env["LAMBDA_TASK_ROOT"] = self.paths[0]
+        env["AWS_LAMBDA_FUNCTION_NAME"] = func.name
+        env["AWS_LAMBDA_FUNCTION_MEMORY_SIZE"] = String(self.memory)
+
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-E",
+                "-s",
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "runtime.py"),
+                config,
+            ],
+            cwd=self.paths[0],
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.invocations = 0
+
+        # lambda gives the init phase 10 seconds
+        message = self.read(max(10, self.timeout))
+        if message.get("error", None):
+            self.stop()
+            raise ValueError("Importing handler {} failed: {}".format(
+                func.handler,
+                message["error"]["errorMessage"],
+            ))
+
+        self.init = message["init"]
+        return self.init
+
+    def read(self, timeout):
+        """read the next message from the process
+
+        :param timeout: float, seconds to wait before the process is stopped
+        :returns: dict, the message or an error if the process stopped
+        """
+        r, w, x = select.select([self.process.stdout], [], [], timeout)
+        if not r:
+            self.stop()
+            return {
+                "error": {
+                    "errorMessage": "Task timed out after {:.2f} seconds".format(timeout),
+                    "errorType": "Runtime.Timeout",
+                    "stackTrace": [],
+                },
+            }
+
+        line = self.process.stdout.readline()
+        if not line:
+            self.stop()
+            return {
+                "error": {
+                    "errorMessage": "Runtime exited before completing request",
+                    "errorType": "Runtime.ExitError",
+                    "stackTrace": [],
+                },
+            }
+
+        return json.loads(line.decode("utf-8"))
+
+    def invoke(self, event):
+        """invoke the handler with event, the process is started if needed
+
+        :param event: dict, the event the handler is passed
+        :returns: dict, with result, error, duration, rss and cold keys, cold is
+            True if this was the first invocation of the process
+        """
+        if not self.is_running():
+            self.start()
+
+        cold = self.invocations == 0
+        self.invocations += 1
+
+        self.process.stdin.write("{}\n".format(json.dumps({
+            "id": String(uuid.uuid4()),
+            "event": event,
+        })).encode("utf-8"))
+        self.process.stdin.flush()
+
+        start = time.time()
+        ret = self.read(self.timeout)
+        ret.setdefault("result", None)
+        ret.setdefault("duration", time.time() - start)
+        ret.setdefault("rss", 0)
+        ret["cold"] = cold
+
+        if ret.get("error", None) and ret["error"]["errorType"] == "Runtime.ExitError":
+            # runtime.py exits when the handler runs out of memory
+            self.stop()
+
+        elif ret["rss"] > self.memory * 1024 * 1024:
+            self.stop()
+            ret["result"] = None
+            ret["error"] = {
+                "errorMessage": "Runtime exited with error: signal: killed, used {}MB of {}MB".format(
+                    ret["rss"] // (1024 * 1024),
+                    self.memory,
+                ),
+                "errorType": "Runtime.ExitError",
+                "stackTrace": [],
+            }
+
+        return ret
+
+    def stop(self):
+        if self.process:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+
+
+class WorkerPool(object):
+    """The warm workers a function's invocations are sent to, an invocation
+    waits for an idle worker so there are never more than concurrency
+    invocations running at the same time"""
+    def __init__(self, func, concurrency=1, memory=128, timeout=None):
+        """
+        :param func: Lambda, the function whose handler is invoked
+        :param concurrency: int, how many workers
+        :param memory: int, see Worker
+        :param timeout: int, see Worker
+        """
+        self.func = func
+        self.concurrency = max(1, concurrency)
+        self.memory = memory
+        self.timeout = timeout
+        self.workers = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.inits = []
+        self.invocations = []
+        self.stack = ExitStack()
+
+    def start(self):
+        """bundle the function and start and warm all the workers"""
+        try:
+            paths = self.stack.enter_context(self.func.unpack())
+            self.workers = [
+                Worker(self.func, paths, memory=self.memory, timeout=self.timeout)
+                for i in range(self.concurrency)
+            ]
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                self.inits.extend(executor.map(lambda w: w.start(), self.workers))
+
+        except Exception:
+            self.stop()
+            raise
+
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def invoke(self, event):
+        """invoke the handler with event using the next idle worker
+
+        :param event: dict, the event the handler is passed
+        :returns: dict, see Worker.invoke()
+        """
+        worker = self.idle.get()
+        try:
+            started = worker.is_running()
+            ret = worker.invoke(event)
+            if not started:
+                with self.lock:
+                    self.inits.append(worker.init)
+
+        finally:
+            self.idle.put(worker)
+
+        with self.lock:
+            self.invocations.append((ret["cold"], ret["duration"]))
+        return ret
+
+    def stats(self):
+        """returns the median and p95 of the init times and the cold and warm
+        invocation durations, in seconds
+
+        :returns: dict, with init, cold and warm keys
+        """
+        ret = {}
+        with self.lock:
+            groups = {
+                "init": list(self.inits),
+                "cold": [d for cold, d in self.invocations if cold],
+                "warm": [d for cold, d in self.invocations if not cold],
+            }
+
+        for name, values in groups.items():
+            ret[name] = {
+                "count": len(values),
+                "median": ImportProfile.get_percentile(values, 50) if values else 0.0,
+                "p95": ImportProfile.get_percentile(values, 95) if values else 0.0,
+            }
+        return ret
+
+    def stop(self):
+        """stop all the workers and remove the unpacked function"""
+        for worker in self.workers:
+            worker.stop()
+        self.stack.close()
+
+
+class LocalGateway(ThreadingHTTPServer):
+    """A local http server that sends requests to a function the way an API
+    Gateway AWS_PROXY integration does, see aws.ApiGateway.add_lambda()
+
+    the function is at /NAME and /STAGE/NAME, like the resource add_lambda()
+    creates
+
+    https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html
+    """
+    daemon_threads = True
+
+    @classmethod
+    def get_event(cls, method, path, headers, body, stage="", name=""):
+        """returns the AWS_PROXY event of a request
+
+        :param method: string, the http method (eg, GET)
+        :param path: string, the request path with the query string
+        :param headers: list, (name, value) tuples
+        :param body: bytes, the request body
+        :param stage: string, the stage name
+        :param name: string, the function's resource name
+        :returns: dict
+        """
+        parts = urlsplit(path)
+        multi_headers = {}
+        for k, v in headers:
+            multi_headers.setdefault(k, []).append(v)
+        query = parse_qs(parts.query, keep_blank_values=True)
+
+        event = {
+            "resource": "/{}".format(name),
+            "path": "/{}".format(name),
+            "httpMethod": method,
+            "headers": dict((k, v[-1]) for k, v in multi_headers.items()) or None,
+            "multiValueHeaders": multi_headers or None,
+            "queryStringParameters": dict((k, v[-1]) for k, v in query.items()) or None,
+            "multiValueQueryStringParameters": query or None,
+            "pathParameters": None,
+            "stageVariables": None,
+            "requestContext": {
+                "resourcePath": "/{}".format(name),
+                "httpMethod": method,
+                "path": parts.path,
+                "stage": stage,
+                "requestId": String(uuid.uuid4()),
+                "requestTimeEpoch": int(time.time() * 1000),
+                "identity": {
+                    "sourceIp": "127.0.0.1",
+                    "userAgent": dict(headers).get("User-Agent", ""),
+                },
+                "protocol": "HTTP/1.1",
+                "accountId": "000000000000",
+                "apiId": "local",
+            },
+            "body": None,
+            "isBase64Encoded": False,
+        }
+
+        if body:
+            try:
+                event["body"] = body.decode("utf-8")
+            except UnicodeDecodeError:
+                event["body"] = base64.b64encode(body).decode("ascii")
+                event["isBase64Encoded"] = True
+
+        return event
+
+    @classmethod
+    def get_response(cls, result):
+        """returns the http response of what the handler returned, anything
+        that isn't a proxy response is an error like in API Gateway
+
+        :param result: dict, the handler's return value
+        :returns: tuple, (status code, list of (name, value) headers, bytes body)
+        """
+        if not isinstance(result, dict) or not isinstance(result.get("statusCode", None), int):
+            return cls.get_error_response()
+
+        headers = [(k, String(v)) for k, v in (result.get("headers", None) or {}).items()]
+        for k, values in (result.get("multiValueHeaders", None) or {}).items():
+            headers.extend((k, String(v)) for v in values)
+
+        body = result.get("body", None) or ""
+        if not isinstance(body, basestring):
+            return cls.get_error_response()
+
+        if result.get("isBase64Encoded", False):
+            body = base64.b64decode(body)
+        else:
+            body = body.encode("utf-8")
+
+        return result["statusCode"], headers, body
+
+    @classmethod
+    def get_error_response(cls, status_code=502, message="Internal server error"):
+        body = json.dumps({"message": message}).encode("utf-8")
+        return status_code, [("Content-Type", "application/json")], body
+
+    def __init__(self, pool, host="127.0.0.1", port=8080, stage=""):
+        """
+        :param pool: WorkerPool, the requests are sent to these workers
+        :param host: string, the address to listen on
+        :param port: int, the port to listen on
+        :param stage: string, the stage name, see aws.ApiGateway.add_lambda()
+        """
+        self.pool = pool
+        self.stage = stage.lower()
+        self.name = pool.func.name
+        super(LocalGateway, self).__init__((host, port), LocalGatewayHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}/{}".format(host, port, self.name)
+
+    def handle_event(self, method, path, headers, body):
+        """send a request to the function
+
+        :returns: tuple, see .get_response()
+        """
+        bits = [bit for bit in urlsplit(path).path.split("/") if bit]
+        if bits != [self.name] and bits != [self.stage, self.name]:
+            return self.get_error_response(403, "Missing Authentication Token")
+
+        event = self.get_event(method, path, headers, body, self.stage, self.name)
+        try:
+            res = self.pool.invoke(event)
+
+        except ValueError as e:
+            # the worker couldn't be started again
+            logger.exception(e)
+            return self.get_error_response()
+
+        if res["error"]:
+            logger.error("{}: {}".format(res["error"]["errorType"], res["error"]["errorMessage"]))
+            for line in res["error"]["stackTrace"]:
+                logger.debug(line)
+            return self.get_error_response()
+
+        return self.get_response(res["result"])
+
+
+class LocalGatewayHandler(BaseHTTPRequestHandler):
+    """Turns every http request into a call to LocalGateway.handle_event()"""
+    protocol_version = "HTTP/1.1"
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if not self.parse_request():
+            return
+
+        start = time.time()
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = self.rfile.read(length) if length else b""
+        status_code, headers, body = self.server.handle_event(
+            self.command,
+            self.path,
+            list(self.headers.items()),
+            body,
+        )
+
+        self.send_response(status_code)
+        for k, v in headers:
+            if k.lower() not in ("content-length", "connection"):
+                self.send_header(k, v)
+        self.send_header("Content-Length", String(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+        self.wfile.flush()
+
+        logger.info("{} {} {} {:.1f}ms".format(
+            self.command,
+            self.path,
+            status_code,
+            (time.time() - start) * 1000,
+        ))
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""The lambda runtime that runs in each herd serve worker process, see
+local.Worker
+
+This file is ran as a script with the unpacked bundle first in sys.path so it
+can't import anything from herd. It imports the handler once and then invokes
+it for every request it reads from stdin, so module state is kept between
+invocations like a warm lambda container. Every message is one line of JSON,
+anything the handler prints goes to stderr
+
+aws.ImportProfile runs this too, with no stdin, so the handler is only imported
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import sys
+import json
+import time
+import importlib
+import traceback
+
+
+def get_rss():
+    """returns the peak resident memory of this process in bytes"""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+
+    except IOError:
+        pass
+
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def set_memory_limit(megabytes):
+    """cap the memory this process can allocate at megabytes, like lambda caps
+    the memory of a container, allocating past it raises MemoryError
+
+    :param megabytes: int
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+
+    # RLIMIT_DATA is closer to what lambda counts but not every platform has it
+    name = "RLIMIT_DATA" if hasattr(resource, "RLIMIT_DATA") else "RLIMIT_AS"
+    rlimit = getattr(resource, name)
+    soft, hard = resource.getrlimit(rlimit)
+    limit = megabytes * 1024 * 1024
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+
+    try:
+        resource.setrlimit(rlimit, (limit, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def get_error(e):
+    """returns the error the way lambda reports an exception the handler raised"""
+    return {
+        "errorMessage": str(e),
+        "errorType": e.__class__.__name__,
+        "stackTrace": traceback.format_exc().splitlines(),
+    }
+
+
+class Context(object):
+    """The context object lambda passes to the handler
+
+    https://docs.aws.amazon.com/lambda/latest/dg/python-context.html
+    """
+    def __init__(self, config, request_id):
+        self.function_name = config["name"]
+        self.function_version = "$LATEST"
+        self.invoked_function_arn = "arn:aws:lambda:local:000000000000:function:{}".format(config["name"])
+        self.memory_limit_in_mb = config["memory"]
+        self.aws_request_id = request_id
+        self.log_group_name = "/aws/lambda/{}".format(config["name"])
+        self.log_stream_name = "herd-serve"
+        self.identity = None
+        self.client_context = None
+        self.deadline = time.time() + config["timeout"]
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+
+def main():
+    config = json.loads(sys.argv[1])
+    sys.path[:] = config["paths"] + [p for p in sys.path[1:] if not p.endswith(("site-packages", "dist-packages"))]
+    sys.dont_write_bytecode = True
+
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    if config.get("memory", None):
+        set_memory_limit(config["memory"])
+
+    def write(message):
+        try:
+            line = json.dumps(message)
+        except (TypeError, ValueError) as e:
+            message["result"] = None
+            message["error"] = {
+                "errorMessage": "Unable to marshal response: {}".format(e),
+                "errorType": "Runtime.MarshalError",
+                "stackTrace": [],
+            }
+            line = json.dumps(message)
+        out.write(line + "\n")
+        out.flush()
+
+    if config.get("marker", None):
+        # the imports made before this can be told apart from the handler's
+        sys.stderr.write(config["marker"] + "\n")
+        sys.stderr.flush()
+
+    start = time.perf_counter()
+    try:
+        handler = getattr(importlib.import_module(config["module"]), config["function"])
+
+    except Exception as e:
+        write({"init": time.perf_counter() - start, "error": get_error(e), "rss": get_rss()})
+        return 1
+
+    write({"init": time.perf_counter() - start, "error": None, "rss": get_rss()})
+
+    for line in iter(sys.stdin.readline, ""):
+        request = json.loads(line)
+        start = time.perf_counter()
+        try:
+            result = handler(request["event"], Context(config, request["id"]))
+            error = None
+
+        except MemoryError:
+            # lambda kills a container that runs out of memory
+            write({
+                "result": None,
+                "error": {
+                    "errorMessage": "Runtime exited with error: signal: killed, used more than {}MB".format(
+                        config["memory"],
+                    ),
+                    "errorType": "Runtime.ExitError",
+                    "stackTrace": [],
+                },
+                "duration": time.perf_counter() - start,
+                "rss": get_rss(),
+            })
+            return 1
+
+        except Exception as e:
+            result = None
+            error = get_error(e)
+
+        write({
+            "result": result,
+            "error": error,
+            "duration": time.perf_counter() - start,
+            "rss": get_rss(),
+        })
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
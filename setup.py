@@ -28,6 +28,10 @@ kwargs["version"] = re.search(r"^__version__\s*=\s*[\'\"]([^\'\"]+)", read(vpath
 kwargs["long_description"] = read('README.md')
 kwargs["long_description_content_type"] = "text/markdown"
 
+# the bundling (hash based bytecode, lazy imports, process pools) and the
+# local server need python 3.7+ and lambda no longer has a python 2 runtime
+kwargs["python_requires"] = ">=3.7"
+
 kwargs["tests_require"] = ["testdata"]
 kwargs["install_requires"] = ["boto3", "captain"]
 
@@ -43,8 +47,8 @@ setup(
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2.7',
-        #'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
     entry_points = {
         'console_scripts': [
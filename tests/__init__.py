@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, division, print_function, absolute_import
+import os
+import tempfile
 
 import testdata
 from testdata import TestCase
@@ -7,3 +9,6 @@ from testdata import TestCase
 
 testdata.basic_logging()
 
+# the tests shouldn't read or write the developer's herd cache (imports,
+# fragments and unpacked wheels), see herd.path.Cachedir
+os.environ["HERD_CACHE_DIR"] = tempfile.mkdtemp(prefix="herd-tests-cache-")
@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, division, print_function, absolute_import
 from zipfile import ZipFile
+import os
+import sys
+import threading
+import subprocess
+
+from botocore.exceptions import ClientError
 
 import testdata
 
@@ -10,6 +16,8 @@ from herd.serverless.interface.aws import (
     Lambda,
     ApiGateway,
     Description,
+    Bucket,
+    ImportProfile,
 )
 
 
@@ -48,6 +56,16 @@ class TestCase(testdata.TestCase):
         l.save()
         return l
 
+    @classmethod
+    def get_stub_lambda(cls, filepath, **kwargs):
+        """returns a Lambda that uses a StubClient instead of AWS"""
+        class Role(object):
+            arn = "arn:aws:iam::123456789012:role/herd-unittests"
+
+        l = type("StubLambda", (Lambda,), {"client": None})(filepath, role=Role(), **kwargs)
+        l.client = StubClient()
+        return l
+
     @classmethod
     def get_api(cls):
         name = "herd-unittests"
@@ -56,6 +74,142 @@ class TestCase(testdata.TestCase):
         return api
 
 
+class StubClient(object):
+    """Stands in for a boto3 lambda client, it records every call and keeps
+    the published layer versions"""
+    @property
+    def names(self):
+        return [name for name, kwargs in self.calls]
+
+    def __init__(self):
+        self.calls = []
+        self.layer_versions = []
+
+    def list_layer_versions(self, **kwargs):
+        self.calls.append(("list_layer_versions", kwargs))
+        return {"LayerVersions": list(self.layer_versions)}
+
+    def publish_layer_version(self, **kwargs):
+        self.calls.append(("publish_layer_version", kwargs))
+        version = {
+            "Version": len(self.layer_versions) + 1,
+            "LayerVersionArn": "arn:aws:lambda:us-west-2:123456789012:layer:{}:{}".format(
+                kwargs["LayerName"],
+                len(self.layer_versions) + 1,
+            ),
+            "Description": kwargs["Description"],
+        }
+        self.layer_versions.append(version)
+        return version
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.calls.append((name, kwargs))
+            return {"CodeSha256": ""}
+        return call
+
+
+class StubS3Client(object):
+    """Stands in for a boto3 s3 client, it keeps the objects in memory"""
+    def __init__(self, fail_part=0):
+        self.calls = []
+        self.objects = {}
+        self.uploads = {}
+        self.fail_part = fail_part
+        self.lock = threading.Lock()
+
+    def record(self, name, kwargs):
+        with self.lock:
+            self.calls.append((name, kwargs))
+
+    def head_object(self, Bucket, Key):
+        self.record("head_object", {"Bucket": Bucket, "Key": Key})
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"Metadata": self.objects[Key]["Metadata"]}
+
+    def put_object(self, Bucket, Key, Body, Metadata):
+        self.record("put_object", {"Bucket": Bucket, "Key": Key})
+        self.objects[Key] = {"Body": Body.read(), "Metadata": Metadata}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata):
+        self.record("create_multipart_upload", {"Bucket": Bucket, "Key": Key})
+        upload_id = "upload{}".format(len(self.uploads) + 1)
+        self.uploads[upload_id] = {"Metadata": Metadata, "Parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.record("upload_part", {"Bucket": Bucket, "Key": Key, "PartNumber": PartNumber})
+        if PartNumber == self.fail_part:
+            raise ClientError({"Error": {"Code": "500"}}, "UploadPart")
+        with self.lock:
+            self.uploads[UploadId]["Parts"][PartNumber] = Body
+        return {"ETag": "etag{}".format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.record("complete_multipart_upload", {"Bucket": Bucket, "Key": Key})
+        upload = self.uploads.pop(UploadId)
+        self.objects[Key] = {
+            "Body": b"".join(upload["Parts"][p["PartNumber"]] for p in MultipartUpload["Parts"]),
+            "Metadata": upload["Metadata"],
+        }
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.record("abort_multipart_upload", {"Bucket": Bucket, "Key": Key})
+        self.uploads.pop(UploadId)
+
+
+class BucketTest(TestCase):
+    def get_bucket(self, **kwargs):
+        b = Bucket("herd-unittests", client=StubS3Client(**kwargs))
+        b.part_size = 10
+        b.workers = 4
+        return b
+
+    def get_path(self, data):
+        path = testdata.get_file("lambda.zip")
+        with open(path, "wb") as fp:
+            fp.write(data)
+        return path
+
+    def test_upload(self):
+        b = self.get_bucket()
+        path = self.get_path(b"1234567890")
+        self.assertTrue(b.upload(path, "herd/foo/lambda.zip"))
+        self.assertEqual(["head_object", "put_object"], [c[0] for c in b.client.calls])
+        self.assertEqual(b"1234567890", b.client.objects["herd/foo/lambda.zip"]["Body"])
+
+        b.client.calls = []
+        self.assertFalse(b.upload(path, "herd/foo/lambda.zip"))
+        self.assertEqual(["head_object"], [c[0] for c in b.client.calls])
+
+    def test_upload_parts(self):
+        b = self.get_bucket()
+        data = b"".join(String(i).encode("ascii") for i in range(100))
+        path = self.get_path(data)
+        checksum = b.get_checksum(path)
+
+        self.assertTrue(b.upload(path, "herd/foo/lambda.zip", checksum))
+        names = [c[0] for c in b.client.calls]
+        self.assertEqual(19, names.count("upload_part"))
+        self.assertEqual("complete_multipart_upload", names[-1])
+        self.assertEqual(data, b.client.objects["herd/foo/lambda.zip"]["Body"])
+        self.assertEqual(checksum, b.get_object_checksum("herd/foo/lambda.zip"))
+
+        self.assertFalse(b.upload(path, "herd/foo/lambda.zip"))
+
+    def test_upload_parts_abort(self):
+        b = self.get_bucket(fail_part=2)
+        path = self.get_path(b"1" * 35)
+        with self.assertRaises(ClientError):
+            b.upload(path, "herd/foo/lambda.zip")
+
+        names = [c[0] for c in b.client.calls]
+        self.assertEqual("abort_multipart_upload", names[-1])
+        self.assertFalse(b.client.uploads)
+        self.assertFalse(b.client.objects)
+
+
 class ApiGatewayTest(TestCase):
     def test_crud(self):
         name = testdata.get_filename()
@@ -112,6 +266,291 @@ class LambdaTest(TestCase):
         self.assertTrue(m in c)
         self.assertTrue("boto3" in c)
 
+    def test_bundle_reproducible(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import os",
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        l = Lambda(filepath, role=self.get_role())
+        zip_path = l.bundle()
+        os.utime(filepath, (0, 0))
+        zip_path2 = l.bundle()
+
+        with open(zip_path, "rb") as fp:
+            code_sha256 = l.get_code_sha256(fp.read())
+        with open(zip_path2, "rb") as fp:
+            self.assertEqual(code_sha256, l.get_code_sha256(fp.read()))
+
+        zip_path3 = l.bundle(staging=True)
+        self.assertTrue(os.path.isfile(os.path.join(zip_path3.dirname, "lambda.manifest")))
+        with open(zip_path3, "rb") as fp:
+            self.assertEqual(code_sha256, l.get_code_sha256(fp.read()))
+
+    def test_bundle_bytecode(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import dateutil",
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        l = Lambda(filepath, role=self.get_role(), bytecode=True)
+        with ZipFile(l.bundle()) as z:
+            names = z.namelist()
+        self.assertTrue(filepath.basename in names)
+        self.assertTrue("dateutil/__init__.py" in names)
+        self.assertTrue(any(n.startswith("dateutil/__pycache__/__init__.") for n in names))
+
+        l = Lambda(filepath, role=self.get_role(), bytecode=True, optimize=2, drop_sources=True)
+        with ZipFile(l.bundle()) as z:
+            names = z.namelist()
+        self.assertTrue(filepath.basename in names)
+        self.assertFalse("dateutil/__init__.py" in names)
+        self.assertTrue("dateutil/__init__.pyc" in names)
+
+    def test_unpack(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        l = Lambda(filepath, role=self.get_role())
+        with l.unpack() as paths:
+            taskdir = paths[0]
+            self.assertTrue(os.path.isfile(os.path.join(taskdir, filepath.basename)))
+            self.assertEqual(0o555, os.stat(taskdir).st_mode & 0o777)
+
+        # the read-only task directory is removed with everything else
+        self.assertFalse(os.path.exists(taskdir))
+        self.assertFalse(os.path.exists(os.path.dirname(taskdir)))
+
+    def test_bundle_wheelhouse(self):
+        from importlib.metadata import version
+
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import dateutil",
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        wheelhouse = testdata.create_dir()
+        wheel_name = "python_dateutil-{}-py2.py3-none-manylinux2014_x86_64.whl".format(version("python-dateutil"))
+        with ZipFile(os.path.join(wheelhouse, wheel_name), "w") as z:
+            z.writestr("dateutil/__init__.py", "wheelhouse = True")
+            z.writestr("dateutil/_speedups.cpython-39-x86_64-linux-gnu.so", "")
+
+        l = Lambda(filepath, role=self.get_role(), wheelhouse=wheelhouse)
+        with ZipFile(l.bundle()) as z:
+            self.assertEqual(b"wheelhouse = True", z.read("dateutil/__init__.py"))
+            self.assertTrue("dateutil/_speedups.cpython-39-x86_64-linux-gnu.so" in z.namelist())
+            self.assertFalse("dateutil/parser/__init__.py" in z.namelist())
+
+        # an arm64 lambda can't use the x86_64 wheel so it uses the installed
+        # files since dateutil doesn't have a shared library
+        l = Lambda(filepath, role=self.get_role(), wheelhouse=wheelhouse, architecture="arm64")
+        with ZipFile(l.bundle()) as z:
+            self.assertNotEqual(b"wheelhouse = True", z.read("dateutil/__init__.py"))
+
+    def test_report(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import dateutil",
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        l = Lambda(filepath, role=self.get_role())
+        report = l.report()
+        rows = {row["name"]: row for row in report}
+        self.assertEqual([l.module_name], rows["dateutil"]["required_by"])
+        self.assertEqual(["dateutil"], rows["six"]["required_by"])
+        self.assertEqual("site", rows["dateutil"]["source"])
+        self.assertEqual("handler", rows[l.module_name]["source"])
+
+        self.assertEqual("dateutil", report[0]["name"])
+        self.assertLess(rows["dateutil"]["compressed_bytes"], rows["dateutil"]["bytes"])
+        self.assertEqual(len(l.manifest), sum(row["files"] for row in report))
+
+    def test_bundle_exclude_packages(self):
+        path = testdata.create_modules({
+            "exfoo": "from .test import client",
+            "exfoo.test": "",
+            "exfoo.test.client": "",
+        })
+        basedir = testdata.create_files({
+            "tests/test_exfoo.py": "",
+            "docs/index.rst": "",
+        }, tmpdir=os.path.join(path, "exfoo"))
+
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import exfoo",
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        l = Lambda(filepath, role=self.get_role())
+        with ZipFile(l.bundle()) as z:
+            names = z.namelist()
+        self.assertTrue("exfoo/test/client.py" in names)
+        self.assertFalse("exfoo/tests/test_exfoo.py" in names)
+        self.assertFalse("exfoo/docs/index.rst" in names)
+        self.assertEqual(1, l.excluded["tests/"][0])
+        self.assertEqual(1, l.excluded["docs/"][0])
+
+    def test_bundle_lazy(self):
+        m = testdata.create_module(contents="VALUE = 1")
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import {}".format(m),
+            "",
+            "def handler(event, context):",
+            "    return {}.VALUE".format(m),
+        ])
+
+        l = Lambda(filepath, role=self.get_role(), lazy=["{}*".format(m)])
+        self.assertEqual("herd_bootstrap.handler", l.handler)
+        self.assertEqual([m], l.get_lazy_modules())
+
+        basedir = testdata.create_dir()
+        with ZipFile(l.bundle()) as z:
+            z.extractall(basedir)
+
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "; ".join([
+                    "import sys, herd_bootstrap",
+                    "print(type(sys.modules['{}']).__name__)".format(m),
+                    "print(herd_bootstrap.handler(None, None))",
+                    "print(type(sys.modules['{}']).__name__)".format(m),
+                ]),
+            ],
+            cwd=basedir,
+        ).decode("utf-8").split()
+        self.assertEqual(["LazyModule", "1", "module"], output)
+
+    def test_save_unchanged(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        l = self.get_stub_lambda(filepath)
+        with open(l.bundle(), "rb") as fp:
+            code_sha256 = l.get_code_sha256(fp.read())
+
+        l.raw = {"Configuration": {"CodeSha256": code_sha256}}
+        l.save()
+        self.assertEqual(["update_function_configuration"], l.client.names)
+
+        l.raw = {"Configuration": {"CodeSha256": "changed"}}
+        l.client.calls = []
+        l.save()
+        self.assertEqual(
+            ["update_function_code", "update_function_configuration"],
+            l.client.names
+        )
+
+    def test_save_layer(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import dateutil",
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        l = self.get_stub_lambda(filepath, layer=True)
+        l.raw = {"Configuration": {"CodeSha256": "changed"}}
+        l.save()
+        self.assertEqual(
+            [
+                "list_layer_versions",
+                "publish_layer_version",
+                "update_function_configuration",
+                "update_function_code",
+            ],
+            l.client.names
+        )
+        self.assertTrue("dateutil/__init__.py" in l.layer_entries)
+        arn = l.client.layer_versions[0]["LayerVersionArn"]
+        self.assertEqual([arn], l.client.calls[2][1]["Layers"])
+
+        with ZipFile(l.bundle()) as z:
+            self.assertEqual([filepath.basename], z.namelist())
+
+        l.client.calls = []
+        l.save()
+        self.assertEqual(
+            ["list_layer_versions", "update_function_configuration", "update_function_code"],
+            l.client.names
+        )
+        self.assertEqual(1, len(l.client.layer_versions))
+        self.assertEqual([arn], l.client.calls[1][1]["Layers"])
+
+    def test_save_layer_external(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import dateutil",
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+        extension = "arn:aws:lambda:us-west-2:123456789012:layer:monitoring-extension:3"
+
+        # a function that doesn't use a dependency layer keeps its layers
+        l = self.get_stub_lambda(filepath)
+        l.raw = {"Configuration": {"CodeSha256": "changed", "Layers": [{"Arn": extension}]}}
+        l.save()
+        self.assertEqual(["update_function_code", "update_function_configuration"], l.client.names)
+        self.assertFalse("Layers" in l.client.calls[1][1])
+
+        l.raw = {}
+        l.client.calls = []
+        l.save()
+        self.assertEqual(["create_function"], l.client.names)
+        self.assertFalse("Layers" in l.client.calls[0][1])
+
+        # the dependency layer is added next to the other layers
+        l = self.get_stub_lambda(filepath, layer=True)
+        l.raw = {"Configuration": {"CodeSha256": "changed", "Layers": [{"Arn": extension}]}}
+        l.save()
+        arn = l.client.layer_versions[0]["LayerVersionArn"]
+        self.assertEqual([extension, arn], l.client.calls[2][1]["Layers"])
+
+        # and removed without removing them
+        l = self.get_stub_lambda(filepath)
+        l.raw = {"Configuration": {"CodeSha256": "changed", "Layers": [{"Arn": arn}, {"Arn": extension}]}}
+        l.save()
+        self.assertEqual(["update_function_code", "update_function_configuration"], l.client.names)
+        self.assertEqual([extension], l.client.calls[1][1]["Layers"])
+
+    def test_save_bucket(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        bucket = Bucket("herd-unittests", client=StubS3Client())
+        l = self.get_stub_lambda(filepath, bucket=bucket)
+        l.raw = {}
+        l.save()
+        self.assertEqual(["create_function"], l.client.names)
+        code = l.client.calls[0][1]["Code"]
+        self.assertEqual({"S3Bucket": "herd-unittests", "S3Key": "herd/{}/lambda.zip".format(l.name)}, code)
+        with open(l.bundle(), "rb") as fp:
+            self.assertEqual(fp.read(), bucket.client.objects[code["S3Key"]]["Body"])
+
+        l.raw = {"Configuration": {"CodeSha256": "changed"}}
+        l.client.calls = []
+        bucket.client.calls = []
+        l.save()
+        self.assertEqual(["update_function_code", "update_function_configuration"], l.client.names)
+        self.assertEqual(["head_object"], [c[0] for c in bucket.client.calls])
+
     def test_crud(self):
         """!!! This writes to AWS"""
         role = self.get_role()
@@ -175,6 +614,68 @@ class LambdaTest(TestCase):
         self.assertEqual("1", r["body"]["environ"]["foo"])
 
 
+class ImportProfileTest(TestCase):
+    def test_parse_importtime(self):
+        output = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:        10 |         10 |       bar.che",
+            "import time:        20 |         30 |     bar",
+            "import time:         5 |          5 |     baz",
+            "import time:       100 |        135 |   foo",
+            "import time:         1 |          1 |   boo",
+        ])
+        self.assertEqual(
+            [
+                (0, "foo", 100, 135),
+                (1, "bar", 20, 30),
+                (2, "bar.che", 10, 10),
+                (1, "baz", 5, 5),
+                (0, "boo", 1, 1),
+            ],
+            ImportProfile.parse_importtime(output)
+        )
+
+    def test_get_percentile(self):
+        values = list(range(1, 21))
+        self.assertEqual(10, ImportProfile.get_percentile(values, 50))
+        self.assertEqual(19, ImportProfile.get_percentile(values, 95))
+        self.assertEqual(3, ImportProfile.get_percentile([3], 95))
+
+    def test_run(self):
+        m = testdata.create_module(contents="import json")
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import {}".format(m),
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        func = Lambda(filepath, role=self.get_role())
+        p = ImportProfile(func).run(2)
+        self.assertEqual(2, len(p.runs))
+        self.assertLess(0, p.summary("init")["median"])
+        self.assertLess(0, p.summary("rss")["p95"])
+        names = [row["name"] for row in p.imports()]
+        self.assertTrue(m in names)
+        self.assertEqual(1, len(p.imports(1)))
+
+    def test_run_error(self):
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=[
+            "import os",
+            "",
+            "# only fails in the unpacked bundle",
+            "if os.environ.get('LAMBDA_TASK_ROOT'):",
+            "    raise RuntimeError('boom')",
+            "",
+            "def handler(event, context):",
+            "    pass",
+        ])
+
+        func = Lambda(filepath, role=self.get_role())
+        with self.assertRaisesRegex(ValueError, "boom"):
+            ImportProfile(func).run(1)
+
+
 class DescriptionTest(TestCase):
     def test_truncate(self):
         """turns out aws descriptions can only be 256 characters"""
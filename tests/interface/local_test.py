@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, print_function, absolute_import
+import threading
+
+import testdata
+
+from herd.compat import *
+from herd.serverless.interface.aws import Lambda
+from herd.serverless.interface.local import WorkerPool, LocalGateway
+
+
+class TestCase(testdata.TestCase):
+    @classmethod
+    def get_lambda(cls, contents, **kwargs):
+        class Role(object):
+            arn = "arn:aws:iam::123456789012:role/herd-unittests"
+
+        filepath = testdata.create_file(testdata.get_filename("py"), contents=contents)
+        return Lambda(filepath, role=Role(), **kwargs)
+
+
+class LocalGatewayTest(TestCase):
+    def test_get_event(self):
+        event = LocalGateway.get_event(
+            "POST",
+            "/dev/foo?bar=1&bar=2&che=",
+            [("Content-Type", "text/plain"), ("X-Foo", "1"), ("X-Foo", "2")],
+            b"body",
+            "dev",
+            "foo",
+        )
+        self.assertEqual("/foo", event["resource"])
+        self.assertEqual("POST", event["httpMethod"])
+        self.assertEqual("2", event["headers"]["X-Foo"])
+        self.assertEqual(["1", "2"], event["multiValueHeaders"]["X-Foo"])
+        self.assertEqual({"bar": "2", "che": ""}, event["queryStringParameters"])
+        self.assertEqual(["1", "2"], event["multiValueQueryStringParameters"]["bar"])
+        self.assertEqual("/dev/foo", event["requestContext"]["path"])
+        self.assertEqual("body", event["body"])
+        self.assertFalse(event["isBase64Encoded"])
+
+        event = LocalGateway.get_event("GET", "/foo", [], b"\xff\xfe")
+        self.assertEqual("//4=", event["body"])
+        self.assertTrue(event["isBase64Encoded"])
+        self.assertIsNone(event["queryStringParameters"])
+
+    def test_get_response(self):
+        status_code, headers, body = LocalGateway.get_response({
+            "statusCode": 201,
+            "headers": {"X-Foo": 1},
+            "multiValueHeaders": {"Set-Cookie": ["a=1", "b=2"]},
+            "body": "foo",
+        })
+        self.assertEqual(201, status_code)
+        self.assertEqual([("X-Foo", "1"), ("Set-Cookie", "a=1"), ("Set-Cookie", "b=2")], headers)
+        self.assertEqual(b"foo", body)
+
+        status_code, headers, body = LocalGateway.get_response({
+            "statusCode": 200,
+            "body": "Zm9v",
+            "isBase64Encoded": True,
+        })
+        self.assertEqual(b"foo", body)
+
+        status_code, headers, body = LocalGateway.get_response({"body": "foo"})
+        self.assertEqual(502, status_code)
+
+        status_code, headers, body = LocalGateway.get_response({"statusCode": 200, "body": 1})
+        self.assertEqual(502, status_code)
+
+
+class WorkerPoolTest(TestCase):
+    def test_invoke(self):
+        func = self.get_lambda([
+            "count = 0",
+            "",
+            "def handler(event, context):",
+            "    global count",
+            "    count += 1",
+            "    if event.get('boom'):",
+            "        raise ValueError('boom')",
+            "    if event.get('sleep'):",
+            "        import time",
+            "        time.sleep(event['sleep'])",
+            "    print('this goes to stderr')",
+            "    return {'count': count, 'name': context.function_name}",
+        ])
+        pool = WorkerPool(func, concurrency=2, timeout=1)
+        pool.start()
+        try:
+            res = pool.invoke({})
+            self.assertTrue(res["cold"])
+            self.assertEqual({"count": 1, "name": func.name}, res["result"])
+
+            # module state is kept by a warm worker
+            pool.invoke({})
+            res = pool.invoke({})
+            self.assertFalse(res["cold"])
+            self.assertEqual(2, res["result"]["count"])
+
+            res = pool.invoke({"boom": True})
+            self.assertEqual("ValueError", res["error"]["errorType"])
+
+            res = pool.invoke({"sleep": 2})
+            self.assertEqual("Runtime.Timeout", res["error"]["errorType"])
+
+            # the timed out worker is started again
+            res = pool.invoke({})
+            res = pool.invoke({})
+            self.assertTrue(res["cold"])
+            self.assertEqual(1, res["result"]["count"])
+
+            stats = pool.stats()
+            self.assertEqual(3, stats["init"]["count"])
+            self.assertEqual(3, stats["cold"]["count"])
+            self.assertEqual(4, stats["warm"]["count"])
+            self.assertLess(0, stats["warm"]["median"])
+
+        finally:
+            pool.stop()
+
+    def test_invoke_memory(self):
+        func = self.get_lambda([
+            "def handler(event, context):",
+            "    b = bytearray(event['size'] * 1024 * 1024)",
+            "    return len(b)",
+        ])
+        pool = WorkerPool(func, memory=64)
+        pool.start()
+        try:
+            res = pool.invoke({"size": 1})
+            self.assertIsNone(res["error"])
+
+            res = pool.invoke({"size": 128})
+            self.assertEqual("Runtime.ExitError", res["error"]["errorType"])
+            self.assertFalse(pool.workers[0].is_running())
+            # the allocation failed instead of going past the limit
+            self.assertGreater(64 * 1024 * 1024, res["rss"])
+
+            res = pool.invoke({"size": 1})
+            self.assertTrue(res["cold"])
+            self.assertIsNone(res["error"])
+
+        finally:
+            pool.stop()
+
+
+class ServeTest(TestCase):
+    def test_serve(self):
+        func = self.get_lambda([
+            "def handler(event, context):",
+            "    return {",
+            "        'statusCode': 200,",
+            "        'headers': {'Content-Type': 'text/plain'},",
+            "        'body': ' '.join([",
+            "            event['httpMethod'],",
+            "            event['queryStringParameters']['foo'],",
+            "            event['body'] or '',",
+            "        ]),",
+            "    }",
+        ])
+        pool = WorkerPool(func)
+        pool.start()
+        server = LocalGateway(pool, port=0, stage="DEV")
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            res = testdata.fetch("{}?foo=1".format(server.url), body=b"bar", method="POST")
+            self.assertEqual(200, res.code)
+            self.assertEqual("POST 1 bar", res.body)
+
+            url = server.url.replace(func.name, "dev/{}?foo=2".format(func.name))
+            self.assertEqual(200, testdata.fetch(url).code)
+
+            url = server.url.replace(func.name, "nope")
+            self.assertEqual(403, testdata.fetch(url).code)
+
+        finally:
+            server.shutdown()
+            server.server_close()
+            pool.stop()
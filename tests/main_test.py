@@ -16,3 +16,9 @@ class InfoTest(TestCase):
         r = c.run("info")
         self.assertTrue("Available Regions" in r)
 
+
+    def test_cache_clear(self):
+        cachedir = testdata.create_dir()
+        c = Client(environ={"HERD_CACHE_DIR": cachedir})
+        r = c.run("cache-clear")
+        self.assertTrue("Cleared herd cache" in r)
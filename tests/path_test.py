@@ -4,7 +4,11 @@ from __future__ import unicode_literals, division, print_function, absolute_impo
 from testdata import TestCase
 import testdata
 
-from herd.path import Filepath
+import os
+import stat
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+from herd.path import Filepath, Dirpath, Zippath, Exclusions, FragmentCache
 
 
 class FilepathTest(TestCase):
@@ -15,3 +19,217 @@ class FilepathTest(TestCase):
         fp = Filepath("foo.bar.txt")
         self.assertEqual("txt", fp.ext)
 
+    def test_compile_to(self):
+        basedir = testdata.create_dir()
+        path = Filepath(basedir, "foo.py")
+        with open(path, "w") as fp:
+            fp.write("def foo():\n    '''foo doc'''\n    return 1\n")
+
+        pyc = path.compile_to(Filepath(basedir, "out", "foo.pyc"), dfile="foo.py")
+        with open(pyc, "rb") as fp:
+            data = fp.read()
+        # flags 0b01 is a hash based pyc that doesn't check its source
+        self.assertEqual(1, int.from_bytes(data[4:8], "little"))
+        self.assertTrue(b"foo doc" in data)
+
+        os.utime(path, (0, 0))
+        pyc2 = path.compile_to(Filepath(basedir, "out2", "foo.pyc"), dfile="foo.py")
+        with open(pyc2, "rb") as fp:
+            self.assertEqual(data, fp.read())
+
+        pyc3 = path.compile_to(Filepath(basedir, "out3", "foo.pyc"), optimize=2)
+        with open(pyc3, "rb") as fp:
+            self.assertFalse(b"foo doc" in fp.read())
+
+
+
+class DirpathTest(TestCase):
+    def test_zip_to(self):
+        files = {
+            "foo/__init__.py": "",
+            "foo/bar.py": "bar = 1",
+            "che.py": "che = 1",
+            "bin/run": "#!/bin/sh",
+        }
+        d1 = Dirpath(testdata.create_files(files))
+        d2 = Dirpath(testdata.create_files(files))
+        os.chmod(os.path.join(d1, "bin", "run"), 0o775)
+        os.chmod(os.path.join(d2, "bin", "run"), 0o700)
+        os.utime(os.path.join(d2, "che.py"), (0, 0))
+
+        zp1 = d1.zip_to(testdata.get_file("one.zip"))
+        zp2 = d2.zip_to(testdata.get_file("two"))
+        self.assertTrue(zp2.endswith("two.zip"))
+
+        with open(zp1, "rb") as fp1, open(zp2, "rb") as fp2:
+            self.assertEqual(fp1.read(), fp2.read())
+
+        with ZipFile(zp1) as z:
+            names = z.namelist()
+            self.assertEqual(sorted(names), names)
+            self.assertEqual(4, len(names))
+            self.assertEqual(0o755, stat.S_IMODE(z.getinfo("bin/run").external_attr >> 16))
+            self.assertEqual(0o644, stat.S_IMODE(z.getinfo("che.py").external_attr >> 16))
+
+
+class ExclusionsTest(TestCase):
+    def test_match(self):
+        e = Exclusions()
+        self.assertEqual("tests/", e.match("foo/tests/test_bar.py"))
+        self.assertEqual("", e.match("foo/tests.py"))
+        self.assertEqual("*.pyi", e.match("foo/bar.pyi"))
+        self.assertEqual("*.pyc", e.match("foo/__pycache__/bar.cpython-37.pyc"))
+        self.assertEqual("__pycache__/", e.match("foo/__pycache__/README"))
+        self.assertEqual("*.dist-info/INSTALLER", e.match("foo-1.0.dist-info/INSTALLER"))
+        self.assertEqual("", e.match("foo-1.0.dist-info/RECORD"))
+        self.assertEqual("", e.match("foo-1.0.dist-info/licenses/LICENSE"))
+        self.assertEqual("", e.match("foo-1.0.dist-info/LICENSE.txt"))
+        self.assertEqual("", e.match("foo-1.0.dist-info/AUTHORS"))
+        self.assertEqual("", e.match("foo-1.0.dist-info/METADATA"))
+        self.assertEqual("", e.match("foo/bar.py"))
+
+        e = Exclusions(defaults=False)
+        self.assertEqual("", e.match("foo/tests/test_bar.py"))
+
+    def test_match_packages(self):
+        packages = Exclusions.get_packages([
+            "django/__init__.py",
+            "django/test/__init__.py",
+            "django/test/client.py",
+            "django/tests/test_foo.py",
+            "setup.py",
+        ])
+        self.assertEqual(set(["django", "django/test"]), packages)
+
+        e = Exclusions()
+        # an importable test subpackage has to be bundled
+        self.assertEqual("", e.match("django/test/client.py", packages))
+        self.assertEqual("tests/", e.match("django/tests/test_foo.py", packages))
+        self.assertEqual("test/", e.match("django/test/client.py"))
+
+        # a rule that was asked for still matches packages
+        e = Exclusions(["test/"])
+        self.assertEqual("test/", e.match("django/test/client.py", packages))
+
+    def test_add_file(self):
+        path = testdata.get_file("foo.herdignore")
+        with open(path, "w") as fp:
+            fp.write("\n".join([
+                "# comment",
+                "",
+                "foo/data/",
+                "!foo/tests/",
+                "*.txt",
+                "!keep.txt",
+            ]))
+        e = Exclusions()
+        e.add_file(path)
+        e.add_file(testdata.get_file("does-not-exist"))
+
+        self.assertEqual("foo/data/", e.match("foo/data/big.json"))
+        self.assertEqual("", e.match("bar/foo/data/big.json"))
+        self.assertEqual("", e.match("foo/tests/test_bar.py"))
+        self.assertEqual("tests/", e.match("bar/tests/test_bar.py"))
+        self.assertEqual("*.txt", e.match("foo/bar.txt"))
+        self.assertEqual("", e.match("foo/keep.txt"))
+
+
+class ZippathTest(TestCase):
+    def test_write(self):
+        basedir = testdata.create_files({
+            "foo/bar.py": "bar = 1",
+            "che.py": "che = 1",
+        })
+        zp = Zippath(testdata.get_file("foo.zip"))
+        count = zp.write([
+            (Filepath(basedir, "foo", "bar.py"), "pkg/bar.py"),
+            (Filepath(basedir, "che.py"), "che.py"),
+        ])
+        self.assertEqual(2, count)
+
+        with ZipFile(zp) as z:
+            self.assertEqual(["che.py", "pkg/bar.py"], z.namelist())
+            self.assertEqual(b"bar = 1", z.read("pkg/bar.py"))
+
+        with self.assertRaises(ValueError):
+            zp.write([
+                (Filepath(basedir, "foo", "bar.py"), "che.py"),
+                (Filepath(basedir, "che.py"), "che.py"),
+            ])
+
+    def test_write_compression(self):
+        basedir = testdata.create_files({
+            "foo.py": "foo = 1\n" * 100,
+            "foo.so": "foo = 1\n" * 100,
+            "bär.txt": "bar",
+        })
+        paths = [(Filepath(basedir, n), n) for n in ["foo.py", "foo.so", "bär.txt"]]
+
+        zp1 = Zippath(testdata.get_file("one.zip"))
+        zp1.write(paths, workers=1)
+        zp2 = Zippath(testdata.get_file("two.zip"))
+        zp2.write(paths, workers=4)
+        with open(zp1, "rb") as fp1, open(zp2, "rb") as fp2:
+            self.assertEqual(fp1.read(), fp2.read())
+
+        with ZipFile(zp1) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(ZIP_DEFLATED, z.getinfo("foo.py").compress_type)
+            self.assertEqual(ZIP_STORED, z.getinfo("foo.so").compress_type)
+            self.assertEqual(b"bar", z.read("bär.txt"))
+
+        zp1.write(paths, level=0)
+        with ZipFile(zp1) as z:
+            self.assertEqual(ZIP_STORED, z.getinfo("foo.py").compress_type)
+            self.assertEqual(b"foo = 1\n" * 100, z.read("foo.py"))
+
+    def test_write_cache(self):
+        basedir = testdata.create_files({
+            "foo/__init__.py": "foo = 1\n" * 100,
+            "foo/bar.py": "bar = 1\n" * 100,
+            "che.py": "che = 1",
+        })
+        paths = [
+            (Filepath(basedir, "foo", "__init__.py"), "foo/__init__.py", "foo==1.0"),
+            (Filepath(basedir, "foo", "bar.py"), "foo/bar.py", "foo==1.0"),
+            (Filepath(basedir, "che.py"), "che.py", ""),
+        ]
+        cache = FragmentCache(testdata.create_dir())
+
+        zp1 = Zippath(testdata.get_file("one.zip"))
+        zp1.write(paths)
+        zp2 = Zippath(testdata.get_file("two.zip"))
+        zp2.write(paths, cache=cache)
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        zp3 = Zippath(testdata.get_file("three.zip"))
+        zp3.write(paths, cache=cache)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        with open(zp1, "rb") as fp1, open(zp2, "rb") as fp2, open(zp3, "rb") as fp3:
+            data = fp1.read()
+            self.assertEqual(data, fp2.read())
+            self.assertEqual(data, fp3.read())
+
+        # a changed file changes the key so the group is compressed again
+        with open(Filepath(basedir, "foo", "bar.py"), "w") as fp:
+            fp.write("bar = 2\n" * 100)
+        zp3.write(paths, cache=cache)
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+        with ZipFile(zp3) as z:
+            self.assertEqual(b"bar = 2\n" * 100, z.read("foo/bar.py"))
+
+
+class FragmentCacheTest(TestCase):
+    def test_evict(self):
+        cache = FragmentCache(testdata.create_dir(), max_size=1024 * 1024)
+        cache.set("one", {"foo.py": (0, 0, 0, b"1" * 400000, 0o644)})
+        os.utime(cache.get_path("one"), (1, 1))
+        cache.set("two", {"foo.py": (0, 0, 0, b"2" * 400000, 0o644)})
+        os.utime(cache.get_path("two"), (2, 2))
+
+        # one is the least recently used until it is read
+        self.assertIsNotNone(cache.get("one"))
+        cache.set("three", {"foo.py": (0, 0, 0, b"3" * 400000, 0o644)})
+        self.assertIsNotNone(cache.get("one"))
+        self.assertIsNone(cache.get("two"))
+        self.assertIsNotNone(cache.get("three"))
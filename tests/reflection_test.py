@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, division, print_function, absolute_import
 
+import os
+import sys
+from zipfile import ZipFile
+
 from testdata import TestCase
 import testdata
 
 from herd.compat import *
 from herd.reflection import (
     Imports,
+    ImportsCache,
+    ModuleImports,
+    Treeshake,
+    Dirindex,
     Dependencies,
+    Lockfile,
+    Marker,
+    Requirement,
+    Infopath,
+    Wheel,
+    Wheelhouse,
     StandardPackages,
     Packages
 )
@@ -57,8 +71,424 @@ class ImportsTest(TestCase):
         self.assertEqual(1, len(im))
         self.assertTrue("foo14" in im)
 
+    def test_tokenize(self):
+        m = testdata.create_module(contents=[
+            "import foo1",
+            "from foo2 import bar",
+            "import foo3.che as boo, foo4",
+            "from . import foo5",
+            "from ..foo6 import foo7",
+            "from foo8 import (",
+            "    bar1,",
+            "    bar2,",
+            ")",
+            "x = 1; import foo9",
+            "'''",
+            "import bar3",
+            "'''",
+            "# import bar4",
+            "",
+            "def do():",
+            "    import foo10",
+            "    if True: from foo11 import bar5",
+            "    yield from bar6",
+            "    raise ValueError() from bar7",
+        ])
+
+        im = Imports(m.path, cache=False, scanner="tokenize")
+        self.assertEqual(Imports(m.path, cache=False), im)
+        self.assertEqual(8, len(im))
+
+        m = testdata.create_module(contents=[
+            "x = 'no imports'",
+        ])
+        im = Imports(m.path, cache=False, scanner="tokenize")
+        self.assertEqual(0, len(im))
+
+    def test_find_all(self):
+        path = testdata.create_modules({
+            "foo": [
+                "import foo1",
+            ],
+            "foo.bar": [
+                "import foo2",
+            ],
+            "foo.che": [
+                "from . import bar",
+                "import foo3",
+            ],
+        })
+
+        ps = Packages()
+        p = ps["foo"]
+        filepaths = [m.filepath for m in p.modules()]
+
+        cache = ImportsCache(testdata.get_file("imports.pickle"))
+        expected = set(["foo1", "foo2", "foo3"])
+        self.assertEqual(expected, Imports.find_all(filepaths, cache=False))
+        self.assertEqual(expected, Imports.find_all(filepaths, processes=2, cache=cache))
+        self.assertEqual(3, cache.misses)
+
+        self.assertEqual(expected, Imports.find_all(filepaths, processes=2, cache=cache))
+        self.assertEqual(3, cache.hits)
+
+
+class ModuleImportsTest(TestCase):
+    def test___init__(self):
+        m = testdata.create_module(contents=[
+            "import foo1.bar",
+            "from foo2 import bar, che as baz",
+            "from . import foo3",
+            "from .. import foo4",
+            "from ..foo5 import *",
+            "from ...foo6 import bar",
+        ])
+
+        im = ModuleImports(m.path, "pkg.sub.mod")
+        self.assertEqual(set([
+            "foo1.bar",
+            "foo2",
+            "foo2.bar",
+            "foo2.che",
+            "pkg.sub",
+            "pkg.sub.foo3",
+            "pkg",
+            "pkg.foo4",
+            "pkg.foo5",
+        ]), im)
+
+        im = ModuleImports(m.path, "pkg.sub", is_package=True)
+        self.assertTrue("pkg.sub.foo3" in im)
+        self.assertTrue("pkg.foo4" in im)
+
+
+class TreeshakeTest(TestCase):
+    def test_files(self):
+        basedir = testdata.create_files({
+            "foo/__init__.py": "from foo import bar",
+            "foo/bar.py": "from . import che",
+            "foo/che.py": "",
+            "foo/unused.py": "import os",
+            "foo/data.json": "{}",
+            "foo/plugins/__init__.py": "",
+            "foo/plugins/one.py": "from ..deep import thing",
+            "foo/deep/__init__.py": "",
+            "foo/deep/thing.py": "",
+        })
+        m = testdata.create_module(contents=["import foo"])
+
+        p = Packages([basedir])["foo"]
+        ts = Treeshake(m.path, [p], keep=["foo.plugins.*"])
+        relpaths = set(relpath for path, relpath in ts.files(p))
+        self.assertEqual(set([
+            "foo/__init__.py",
+            "foo/bar.py",
+            "foo/che.py",
+            "foo/plugins/__init__.py",
+            "foo/plugins/one.py",
+            "foo/deep/__init__.py",
+            "foo/deep/thing.py",
+        ]), relpaths)
+
+        pruned = set(relpath for path, relpath in ts.pruned)
+        self.assertEqual(set(["foo/unused.py", "foo/data.json"]), pruned)
+
+        ts = Treeshake(m.path, [p], keep=["foo/*.json"])
+        relpaths = set(relpath for path, relpath in ts.files(p))
+        self.assertTrue("foo/data.json" in relpaths)
+        self.assertFalse("foo/plugins/one.py" in relpaths)
+
+
+class ImportsCacheTest(TestCase):
+    def test_get_set(self):
+        cache = ImportsCache(testdata.get_file("imports.pickle"))
+        m = testdata.create_module(contents=[
+            "import foo1",
+            "from foo2 import bar",
+        ])
+
+        im = Imports(m.path, cache=cache)
+        self.assertEqual(set(["foo1", "foo2"]), im)
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(0, cache.hits)
+
+        im = Imports(m.path, cache=cache)
+        self.assertEqual(set(["foo1", "foo2"]), im)
+        self.assertEqual(1, cache.hits)
+
+        # changing the file should invalidate the cached imports
+        with open(m.path, "w") as fp:
+            fp.write("import foo3")
+        im = Imports(m.path, cache=cache)
+        self.assertEqual(set(["foo3"]), im)
+        self.assertEqual(2, cache.misses)
+
+    def test_get_set_hash(self):
+        class Cache(ImportsCache):
+            hashes = 0
+            def hash(self, filepath):
+                self.hashes += 1
+                return super(Cache, self).hash(filepath)
+
+        cache = Cache(testdata.get_file("imports.pickle"))
+        m = testdata.create_module(contents="import foo1")
+
+        # a miss hashes the file once for both .get() and .set()
+        Imports(m.path, cache=cache)
+        self.assertEqual(1, cache.hashes)
+        self.assertEqual({}, cache.digests)
+
+    def test_save(self):
+        path = testdata.get_file("imports.pickle")
+        m = testdata.create_module(contents="import foo1")
+
+        cache = ImportsCache(path)
+        Imports(m.path, cache=cache)
+        cache.save()
+
+        # same contents at a different path should hit using the hash
+        m2 = testdata.create_module(contents="import foo1")
+        cache = ImportsCache(path)
+        im = Imports(m2.path, cache=cache)
+        self.assertEqual(set(["foo1"]), im)
+        self.assertEqual(1, cache.hits)
+
+        cache.clear()
+        im = Imports(m2.path, cache=cache)
+        self.assertEqual(1, cache.misses)
+
+
+class DirindexTest(TestCase):
+    def test_find(self):
+        basedir = testdata.create_files({
+            "Foo.py": "",
+            "bar/__init__.py": "",
+            "che.cpython-37m-x86_64-linux-gnu.so": "",
+            "baz_boo-1.0.dist-info/METADATA": "Name: baz-boo",
+        })
+
+        index = Dirindex(basedir)
+        self.assertEqual("py", index.find("Foo").ext)
+        self.assertTrue(index.find("foo").endswith("Foo.py"))
+        self.assertTrue(index.find("bar").isdir())
+        self.assertEqual("so", index.find("che").ext)
+
+        self.assertIsNone(index.find("boo"))
+        self.assertTrue("boo" in index.misses)
+
+        infopaths = index.find_infopaths("Baz-Boo")
+        self.assertEqual(1, len(infopaths))
+        self.assertTrue(infopaths[0].endswith("baz_boo-1.0.dist-info"))
+
+    def test_get_instance_stale(self):
+        basedir = testdata.create_dir()
+        self.assertFalse("foomod" in Packages(paths=[basedir]))
+
+        with open(os.path.join(basedir, "foomod.py"), "w") as fp:
+            fp.write("")
+        # make sure the mtime moves even on a filesystem with coarse mtimes
+        st = os.stat(basedir)
+        os.utime(basedir, (st.st_atime, st.st_mtime + 10))
+
+        # the earlier miss shouldn't hide the new module
+        self.assertTrue("foomod" in Packages(paths=[basedir]))
+
+    def test_find_distribution(self):
+        basedir = testdata.create_files({
+            "foo/__init__.py": "",
+            "bar.py": "",
+            "foo_dist-1.0.dist-info/top_level.txt": "foo",
+            "bar_dist-2.0.dist-info/RECORD": [
+                "bar.py,sha256=abc,10",
+                "__pycache__/bar.cpython-37.pyc,,",
+                "bar_dist-2.0.dist-info/RECORD,,",
+                "../../../bin/bar,sha256=abc,10",
+            ],
+        })
+
+        index = Dirindex(basedir)
+        self.assertTrue(index.find_distribution("foo").endswith("foo_dist-1.0.dist-info"))
+        self.assertTrue(index.find_distribution("bar").endswith("bar_dist-2.0.dist-info"))
+        self.assertIsNone(index.find_distribution("che"))
+
+        infopath = index.find_distribution("bar")
+        self.assertEqual(["bar"], index.get_top_level(infopath))
+        self.assertEqual(3, len(infopath.files()))
+
+    def test_find_distributions(self):
+        basedir = testdata.create_files({
+            "nsp/a/__init__.py": "",
+            "nsp/b/__init__.py": "",
+            "zdist-1.0.dist-info/top_level.txt": "nsp",
+            "zdist-1.0.dist-info/METADATA": ["Name: zdist", "Requires-Dist: zreq"],
+            "adist-1.0.dist-info/top_level.txt": "nsp",
+            "adist-1.0.dist-info/METADATA": ["Name: adist", "Requires-Dist: areq"],
+        })
+
+        index = Dirindex(basedir)
+        infopaths = index.find_distributions("nsp")
+        self.assertEqual(["adist", "zdist"], [m.name for m in infopaths])
+        self.assertEqual(infopaths[0], index.find_distribution("nsp"))
+        self.assertEqual([], index.find_distributions("che"))
+
+        p = Packages(paths=[basedir])["nsp"]
+        self.assertEqual(2, len(p.infopaths))
+        self.assertEqual(set(["areq", "zreq"]), p._requires_info())
+
+    def test_get_instance(self):
+        basedir = testdata.create_dir()
+        self.assertIs(Dirindex.get_instance(basedir), Dirindex.get_instance(basedir))
+
+
+class MarkerTest(TestCase):
+    def test_evaluate(self):
+        environment = Marker.get_environment(
+            "python3.9",
+            sys_platform="linux",
+            platform_system="Linux",
+        )
+        self.assertEqual("3.9", environment["python_version"])
+
+        m = Marker('python_version < "3.8"')
+        self.assertFalse(m.evaluate(environment))
+
+        m = Marker('python_version >= "3.6" and (sys_platform == "win32" or os_name == "nt")')
+        self.assertFalse(m.evaluate(environment))
+
+        m = Marker("python_version == '3.*' and platform_system != 'Windows'")
+        self.assertTrue(m.evaluate(environment))
+
+        m = Marker('python_full_version ~= "3.9.0"')
+        self.assertTrue(m.evaluate(environment))
+
+        m = Marker('"linux" in sys_platform and extra == "Test_Suite"')
+        self.assertFalse(m.evaluate(environment))
+        self.assertFalse(m.evaluate(environment, ["other"]))
+        self.assertTrue(m.evaluate(environment, ["other", "test-suite"]))
+
+        with self.assertRaises(ValueError):
+            Marker('python_version < "3.8" and')
+
+        with self.assertRaises(ValueError):
+            Marker('foo == "bar"')
+
+    def test_requirement(self):
+        r = Requirement('Foo-Bar[baz, che] (>=1.0) ; python_version < "3.8"')
+        self.assertEqual("Foo", r.name)
+        self.assertEqual("Foo-Bar", r.distribution)
+        self.assertEqual(set(["baz", "che"]), r.extras)
+        self.assertNotEqual("", r.drop_reason(Marker.get_environment("python3.9")))
+        self.assertEqual("", r.drop_reason(Marker.get_environment("python3.7")))
+
+        # a marker we can't understand keeps the requirement
+        r = Requirement('foo ; python_version <')
+        self.assertEqual("", r.drop_reason())
+
+    def test_infopath_requires(self):
+        basedir = testdata.create_files({
+            "foo-1.0.dist-info/METADATA": [
+                "Name: foo",
+                "Requires-Dist: bar (>=1.0)",
+                "Requires-Dist: che ; sys_platform == 'win32'",
+                "Requires-Dist: baz ; extra == 'test'",
+            ],
+        })
+        infopath = Infopath(os.path.join(basedir, "foo-1.0.dist-info"))
+        self.assertEqual("foo", infopath.name)
+        self.assertEqual(3, len(infopath.requirements()))
+
+        environment = Marker.get_environment(sys_platform="linux")
+        self.assertEqual(set(["bar"]), infopath.requires(environment))
+        self.assertEqual(set(["bar", "baz"]), infopath.requires(environment, ["test"]))
+        self.assertEqual(
+            set(["bar", "che"]),
+            infopath.requires(Marker.get_environment(sys_platform="win32"))
+        )
+
+
+class WheelhouseTest(TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ["HERD_CACHE_DIR"] = testdata.create_dir()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def create_wheel(self, basedir, filename, files):
+        path = os.path.join(basedir, filename)
+        with ZipFile(path, "w") as z:
+            for name, contents in files.items():
+                z.writestr(name, contents)
+        return path
+
+    def test_find(self):
+        basedir = testdata.create_dir()
+        for filename in [
+            "foo-1.0-cp39-cp39-macosx_10_9_x86_64.whl",
+            "foo-1.0-cp39-cp39-manylinux_2_17_aarch64.manylinux2014_aarch64.whl",
+            "foo-1.0-cp39-cp39-manylinux_2_17_x86_64.manylinux2014_x86_64.whl",
+            "foo-1.0-cp36-abi3-manylinux2010_x86_64.whl",
+            "foo-1.0-cp39-cp39-manylinux_2_28_x86_64.whl",
+            "Foo_Bar-2.0-py2.py3-none-any.whl",
+            "Foo_Bar-2.1-py3-none-any.whl",
+            "not-a-wheel.whl",
+        ]:
+            self.create_wheel(basedir, filename, {})
+
+        wh = Wheelhouse(basedir, "python3.9")
+        self.assertEqual(
+            "foo-1.0-cp39-cp39-manylinux_2_17_x86_64.manylinux2014_x86_64.whl",
+            wh.find("foo").basename
+        )
+        self.assertIsNone(wh.find("foo", "2.0"))
+        self.assertEqual("Foo_Bar-2.1-py3-none-any.whl", wh.find("foo-bar").basename)
+        self.assertEqual("Foo_Bar-2.0-py2.py3-none-any.whl", wh.find("foo.bar", "2.0").basename)
+
+        wh = Wheelhouse(basedir, "python3.9", "aarch64")
+        self.assertEqual(
+            "foo-1.0-cp39-cp39-manylinux_2_17_aarch64.manylinux2014_aarch64.whl",
+            wh.find("foo").basename
+        )
+
+        # python3.12 lambda has a newer glibc
+        wh = Wheelhouse(basedir, "python3.12")
+        self.assertEqual("foo-1.0-cp36-abi3-manylinux2010_x86_64.whl", wh.find("foo").basename)
+
+    def test_files(self):
+        basedir = testdata.create_dir()
+        path = self.create_wheel(basedir, "foo-1.0-py3-none-any.whl", {
+            "foo/__init__.py": "",
+            "foo/__pycache__/__init__.cpython-39.pyc": "",
+            "foo-1.0.dist-info/METADATA": "Name: foo",
+            "foo-1.0.data/purelib/foo_extra.py": "",
+            "foo-1.0.data/scripts/foo": "",
+        })
+
+        w = Wheel(path)
+        relpaths = sorted(relpath for path, relpath in w.files())
+        self.assertEqual(["foo-1.0.dist-info/METADATA", "foo/__init__.py", "foo_extra.py"], relpaths)
+
+        # the unpacked wheel is reused
+        unpacked = w.unpack()
+        os.unlink(os.path.join(unpacked, "foo", "__init__.py"))
+        self.assertEqual(unpacked, w.unpack())
+        self.assertFalse(os.path.isfile(os.path.join(w.unpack(), "foo", "__init__.py")))
+
+        with self.assertRaises(ValueError):
+            Wheel(basedir, "foo-1.0.zip")
+
 
 class PackagesTest(TestCase):
+    def test_requires_processes(self):
+        basedir = testdata.create_files({
+            "foo/__init__.py": "import bar",
+            "foo/che.py": "import baz",
+        })
+        p = Packages(paths=[basedir])["foo"]
+        p.parse_threshold = 1
+        self.assertEqual(set(["bar", "baz"]), p.requires(processes=2))
+
     def test___missing__(self):
         ps = Packages()
 
@@ -165,6 +595,76 @@ class PackagesTest(TestCase):
         expected = set(["boto3", "sys", "os"])
         self.assertEqual(expected, p.requires())
 
+    def test_files(self):
+        basedir = testdata.create_files({
+            "foo/__init__.py": "",
+            "foo/bar.py": "",
+            "foo/__pycache__/bar.cpython-37.pyc": "",
+            "foo/stray.py": "",
+            "foo_data.json": "{}",
+            "foo-1.0.dist-info/METADATA": "Name: foo",
+            "foo-1.0.dist-info/RECORD": [
+                "foo/__init__.py,sha256=abc,0",
+                "foo/bar.py,sha256=abc,0",
+                "foo/__pycache__/bar.cpython-37.pyc,,",
+                "foo_data.json,sha256=abc,2",
+                "foo-1.0.dist-info/METADATA,sha256=abc,9",
+                "foo-1.0.dist-info/RECORD,,",
+            ],
+        })
+
+        ps = Packages([basedir])
+        p = ps["foo"]
+        relpaths = set(relpath for path, relpath in p.files())
+        self.assertEqual(set([
+            "foo/__init__.py",
+            "foo/bar.py",
+            "foo_data.json",
+            "foo-1.0.dist-info/METADATA",
+            "foo-1.0.dist-info/RECORD",
+        ]), relpaths)
+
+        path = testdata.create_modules({
+            "bar": [],
+            "bar.che": [],
+        })
+        ps = Packages()
+        p = ps["bar"]
+        relpaths = set(relpath for path, relpath in p.files())
+        self.assertEqual(set(["bar/__init__.py", "bar/che.py"]), relpaths)
+
+    def test_files_namespace(self):
+        basedir = testdata.create_files({
+            "nsp/a/__init__.py": "",
+            "nsp/b/__init__.py": "",
+            "dista-1.0.dist-info/top_level.txt": "nsp",
+            "dista-1.0.dist-info/RECORD": [
+                "nsp/a/__init__.py,sha256=abc,0",
+                "dista-1.0.dist-info/RECORD,,",
+            ],
+            "distb-1.0.dist-info/top_level.txt": "nsp",
+            "distb-1.0.dist-info/RECORD": [
+                "nsp/b/__init__.py,sha256=abc,0",
+                "distb-1.0.dist-info/RECORD,,",
+            ],
+        })
+
+        p = Packages(paths=[basedir])["nsp"]
+        relpaths = set(relpath for path, relpath in p.files())
+        self.assertEqual(set([
+            "nsp/a/__init__.py",
+            "nsp/b/__init__.py",
+            "dista-1.0.dist-info/RECORD",
+            "distb-1.0.dist-info/RECORD",
+        ]), relpaths)
+
+        # a distribution that didn't record its files falls back to .path
+        os.unlink(os.path.join(basedir, "distb-1.0.dist-info", "RECORD"))
+        Dirindex.clear()
+        p = Packages(paths=[basedir])["nsp"]
+        relpaths = set(relpath for path, relpath in p.files())
+        self.assertEqual(set(["nsp/a/__init__.py", "nsp/b/__init__.py"]), relpaths)
+
     def test_has_shared_library(self):
         modpath = testdata.create_package(contents=[])
         shared_library = testdata.create_file("foo.so", tmpdir=modpath.directory)
@@ -203,6 +703,154 @@ class DependenciesTest(TestCase):
         d = Dependencies(m.path)
         self.assertLess(0, len(d))
 
+    def test_required_by(self):
+        m = testdata.create_module(contents=[
+            "import boto3",
+            "import os",
+        ])
+
+        d = Dependencies(m.path)
+        required_by = d.required_by()
+        self.assertEqual([""], required_by["boto3"])
+        self.assertTrue("boto3" in required_by["botocore"])
+        self.assertEqual(set(String(p) for p in d), set(required_by))
+
+    def test_workers(self):
+        m = testdata.create_module(contents=[
+            "import boto3",
+            "import os",
+        ])
+
+        d = Dependencies(m.path)
+        d2 = Dependencies(m.path, workers=4)
+        self.assertLess(0, len(d2))
+        self.assertEqual(d, d2)
+
+        d = Dependencies(m.path, ["^botocore(?:\\.|$)"])
+        d2 = Dependencies(m.path, ["^botocore(?:\\.|$)"], workers=4)
+        self.assertEqual(d, d2)
+
+    def test_lockfile(self):
+        m = testdata.create_module(contents=[
+            "import boto3",
+            "import os",
+        ])
+        lockfile = Lockfile(testdata.get_file("foo.herd.lock"))
+
+        with self.assertRaises(ValueError):
+            Dependencies(m.path, lockfile=lockfile, frozen=True)
+
+        d = Dependencies(m.path, lockfile=lockfile)
+        self.assertEqual("", lockfile.drift(m.path, []))
+        self.assertNotEqual("", lockfile.drift(m.path, ["^boto3"]))
+
+        d2 = Dependencies(m.path, lockfile=lockfile, frozen=True)
+        self.assertEqual(d, d2)
+        for p in d2:
+            if p == "boto3":
+                self.assertNotEqual("", p.version)
+
+        with open(m.path, "w") as fp:
+            fp.write("import os")
+        self.assertNotEqual("", lockfile.drift(m.path, []))
+        with self.assertRaises(ValueError):
+            Dependencies(m.path, lockfile=lockfile, frozen=True)
+
+        d3 = Dependencies(m.path, lockfile=lockfile)
+        self.assertEqual(0, len(d3))
+        self.assertEqual("", lockfile.drift(m.path, []))
+
+    def test_lockfile_install(self):
+        basedir = testdata.create_dir()
+        m = testdata.create_module(contents=[
+            "import lkfoomod",
+        ])
+        lockfile = Lockfile(testdata.get_file("foo.herd.lock"))
+
+        sys.path.insert(0, basedir)
+        try:
+            d = Dependencies(m.path, lockfile=lockfile)
+            self.assertEqual(0, len(d))
+
+            # install lkfoomod, the mtime is moved in case the filesystem's
+            # mtimes are coarse
+            with open(os.path.join(basedir, "lkfoomod.py"), "w") as fp:
+                fp.write("")
+            st = os.stat(basedir)
+            os.utime(basedir, (st.st_atime, st.st_mtime + 10))
+            self.assertNotEqual("", lockfile.drift(m.path, []))
+
+            d = Dependencies(m.path, lockfile=lockfile)
+            self.assertEqual(["lkfoomod"], [String(p) for p in d])
+
+            # the new lockfile has it too
+            self.assertEqual("", lockfile.drift(m.path, []))
+            d = Dependencies(m.path, lockfile=lockfile, frozen=True)
+            self.assertEqual(["lkfoomod"], [String(p) for p in d])
+
+        finally:
+            sys.path.remove(basedir)
+
+    def test_markers_extras(self):
+        basedir = testdata.create_files({
+            "mkfoo/__init__.py": [
+                "try:",
+                "    import mkwin",
+                "except ImportError:",
+                "    pass",
+            ],
+            "mkfoo-1.0.dist-info/METADATA": [
+                "Name: mkfoo",
+                "Requires-Dist: mkbar[fast]",
+                "Requires-Dist: mkwin ; sys_platform == 'win32'",
+                "Requires-Dist: mktest ; extra == 'test'",
+            ],
+            "mkfoo-1.0.dist-info/top_level.txt": "mkfoo",
+            "mkbar.py": "",
+            "mkbar-1.0.dist-info/METADATA": [
+                "Name: mkbar",
+                "Requires-Dist: mkfast ; extra == 'fast'",
+            ],
+            "mkbar-1.0.dist-info/top_level.txt": "mkbar",
+            "mkfast.py": "",
+            "mkfast-1.0.dist-info/top_level.txt": "mkfast",
+            "mkwin.py": "",
+            "mkwin-1.0.dist-info/top_level.txt": "mkwin",
+            "mktest.py": "",
+            "mktest-1.0.dist-info/top_level.txt": "mktest",
+        })
+        m = testdata.create_module(contents=["import mkfoo"])
+        environment = Marker.get_environment(sys_platform="linux")
+
+        sys.path.insert(0, basedir)
+        try:
+            for workers in [0, 2]:
+                d = Dependencies(m.path, environment=environment, workers=workers)
+                self.assertEqual(set(["mkfoo", "mkbar", "mkfast"]), set(String(p) for p in d))
+                self.assertEqual(
+                    set(["mkwin", "mktest"]),
+                    set(r.name for p, r, reason in d.dropped)
+                )
+
+            d = Dependencies(m.path, environment=environment, extras=["mkfoo[test]"])
+            self.assertEqual(set(["mkfoo", "mkbar", "mkfast", "mktest"]), set(String(p) for p in d))
+
+            d = Dependencies(m.path, environment=Marker.get_environment(sys_platform="win32"))
+            self.assertEqual(set(["mkfoo", "mkbar", "mkfast", "mkwin"]), set(String(p) for p in d))
+
+        finally:
+            sys.path.remove(basedir)
+
+    def test_scanner(self):
+        m = testdata.create_module(contents=[
+            "import boto3",
+            "import os",
+        ])
+
+        d = Dependencies(m.path)
+        d2 = Dependencies(m.path, scanner="tokenize")
+        self.assertEqual(d, d2)
+
     def test_standard(self):
         """make sure standard modules are ignored"""
         m = testdata.create_module(contents=[
@@ -264,6 +912,19 @@ class StandardPackagesTest(TestCase):
         p = s["json"]
         self.assertTrue(p is not None)
 
+    def test_get_module_names(self):
+        names = StandardPackages.get_module_names()
+        self.assertIs(names, StandardPackages.get_module_names())
+        for modpath in ["sys", "os", "email", "zlib"]:
+            self.assertTrue(modpath in names, modpath)
+
+        self.assertTrue(StandardPackages.is_standard_name("os.path"))
+        self.assertFalse(StandardPackages.is_standard_name("boto3"))
+
+        s = StandardPackages.get_instance()
+        with self.assertRaises(KeyError):
+            s["boto3"]
+
 
 # class SitePackagesTest(TestCase):
 #     def test_setuptools(self):